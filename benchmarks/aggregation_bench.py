@@ -0,0 +1,62 @@
+"""
+Memory per tracked series and ingest throughput of the windowed aggregator.
+
+Feeds DHT11-style readings (two metrics) from many devices into aggregators
+with tumbling and sliding windows, with and without percentiles, and reports
+the memory held per (device, metric) series as measured by tracemalloc.
+
+Usage: PYTHONPATH=. python benchmarks/aggregation_bench.py [--devices N] [--readings N]
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from iot_bridge.aggregation import AggregationRule, Aggregator
+
+CONFIGS = [
+    ("tumbling 60s", dict(window=60)),
+    ("sliding 60s / 10s", dict(window=60, step=10)),
+    ("sliding 300s / 10s", dict(window=300, step=10)),
+    ("tumbling 60s + p50/p95/p99", dict(window=60, percentiles=(50, 95, 99))),
+    ("sliding 60s / 10s + p50/p95/p99", dict(window=60, step=10, percentiles=(50, 95, 99))),
+]
+
+
+def feed(settings, readings, rounds):
+    aggregator = Aggregator([AggregationRule(**settings)], lambda summary: None, source="bench",
+                            max_series=10 * len(readings))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for reading in readings:
+            aggregator.apply(reading)
+    elapsed = time.perf_counter() - started
+    aggregator._stopped.set() # Nothing to forward
+    return aggregator, elapsed
+
+
+def run(name, settings, devices, rounds):
+    readings = [{"temperature": round(random.uniform(15, 30), 1), "humidity": round(random.uniform(30, 70), 1),
+                 "device_id": f"dev-{i:05d}", "source": "mqtt", "topic": f"sensor/dht11/dev-{i:05d}"}
+                for i in range(devices)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    aggregator, _ = feed(settings, readings, rounds)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    _, elapsed = feed(settings, readings, rounds) # Timed without tracemalloc
+    print(f"{name:<34} {held / aggregator._series:>8,.0f} bytes/series  "
+          f"{devices * rounds / elapsed:>10,.0f} readings/s  ({aggregator._series:,} series)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--readings", type=int, default=5, help="Readings per device")
+    args = parser.parse_args()
+    for name, settings in CONFIGS:
+        run(name, settings, args.devices, args.readings)
+
+
+if __name__ == "__main__":
+    main()
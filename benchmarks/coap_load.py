@@ -0,0 +1,161 @@
+"""
+CoAP load generator: confirmable POSTs against a running CoAP bridge.
+
+Each client is its own UDP socket (so its own source port, which is what
+SO_REUSEPORT balances worker processes on) and keeps a window of requests in
+flight. A share of the requests is resent under a new message ID with the same
+token and payload, the way a device resends after its own timeout; the bridge
+answers those with "Duplicate", which gives the dedup hit rate.
+
+Start the bridge (e.g. COAP_RESPONSE_MODE=queued, BRIDGE_PROCESSES=4) against a
+gateway, then:
+
+Usage: PYTHONPATH=. python benchmarks/coap_load.py [--clients N] [--duration S] [--duplicates 0.05]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from aiocoap import CON, Code, Message
+from aiocoap.numbers.types import Type
+
+
+class Client(asyncio.DatagramProtocol):
+    """One UDP socket with up to `window` outstanding requests."""
+
+    def __init__(self, name, window, duplicates, deadline):
+        self.name = name
+        self.window = window
+        self.duplicates = duplicates
+        self.deadline = deadline
+        self.mid = random.randrange(0x10000)
+        self.seq = 0
+        self.pending = {} # token -> [sent_at, responses expected]
+        self.transport = None
+        self.slot = asyncio.Event()
+        self.sent = self.resent = self.answered = self.duplicate_answers = self.errors = 0
+        self.latencies = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def next_mid(self):
+        self.mid = (self.mid + 1) & 0xFFFF
+        return self.mid
+
+    def send(self, token, payload):
+        message = Message(code=Code.POST, payload=payload, uri_path=("data",), content_format=50)
+        message.mtype, message.mid, message.token = CON, self.next_mid(), token # Set by hand, no client context
+        self.transport.sendto(message.encode())
+
+    def datagram_received(self, data, addr):
+        message = Message.decode(data)
+        if message.mtype == Type.CON:
+            # Separate response: acknowledge it so the bridge does not retransmit
+            ack = Message(code=Code.EMPTY)
+            ack.mtype, ack.mid = Type.ACK, message.mid
+            self.transport.sendto(ack.encode())
+        if message.code == Code.EMPTY:
+            return # Empty ACK; the response follows
+        entry = self.pending.get(message.token)
+        if entry is None:
+            return # Late answer to a request already given up on
+        self.answered += 1
+        self.latencies.append(time.perf_counter() - entry[0])
+        if message.payload == b"Duplicate":
+            self.duplicate_answers += 1
+        if not message.code.is_successful():
+            self.errors += 1
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.pending[message.token]
+            self.slot.set()
+
+    async def run(self):
+        while time.perf_counter() < self.deadline:
+            if len(self.pending) >= self.window:
+                self.slot.clear()
+                try:
+                    await asyncio.wait_for(self.slot.wait(), 2)
+                except asyncio.TimeoutError:
+                    self.expire()
+                continue
+            self.seq += 1
+            token = os.urandom(4)
+            payload = json.dumps({"temperature": round(random.uniform(15, 30), 2), "seq": self.seq,
+                                  "device_id": self.name, "timestamp": time.time()}).encode("utf-8")
+            resend = random.random() < self.duplicates
+            self.pending[token] = [time.perf_counter(), 2 if resend else 1]
+            self.send(token, payload)
+            self.sent += 1
+            if resend:
+                self.send(token, payload) # New message ID, same token and payload
+                self.resent += 1
+        await asyncio.sleep(1) # Collect the last answers
+
+    def expire(self):
+        """Give up on requests unanswered for 5 seconds (lost datagrams)."""
+        cutoff = time.perf_counter() - 5
+        for token in [token for token, (sent_at, _) in self.pending.items() if sent_at < cutoff]:
+            del self.pending[token]
+
+
+async def load(host, port, clients, window, duplicates, duration, offset):
+    loop = asyncio.get_running_loop()
+    deadline = time.perf_counter() + duration
+    protocols = []
+    for i in range(clients):
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda i=i: Client(f"load-{offset + i}", window, duplicates, deadline), remote_addr=(host, port))
+        protocols.append(protocol)
+    await asyncio.gather(*(protocol.run() for protocol in protocols))
+    for protocol in protocols:
+        protocol.transport.close()
+    totals = {key: sum(getattr(p, key) for p in protocols)
+              for key in ("sent", "resent", "answered", "duplicate_answers", "errors")}
+    totals["latencies"] = [latency for p in protocols for latency in p.latencies]
+    return totals
+
+
+def run_process(args, offset):
+    return asyncio.run(load(args.host, args.port, args.clients, args.window, args.duplicates, args.duration, offset))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5683)
+    parser.add_argument("--clients", type=int, default=32, help="UDP sockets per generator process")
+    parser.add_argument("--window", type=int, default=4, help="Requests in flight per client")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="Share of requests resent under a new message ID")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--processes", type=int, default=1, help="Generator processes")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(run_process, [(args, n * args.clients) for n in range(args.processes)])
+    else:
+        results = [run_process(args, 0)]
+
+    totals = {key: sum(result[key] for result in results) for key in ("sent", "resent", "answered", "duplicate_answers", "errors")}
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    requests = totals["sent"] + totals["resent"]
+    print(f"requests:     {requests:,} ({totals['resent']:,} resent) from {args.processes * args.clients} clients")
+    print(f"answered:     {totals['answered']:,} ({totals['errors']:,} errors, {requests - totals['answered']:,} unanswered)")
+    print(f"throughput:   {totals['answered'] / args.duration:,.0f} requests/s")
+    if latencies:
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        print(f"latency:      p50 {percentile(0.5):.1f} ms, p99 {percentile(0.99):.1f} ms")
+    if totals["resent"]:
+        print(f"dedup hits:   {totals['duplicate_answers']:,} of {totals['resent']:,} resends "
+              f"({totals['duplicate_answers'] / totals['resent']:.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Per-reading JSON handling cost: stdlib versus the fast codec paths.
+
+For each payload and each installed backend it times the bridges' old path
+(bytes -> str -> json.loads -> add envelope -> json.dumps), the same steps with
+the fast codec, and the splice path (codec.enrich) that skips re-encoding.
+
+Usage: PYTHONPATH=. python benchmarks/codec_bench.py [--iterations N]
+"""
+import argparse
+import json
+import timeit
+
+from iot_bridge.codec import BACKENDS, Codec, _available
+
+PAYLOADS = {
+    # What a DHT11 node publishes over MQTT
+    "dht11": b'{"temperature": 23.4, "humidity": 51.0, "sensor_id": "dht11-kitchen", "timestamp": 1718000000.123}',
+    # A Modbus device reading from a register map with a few dozen points
+    "modbus": json.dumps(dict(
+        [(f"reg_{i}", round(i * 1.37, 2)) for i in range(40)]
+        + [("source", "modbus"), ("device_id", "modbus_192.168.1.100_1")]
+    )).encode("utf-8"),
+}
+ENVELOPE = {"source": "mqtt", "topic": "sensor/dht11/device123", "device_id": "device123"}
+
+
+def stdlib_path(raw):
+    payload = json.loads(raw.decode("utf-8"))
+    for key, value in ENVELOPE.items():
+        if key not in payload:
+            payload[key] = value
+    return json.dumps(payload).encode("utf-8")
+
+
+def codec_paths(codec):
+    """(loads + envelope + dumps, splice) callables for one codec."""
+    return (
+        lambda raw: codec.dumps(codec.decode_reading(raw, ENVELOPE)),
+        lambda raw: codec.enrich(raw, ENVELOPE),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    cases = [("stdlib loads+dumps", stdlib_path)]
+    for backend in BACKENDS:
+        if not _available(backend):
+            print(f"{backend}: not installed, skipped")
+            continue
+        for validate in (False, True):
+            suffix = " +schema" if validate else ""
+            full, splice = codec_paths(Codec(backend, validate=validate))
+            cases.append((f"{backend} loads+dumps{suffix}", full))
+            cases.append((f"{backend} enrich{suffix}", splice))
+
+    for name, raw in PAYLOADS.items():
+        print(f"{name} ({len(raw)} bytes)")
+        baseline = None
+        for label, func in cases:
+            seconds = min(timeit.repeat(lambda: func(raw), number=args.iterations, repeat=3)) / args.iterations
+            baseline = baseline or seconds
+            print(f"  {label:<28} {seconds * 1e6:7.2f} us/reading  {baseline / seconds:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
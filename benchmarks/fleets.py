@@ -0,0 +1,200 @@
+"""
+Simulated device fleets for load tests.
+
+Every fleet sends readings at a fixed total rate, round-robin over its
+devices, and stamps each reading with ``sent_at`` so the stub gateway can
+measure end-to-end latency. The Modbus fleet is a small Modbus TCP server with
+one unit per device whose registers hold the time they are read
+(``sent_at_ms``), so its latency runs from the poll to the gateway.
+"""
+import asyncio
+import json
+import os
+import random
+import struct
+import time
+
+from iot_bridge import codec
+
+
+def dht11_reading(device, seq):
+    return {"temperature": round(random.uniform(15, 30), 1), "humidity": round(random.uniform(30, 70), 1), "sensor_id": device}
+
+
+def wide_reading(device, seq):
+    # A device reporting a few dozen metrics at once
+    reading = {f"reg_{i}": round(random.uniform(0, 1000), 2) for i in range(40)}
+    reading["sensor_id"] = device
+    return reading
+
+
+PAYLOADS = {"dht11": dht11_reading, "wide": wide_reading}
+
+
+def make_reading(shape, device, seq):
+    reading = PAYLOADS[shape](device, seq)
+    reading["seq"] = seq
+    reading["sent_at"] = time.time()
+    return reading
+
+
+async def paced(rate, duration, devices, send):
+    """Await send(device_index, seq) `rate` times per second for `duration` seconds; return the count."""
+    sent = 0
+    started = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            return sent
+        due = int(rate * elapsed)
+        while sent < due:
+            await send(sent % devices, sent)
+            sent += 1
+        await asyncio.sleep(0.005)
+
+
+async def mqtt_fleet(host, port, devices, rate, duration, shape="dht11", topic_prefix="bench/dht11"):
+    """QoS 0 publishes from one client on bench/dht11/dev-<n> topics."""
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"loadtest-{os.getpid()}")
+    client.max_queued_messages_set(0)
+    client.connect(host, port)
+    client.loop_start()
+    names = [f"dev-{i}" for i in range(devices)]
+
+    async def send(i, seq):
+        client.publish(f"{topic_prefix}/{names[i]}", codec.dumps(make_reading(shape, names[i], seq)))
+    try:
+        return await paced(rate, duration, devices, send)
+    finally:
+        await asyncio.sleep(0.5) # Let paho flush
+        client.disconnect()
+        client.loop_stop()
+
+
+async def websocket_fleet(url, devices, rate, duration, shape="dht11"):
+    """One WebSocket connection per device, one reading per text message."""
+    import websockets
+
+    connections = [await websockets.connect(url) for _ in range(devices)]
+    names = [f"ws-{i}" for i in range(devices)]
+
+    async def send(i, seq):
+        await connections[i].send(codec.dumps(make_reading(shape, names[i], seq)).decode("utf-8"))
+    try:
+        return await paced(rate, duration, devices, send)
+    finally:
+        for connection in connections:
+            await connection.close()
+
+
+class _CoapDevice(asyncio.DatagramProtocol):
+    """Confirmable POSTs to /data from one UDP socket; answers are counted, not awaited."""
+
+    def __init__(self):
+        self.transport = None
+        self.mid = random.randrange(0x10000)
+        self.answered = self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def post(self, payload):
+        from aiocoap import CON, Code, Message
+        message = Message(code=Code.POST, payload=payload, uri_path=("data",), content_format=50)
+        self.mid = (self.mid + 1) & 0xFFFF
+        message.mtype, message.mid, message.token = CON, self.mid, os.urandom(4)
+        self.transport.sendto(message.encode())
+
+    def datagram_received(self, data, addr):
+        from aiocoap import ACK, CON, Code, Message
+        message = Message.decode(data)
+        if message.mtype == CON:
+            ack = Message(code=Code.EMPTY)
+            ack.mtype, ack.mid = ACK, message.mid
+            self.transport.sendto(ack.encode()) # Separate response
+        if message.code == Code.EMPTY:
+            return
+        self.answered += 1
+        if not message.code.is_successful():
+            self.errors += 1
+
+
+async def coap_fleet(host, port, devices, rate, duration, shape="dht11"):
+    """One UDP socket per device sending confirmable JSON POSTs (no retransmission)."""
+    loop = asyncio.get_running_loop()
+    endpoints = [await loop.create_datagram_endpoint(_CoapDevice, remote_addr=(host, port)) for _ in range(devices)]
+    names = [f"coap-{i}" for i in range(devices)]
+
+    async def send(i, seq):
+        endpoints[i][1].post(codec.dumps(make_reading(shape, names[i], seq)))
+    try:
+        return await paced(rate, duration, devices, send)
+    finally:
+        await asyncio.sleep(1) # Collect the last answers
+        for transport, _ in endpoints:
+            transport.close()
+
+
+# Holding registers of every simulated Modbus unit
+MODBUS_POINTS = [
+    {"name": "sent_at_ms", "address": 0, "type": "uint64"},
+    {"name": "temperature", "address": 4, "scale": 0.1},
+    {"name": "humidity", "address": 5, "scale": 0.1},
+]
+
+
+def modbus_register_map(path, port, devices, poll_interval):
+    """Write a register map polling `devices` units of the simulator every `poll_interval` seconds."""
+    if devices > 247:
+        raise ValueError("A Modbus simulator port serves at most 247 units")
+    register_map = {"devices": [
+        {"name": f"sim-{unit}", "host": "127.0.0.1", "port": port, "unit": unit, "poll_interval": poll_interval,
+         "points": MODBUS_POINTS}
+        for unit in range(1, devices + 1)
+    ]}
+    with open(path, "w") as f:
+        json.dump(register_map, f)
+    return path
+
+
+class _ModbusUnits(asyncio.Protocol):
+    """Modbus TCP server answering read holding registers (function 3) for units 1..N.
+
+    Registers are computed when read: 0-3 hold the current time in ms (uint64),
+    4 and 5 a temperature and humidity scaled by 10.
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.buffer = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 12:
+            transaction, _, length, unit = struct.unpack(">HHHB", self.buffer[:7])
+            frame, self.buffer = self.buffer[:6 + length], self.buffer[6 + length:]
+            function, start, count = struct.unpack(">BHH", frame[7:12])
+            if function != 3 or not 1 <= unit <= self.devices or start + count > 6:
+                error = 0x01 if function != 3 else 0x0B if unit > self.devices else 0x02
+                self.transport.write(struct.pack(">HHHBBB", transaction, 0, 3, unit, function | 0x80, error))
+                continue
+            now_ms = int(time.time() * 1000)
+            registers = [(now_ms >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+            registers += [random.randint(150, 300), random.randint(300, 700)]
+            values = registers[start:start + count]
+            self.transport.write(struct.pack(f">HHHBBB{count}H", transaction, 0, 3 + 2 * count, unit, 3, 2 * count, *values))
+
+
+async def modbus_simulator(port, devices, duration):
+    """Serve `devices` Modbus units on `port` for `duration` seconds."""
+    server = await asyncio.get_running_loop().create_server(lambda: _ModbusUnits(devices), "127.0.0.1", port)
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        server.close()
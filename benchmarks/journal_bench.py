@@ -0,0 +1,53 @@
+"""
+Append and replay throughput of the store-and-forward journal.
+
+Usage: PYTHONPATH=. python benchmarks/journal_bench.py [--records N] [--batch N]
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from iot_bridge.journal import Journal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=500, help="Records per replay batch")
+    parser.add_argument("--segment-bytes", type=int, default=16 * 1024 * 1024)
+    args = parser.parse_args()
+
+    record = json.dumps({"temperature": 23.4, "humidity": 51.2, "source": "mqtt", "topic": "sensor/dht11/dev-0042",
+                         "device_id": "dev-0042"}, separators=(",", ":")).encode("utf-8")
+    directory = tempfile.mkdtemp(prefix="journal-bench-")
+    try:
+        journal = Journal(directory, segment_bytes=args.segment_bytes, max_bytes=64 * args.segment_bytes)
+
+        started = time.perf_counter()
+        for _ in range(args.records):
+            journal.append(record)
+        append_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        replayed = 0
+        while True:
+            records, position = journal.read_batch(args.batch)
+            if not records:
+                break
+            journal.commit(position)
+            replayed += len(records)
+        replay_s = time.perf_counter() - started
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+
+    mb = args.records * len(record) / 1e6
+    print(f"record size:  {len(record)} bytes")
+    print(f"append:       {args.records / append_s:,.0f} records/s ({mb / append_s:.1f} MB/s)")
+    print(f"replay:       {replayed / replay_s:,.0f} records/s ({mb / replay_s:.1f} MB/s, batch={args.batch}, incl. checkpoint fsync)")
+
+
+if __name__ == "__main__":
+    main()
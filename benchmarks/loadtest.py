@@ -0,0 +1,335 @@
+"""
+End-to-end load test of one bridge, entirely on localhost.
+
+Starts the stub gateway (benchmarks/stub_gateway.py), the bridge script under
+test and a simulated device fleet (benchmarks/fleets.py) sending at a fixed
+rate. After a warm-up it measures, over the test window:
+
+- sustained readings/s arriving at the gateway, against the offered rate
+- p50/p99/p999 end-to-end latency, from the device stamping a reading to the
+  gateway receiving it
+- CPU (percent of one core) and RSS of the bridge, summed over its worker
+  processes, read from /proc
+
+Each run is appended to a JSON results file with the git revision and host, so
+runs of different versions can be compared (``--baseline``). The MQTT fleet
+needs a broker: a local ``mosquitto`` is started when it is installed,
+otherwise pass ``--mqtt-broker host:port``.
+
+Usage: PYTHONPATH=. python benchmarks/loadtest.py --bridge websocket [--rate 2000] [--devices 50]
+       [--duration 30] [--payload dht11|wide] [--processes N] [--env NAME=VALUE ...]
+       [--output loadtest-results.json] [--baseline old-results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+import fleets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(ROOT, "benchmarks")
+
+BRIDGES = {
+    "mqtt": "mqtt-http/app.py",
+    "websocket": "websocket-http/websocket_server.py",
+    "coap": "coap-http/coap-server.py",
+    "modbus": "modbus-http/modbus_client.py",
+}
+GATEWAY_PORT, WS_PORT, COAP_PORT, MQTT_PORT, MODBUS_PORT = 18090, 18765, 15683, 18830, 15020
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def process_tree(pid):
+    """`pid` and all its descendants (the supervisor's worker processes)."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parents.setdefault(int(f.read().rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+            except OSError:
+                continue # Exited meanwhile
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(parents.get(current, ()))
+    return tree
+
+
+def cpu_and_rss(pids):
+    """(CPU seconds used, resident bytes) summed over `pids`."""
+    cpu = rss = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS # utime + stime
+            with open(f"/proc/{pid}/status") as f:
+                rss += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            continue
+    return cpu, rss
+
+
+class ResourceSampler:
+    """Samples the bridge's process tree while the test window is open."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss = []
+        self.cpu_start = self.cpu_end = 0.0
+        self.started = self.ended = 0.0
+        self._task = None
+
+    def start(self):
+        self.cpu_start, _ = cpu_and_rss(process_tree(self.pid))
+        self.started = time.perf_counter()
+        self._task = asyncio.create_task(self._sample())
+
+    async def _sample(self):
+        while True:
+            _, rss = cpu_and_rss(process_tree(self.pid))
+            self.rss.append(rss)
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        self._task.cancel()
+        self.cpu_end, _ = cpu_and_rss(process_tree(self.pid))
+        self.ended = time.perf_counter()
+
+    def results(self):
+        seconds = max(self.ended - self.started, 1e-9)
+        return {
+            "cpu_percent": round((self.cpu_end - self.cpu_start) / seconds * 100, 1),
+            "rss_mb_mean": round(sum(self.rss) / len(self.rss) / 2 ** 20, 1) if self.rss else None,
+            "rss_mb_peak": round(max(self.rss) / 2 ** 20, 1) if self.rss else None,
+        }
+
+
+async def wait_for_port(port, timeout=15.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"Nothing listening on port {port} after {timeout:.0f}s")
+            await asyncio.sleep(0.2)
+
+
+def start_process(args, log_path, env=None):
+    log_file = open(log_path, "w")
+    return subprocess.Popen(args, stdout=log_file, stderr=subprocess.STDOUT, env=env, cwd=ROOT)
+
+
+def stop_process(process, timeout=15):
+    if process is None or process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bridge_env(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "HTTP_ENDPOINT": f"http://127.0.0.1:{GATEWAY_PORT}/data",
+        "GATEWAY_API_KEY": "loadtest",
+        "METRICS_PORT": "0",
+        "BRIDGE_PROCESSES": str(args.processes),
+    })
+    if args.bridge == "mqtt":
+        env.update({"MQTT_SERVER": f"mqtt://{args.mqtt_host}:{args.mqtt_port}", "MQTT_TOPICS": "bench/#"})
+    elif args.bridge == "websocket":
+        env.update({"WS_PORT": str(WS_PORT), "WS_BIND": "127.0.0.1"})
+    elif args.bridge == "coap":
+        env.update({"COAP_PORT": str(COAP_PORT), "COAP_BIND": "127.0.0.1"})
+    elif args.bridge == "modbus":
+        path = os.path.join(workdir, "register_map.json")
+        fleets.modbus_register_map(path, MODBUS_PORT, args.devices, poll_interval=args.devices / args.rate)
+        env["MODBUS_REGISTER_MAP"] = path
+    for assignment in args.env:
+        name, _, value = assignment.partition("=")
+        env[name] = value
+    return env
+
+
+def fleet(args, seconds):
+    """The coroutine driving the device fleet for `seconds`."""
+    if args.bridge == "mqtt":
+        return fleets.mqtt_fleet(args.mqtt_host, args.mqtt_port, args.devices, args.rate, seconds, args.payload)
+    if args.bridge == "websocket":
+        return fleets.websocket_fleet(f"ws://127.0.0.1:{WS_PORT}", args.devices, args.rate, seconds, args.payload)
+    if args.bridge == "coap":
+        return fleets.coap_fleet("127.0.0.1", COAP_PORT, args.devices, args.rate, seconds, args.payload)
+    return asyncio.sleep(seconds) # Modbus devices are polled; the simulator is already serving
+
+
+async def gateway_request(method, path):
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, f"http://127.0.0.1:{GATEWAY_PORT}{path}") as response:
+            return await response.json()
+
+
+async def run(args, workdir):
+    processes = {}
+    simulator = None
+    try:
+        processes["gateway"] = start_process([sys.executable, os.path.join(BENCHMARKS, "stub_gateway.py"), "--port", str(GATEWAY_PORT)],
+                                             os.path.join(workdir, "gateway.log"), env=dict(os.environ, PYTHONPATH=ROOT))
+        await wait_for_port(GATEWAY_PORT)
+        if args.bridge == "mqtt" and args.mqtt_broker is None:
+            processes["broker"] = start_process(["mosquitto", "-p", str(MQTT_PORT)], os.path.join(workdir, "broker.log"))
+            await wait_for_port(MQTT_PORT)
+        if args.bridge == "modbus":
+            simulator = asyncio.create_task(fleets.modbus_simulator(MODBUS_PORT, args.devices, args.warmup + args.duration + 30))
+            await wait_for_port(MODBUS_PORT)
+
+        processes["bridge"] = start_process([sys.executable, os.path.join(ROOT, BRIDGES[args.bridge])],
+                                            os.path.join(workdir, "bridge.log"), env=bridge_env(args, workdir))
+        if args.bridge == "websocket":
+            await wait_for_port(WS_PORT)
+        await asyncio.sleep(args.startup)
+        if processes["bridge"].poll() is not None:
+            raise RuntimeError("the bridge exited on startup")
+
+        sampler = ResourceSampler(processes["bridge"].pid)
+        driving = asyncio.create_task(fleet(args, args.warmup + args.duration))
+        await asyncio.sleep(args.warmup)
+        await gateway_request("POST", "/reset")
+        sampler.start()
+        await asyncio.sleep(args.duration)
+        window = await gateway_request("GET", "/stats")
+        sampler.stop()
+        sent = await driving
+        await asyncio.sleep(args.drain)
+        drained = await gateway_request("GET", "/stats")
+    finally:
+        stop_process(processes.get("bridge"))
+        if simulator is not None:
+            simulator.cancel()
+        stop_process(processes.get("broker"))
+        stop_process(processes.get("gateway"))
+
+    offered = args.rate
+    return {
+        "offered_per_second": offered,
+        "readings_per_second": window["readings_per_second"],
+        "readings_in_window": window["readings"],
+        "gateway_requests_in_window": window["requests"],
+        "latency_ms": window["latency_ms"],
+        "readings_after_drain": drained["readings"],
+        "sent_total": sent, # Warm-up included; None for Modbus, whose devices are polled
+        **sampler.results(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(run, baseline_path):
+    """Print the change against the latest matching run of a baseline results file."""
+    with open(baseline_path) as f:
+        runs = json.load(f)["runs"]
+    matching = [old for old in runs if old["config"] == run["config"]]
+    if not matching:
+        print(f"No run with the same configuration in {baseline_path}")
+        return
+    old, new = matching[-1]["results"], run["results"]
+    print(f"Against {matching[-1]['version']} ({matching[-1]['timestamp']}):")
+    for label, before, after in (
+        ("readings/s", old["readings_per_second"], new["readings_per_second"]),
+        ("p50 ms", old["latency_ms"].get("p50"), new["latency_ms"].get("p50")),
+        ("p99 ms", old["latency_ms"].get("p99"), new["latency_ms"].get("p99")),
+        ("p999 ms", old["latency_ms"].get("p999"), new["latency_ms"].get("p999")),
+        ("CPU %", old["cpu_percent"], new["cpu_percent"]),
+        ("RSS MB peak", old["rss_mb_peak"], new["rss_mb_peak"]),
+    ):
+        if before and after is not None:
+            print(f"  {label:<12} {before:>10} -> {after:<10} ({(after - before) / before:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bridge", choices=sorted(BRIDGES), required=True)
+    parser.add_argument("--rate", type=float, default=1000, help="Readings per second offered by the whole fleet")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--payload", choices=sorted(fleets.PAYLOADS), default="dht11")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds measured")
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--drain", type=float, default=3, help="Seconds to wait for in-flight readings after the fleet stops")
+    parser.add_argument("--startup", type=float, default=2, help="Seconds to let the bridge start")
+    parser.add_argument("--processes", type=int, default=1, help="BRIDGE_PROCESSES for the bridge")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra bridge environment")
+    parser.add_argument("--mqtt-broker", metavar="HOST:PORT", help="Existing broker instead of a local mosquitto")
+    parser.add_argument("--output", default="loadtest-results.json", help="JSON file the run is appended to")
+    parser.add_argument("--baseline", help="Results file to compare this run against")
+    args = parser.parse_args()
+
+    if args.bridge == "mqtt":
+        if args.mqtt_broker:
+            args.mqtt_host, _, port = args.mqtt_broker.partition(":")
+            args.mqtt_port = int(port or 1883)
+        elif shutil.which("mosquitto"):
+            args.mqtt_host, args.mqtt_port = "127.0.0.1", MQTT_PORT
+        else:
+            parser.error("the MQTT fleet needs mosquitto installed or --mqtt-broker")
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        try:
+            results = asyncio.run(run(args, workdir))
+        except RuntimeError as e:
+            for name in ("gateway", "broker", "bridge"):
+                path = os.path.join(workdir, f"{name}.log")
+                if os.path.exists(path): # The work directory goes away, so show the tail of each log
+                    with open(path) as f:
+                        sys.stderr.write(f"--- {name}.log\n{f.read()[-4000:]}\n")
+            sys.exit(f"Load test failed: {e}")
+
+    run_record = {
+        "version": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {"bridge": args.bridge, "rate": args.rate, "devices": args.devices, "payload": args.payload,
+                   "duration": args.duration, "processes": args.processes, "env": sorted(args.env)},
+        "results": results,
+    }
+    print(json.dumps(run_record["results"], indent=2))
+
+    existing = {"runs": []}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            existing = json.load(f)
+    existing["runs"].append(run_record)
+    with open(args.output, "w") as f:
+        json.dump(existing, f, indent=2)
+    print(f"Appended to {args.output}")
+    if args.baseline:
+        compare(run_record, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
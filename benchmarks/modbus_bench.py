@@ -0,0 +1,175 @@
+"""
+Modbus bus throughput: the poller against local simulators over each transport.
+
+Every scenario polls --units units (one read of the fleets.py registers per
+poll) every --interval seconds through one bus, and reports readings/s
+against the offered rate, skipped deadlines, the bus utilization (requests
+outstanding over time, divided by the pipeline depth) and the mean request
+turnaround:
+
+- tcp: pymodbus's TCP server
+- tcp, pipeline 1 / N: the fleets.py simulator, which answers every request it
+  has read (pymodbus's server answers only the last of several outstanding
+  requests, so it cannot be pipelined)
+- rtu_over_tcp: pymodbus's TCP server with RTU framing
+- rtu: pymodbus's serial server on one end of a pty pair, relayed to the
+  other end at --baudrate, like a serial line
+
+TCP traffic goes through a proxy adding --latency-ms of round trip, standing
+in for the network and a gateway's forwarding time.
+
+Usage: PYTHONPATH=. python benchmarks/modbus_bench.py [--units 20] [--interval 0.1] [--duration 10]
+       [--latency-ms 5] [--pipeline 8] [--baudrate 19200]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+import tty
+
+from pymodbus import FramerType
+from pymodbus.server import ModbusSerialServer, ModbusTcpServer
+from pymodbus.simulator import DataType, SimData, SimDevice
+
+import fleets
+from iot_bridge.modbus import Bus, Device, ModbusPoller, Point
+from iot_bridge.modbus.poller import BUS_TURNAROUND, POLL_MISSED
+
+SERVER_PORT = 15502
+PROXY_PORT = 15503
+BITS_PER_CHAR = 10 # Start bit, 8 data bits, stop bit (8N1)
+
+
+def sim_devices(units):
+    """pymodbus simulator units 1..N holding the fleets.py registers."""
+    return [SimDevice(unit, [SimData(0, count=6, values=[0, 0, 0, unit, 215, 480], datatype=DataType.UINT16)])
+            for unit in range(1, units + 1)]
+
+
+async def latency_proxy(listen_port, target_port, latency):
+    """Forward TCP connections to `target_port`, delaying every chunk by half of `latency` each way."""
+    loop = asyncio.get_running_loop()
+
+    async def pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                loop.call_later(latency / 2, writer.write, data)
+        finally:
+            loop.call_later(latency / 2, writer.close)
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(pipe(client_reader, server_writer), pipe(server_reader, client_writer), return_exceptions=True)
+
+    return await asyncio.start_server(handle, "127.0.0.1", listen_port)
+
+
+def serial_pair(baudrate):
+    """Two pty paths joined like the ends of a serial line: bytes take their transmission time at `baudrate`."""
+    ends = [os.openpty() for _ in range(2)]
+    for _, follower in ends:
+        tty.setraw(follower)
+
+    def relay(source, destination):
+        while True:
+            try:
+                data = os.read(source, 4096)
+            except OSError:
+                return
+            time.sleep(len(data) * BITS_PER_CHAR / baudrate)
+            os.write(destination, data)
+
+    (a, a_path), (b, b_path) = ((leader, os.ttyname(follower)) for leader, follower in ends)
+    for source, destination in ((a, b), (b, a)):
+        threading.Thread(target=relay, args=(source, destination), daemon=True).start()
+    return a_path, b_path
+
+
+async def measure(name, bus, units, interval, duration):
+    """Poll `units` units on `bus` and print what the bus carried."""
+    points = [Point(**point) for point in fleets.MODBUS_POINTS]
+    devices = [Device(f"{name}-{unit}", bus=bus, unit=unit, points=points, poll_interval=interval)
+               for unit in range(1, units + 1)]
+    readings = 0
+
+    def on_reading(device, values):
+        nonlocal readings
+        readings += 1
+
+    poller = ModbusPoller(devices, on_reading, timeout=2.0)
+    task = asyncio.create_task(poller.run())
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(1.0) # Connect and settle
+    readings, missed = 0, POLL_MISSED.total()
+    turnaround = BUS_TURNAROUND.value(bus=bus.name)
+    snapshot = poller.bus_snapshot(loop.time())
+    await asyncio.sleep(duration)
+    elapsed = loop.time() - snapshot[0]
+    utilization, requests = poller.bus_stats(snapshot, loop.time())[bus.name]
+    after = BUS_TURNAROUND.value(bus=bus.name)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    mean_ms = (after["sum"] - turnaround["sum"]) / max(after["count"] - turnaround["count"], 1) * 1000
+    print(f"{name:<26} {units / interval:8.0f} {readings / elapsed:10.1f} {POLL_MISSED.total() - missed:8d} "
+          f"{utilization * 100:6.0f}% {mean_ms:11.2f}")
+
+
+async def main(args):
+    print(f"{args.units} units every {args.interval}s; TCP round trip +{args.latency_ms} ms; serial {args.baudrate} baud\n")
+    print(f"{'bus':<26} {'offered/s':>8} {'readings/s':>10} {'missed':>8} {'busy':>7} {'turnaround ms':>11}")
+    latency = args.latency_ms / 1000.0
+    proxy = await latency_proxy(PROXY_PORT, SERVER_PORT, latency)
+
+    server = ModbusTcpServer(sim_devices(args.units), address=("127.0.0.1", SERVER_PORT))
+    serving = asyncio.create_task(server.serve_forever())
+    await asyncio.sleep(0.2)
+    await measure("tcp (pymodbus)", Bus("tcp-pymodbus", host="127.0.0.1", port=PROXY_PORT),
+                  args.units, args.interval, args.duration)
+    await server.shutdown()
+    serving.cancel()
+
+    simulator = asyncio.create_task(fleets.modbus_simulator(SERVER_PORT, args.units, 3 * args.duration + 10))
+    await asyncio.sleep(0.2)
+    await measure("tcp, pipeline 1", Bus("tcp", host="127.0.0.1", port=PROXY_PORT),
+                  args.units, args.interval, args.duration)
+    await measure(f"tcp, pipeline {args.pipeline}", Bus("tcp-pipelined", host="127.0.0.1", port=PROXY_PORT, pipeline=args.pipeline),
+                  args.units, args.interval, args.duration)
+    simulator.cancel()
+    await asyncio.gather(simulator, return_exceptions=True)
+
+    server = ModbusTcpServer(sim_devices(args.units), framer=FramerType.RTU, address=("127.0.0.1", SERVER_PORT))
+    serving = asyncio.create_task(server.serve_forever())
+    await asyncio.sleep(0.2)
+    await measure("rtu_over_tcp (pymodbus)", Bus("rtu-over-tcp", transport="rtu_over_tcp", host="127.0.0.1", port=PROXY_PORT),
+                  args.units, args.interval, args.duration)
+    await server.shutdown()
+    serving.cancel()
+    proxy.close()
+
+    device_end, bridge_end = serial_pair(args.baudrate)
+    server = ModbusSerialServer(sim_devices(args.units), framer=FramerType.RTU, port=device_end, baudrate=args.baudrate)
+    serving = asyncio.create_task(server.serve_forever())
+    await asyncio.sleep(0.5)
+    await measure(f"rtu (pty, {args.baudrate} baud)", Bus("rtu-pty", transport="rtu", serial_port=bridge_end, baudrate=args.baudrate),
+                  args.units, args.interval, args.duration)
+    await server.shutdown()
+    serving.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--units", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.1, help="poll interval per unit, seconds")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured per bus")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="round trip added to TCP buses")
+    parser.add_argument("--pipeline", type=int, default=8, help="outstanding requests on the pipelined bus")
+    parser.add_argument("--baudrate", type=int, default=19200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    asyncio.run(main(args))
@@ -0,0 +1,198 @@
+"""
+Stub gateway for load tests: accepts readings on /data, /data/batch and
+/data/stream like the Go gateway and measures end-to-end latency.
+
+Simulated devices stamp each reading with ``sent_at`` (epoch seconds) or
+``sent_at_ms``; the time from that stamp to the POST arriving here is the
+reading's end-to-end latency through the bridge. GET /stats returns counts per
+source and latency percentiles as JSON, POST /reset clears them (after a
+warm-up).
+
+Bodies may be compressed (gzip, or deflate with the preset dictionary given by
+--dict) and batches may come in the binary envelope (HTTP_ENVELOPE=msgpack),
+as the bridges send them with HTTP_COMPRESSION / HTTP_ENVELOPE set.
+
+Usage: PYTHONPATH=. python benchmarks/stub_gateway.py [--port 8090] [--dict FILE]
+"""
+import argparse
+import asyncio
+import time
+import zlib
+
+from aiohttp import web
+
+from iot_bridge import codec, wire
+
+WBITS = {"gzip": 31, "deflate": 15}
+
+
+def percentiles(samples):
+    """p50/p99/p999/max in milliseconds of latency samples in seconds."""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def at(share):
+        return round(samples[min(len(samples) - 1, int(len(samples) * share))] * 1000, 3)
+    return {"p50": at(0.5), "p99": at(0.99), "p999": at(0.999), "max": round(samples[-1] * 1000, 3)}
+
+
+def decompressor(encoding, dictionary):
+    """A zlib decompressor for a Content-Encoding, or None for an uncompressed body."""
+    if encoding not in WBITS:
+        return None
+    if encoding == "deflate" and dictionary:
+        return zlib.decompressobj(WBITS[encoding], zdict=dictionary)
+    return zlib.decompressobj(WBITS[encoding])
+
+
+def decode_envelope(body):
+    """Readings (dicts) from a binary envelope."""
+    def ext_hook(code, data):
+        return Ref(int.from_bytes(data, "big"))
+    envelope = wire.msgspec.msgpack.decode(body, ext_hook=ext_hook)
+    keys, strings = envelope.get("k", []), envelope.get("s", [])
+    return [{keys[k]: strings[v] if isinstance(v, Ref) else v for k, v in row.items()} for row in envelope.get("r", [])]
+
+
+class Ref(int):
+    """An interned string reference in an envelope."""
+
+
+class Sink:
+    def __init__(self, dictionary=None):
+        self.dictionary = dictionary # Preset deflate dictionary shared with the bridges
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.requests = 0
+        self.traced = 0 # Readings named in X-Trace-Id headers
+        self.readings = {} # source -> count
+        self.latencies = []
+
+    def record(self, source, reading, now):
+        self.readings[source] = self.readings.get(source, 0) + 1
+        sent_at = reading.get("sent_at")
+        if sent_at is None and "sent_at_ms" in reading:
+            sent_at = reading["sent_at_ms"] / 1000.0
+        if isinstance(sent_at, (int, float)):
+            self.latencies.append(now - sent_at)
+
+    async def data(self, request):
+        body = await request.read()
+        now = time.time()
+        self.requests += 1
+        source = request.headers.get("X-Source-Identifier", "unknown")
+        if "X-Trace-Id" in request.headers:
+            self.traced += request.headers["X-Trace-Id"].count(",") + 1
+        try:
+            inflate = decompressor(request.headers.get("Content-Encoding"), self.dictionary)
+            if inflate is not None:
+                body = inflate.decompress(body)
+            if request.headers.get("Content-Type") == wire.ENVELOPE_CONTENT_TYPE:
+                payload = decode_envelope(body)
+            else:
+                payload = codec.loads(body)
+        except (codec.DecodeError, zlib.error, ValueError) as e:
+            return web.Response(status=400, text=f"invalid body: {e}")
+        for reading in payload if isinstance(payload, list) else [payload]:
+            if isinstance(reading, dict):
+                self.record(source, reading, now)
+        return web.json_response({"status": "ok"})
+
+    async def stream(self, request):
+        """NDJSON stream: readings are recorded as their lines arrive, with progress acks like the gateway's."""
+        self.requests += 1
+        source = request.headers.get("X-Source-Identifier", "unknown")
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        progress = {"acked": 0, "rejected": 0}
+        await response.write(codec.dumps(progress) + b"\n") # Accepted
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(1)
+                await response.write(codec.dumps(progress) + b"\n")
+
+        async def lines():
+            inflate = decompressor(request.headers.get("Content-Encoding"), self.dictionary)
+            if inflate is None:
+                async for line in request.content:
+                    yield line
+                return
+            rest = b""
+            async for data in request.content.iter_any():
+                *complete, rest = (rest + inflate.decompress(data)).split(b"\n")
+                for line in complete:
+                    yield line
+            yield rest
+
+        task = asyncio.create_task(heartbeat())
+        try:
+            async for line in lines():
+                if not line.strip():
+                    continue
+                try:
+                    reading = codec.loads(line)
+                    if isinstance(reading, dict):
+                        self.record(source, reading, time.time())
+                except codec.DecodeError:
+                    progress["rejected"] += 1
+                progress["acked"] += 1
+                if progress["acked"] % 1000 == 0:
+                    await response.write(codec.dumps(progress) + b"\n")
+        finally:
+            task.cancel()
+        progress["status"] = "received"
+        await response.write(codec.dumps(progress) + b"\n")
+        await response.write_eof()
+        return response
+
+    async def stats(self, request):
+        elapsed = time.time() - self.started
+        received = sum(self.readings.values())
+        return web.json_response({
+            "seconds": round(elapsed, 3),
+            "requests": self.requests,
+            "readings": received,
+            "traced": self.traced,
+            "readings_per_source": self.readings,
+            "readings_per_second": round(received / elapsed, 1) if elapsed > 0 else 0,
+            "latency_ms": percentiles(self.latencies),
+        })
+
+    async def clear(self, request):
+        self.reset()
+        return web.json_response({"status": "reset"})
+
+
+def make_app(dictionary=None):
+    sink = Sink(dictionary)
+    # Bodies are decoded here, as aiohttp's own decompression knows no preset dictionaries
+    app = web.Application(client_max_size=64 * 1024 * 1024, handler_args={"auto_decompress": False})
+    app.add_routes([
+        web.post("/data", sink.data),
+        web.post("/data/batch", sink.data),
+        web.post("/data/stream", sink.stream),
+        web.get("/stats", sink.stats),
+        web.post("/reset", sink.clear),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--dict", help="preset deflate dictionary (the bridges' HTTP_COMPRESSION_DICT)")
+    args = parser.parse_args()
+    dictionary = None
+    if args.dict:
+        with open(args.dict, "rb") as f:
+            dictionary = f.read()
+    web.run_app(make_app(dictionary), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
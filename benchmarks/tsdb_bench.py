@@ -0,0 +1,110 @@
+"""
+Ingest rate, bytes per point and range-scan latency of the local time-series store.
+
+Writes DHT11-style readings (temperature and humidity with 0.1 resolution,
+one per device every 5 seconds with a little jitter) into a fresh store, then
+the same points with full-precision random-walk floats, raw and compressed.
+Range scans run on a store of a few long series (--scan-devices x
+--scan-readings): one series whole and its last hour, one series downsampled,
+and every series downsampled.
+
+Usage: PYTHONPATH=. python benchmarks/tsdb_bench.py [--devices N] [--readings N] [--scan-readings N]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from iot_bridge.tsdb import TimeSeriesStore, chunks
+from iot_bridge.tsdb.query import run_query
+
+START = 1_750_000_000.0
+INTERVAL = 5.0
+
+
+def readings(devices, per_device, decimals):
+    """Readings in arrival order: a round of every device, every INTERVAL seconds."""
+    rng = random.Random(1)
+    temperature = [rng.uniform(15, 30) for _ in range(devices)]
+    humidity = [rng.uniform(30, 70) for _ in range(devices)]
+    for n in range(per_device):
+        for i in range(devices):
+            temperature[i] += rng.gauss(0, 0.05)
+            humidity[i] += rng.gauss(0, 0.1)
+            yield {
+                "device_id": f"dev-{i:05d}",
+                "source": "mqtt",
+                "temperature": round(temperature[i], 1) if decimals else temperature[i],
+                "humidity": round(humidity[i], 1) if decimals else humidity[i],
+                "timestamp": START + n * INTERVAL + rng.uniform(0, 0.05),
+            }
+
+
+def timed(function, repeat=20):
+    """Median seconds per call."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return sorted(samples)[len(samples) // 2]
+
+
+def run(name, devices, per_device, decimals, compress):
+    directory = tempfile.mkdtemp(prefix="tsdb-bench-")
+    try:
+        store = TimeSeriesStore(directory, retention=0, flush_interval=0, compress=compress, max_series=10 * devices)
+        batch = list(readings(devices, per_device, decimals))
+        started = time.perf_counter()
+        for reading in batch:
+            store.append_reading(reading)
+        store.flush()
+        elapsed = time.perf_counter() - started
+        points = 2 * len(batch)
+        print(f"{name:<32} {points / elapsed:>10,.0f} points/s  {store.bytes_used() / points:>6.2f} bytes/point  "
+              f"({points:,} points in {devices * 2:,} series)")
+        return store, directory
+    except BaseException:
+        shutil.rmtree(directory)
+        raise
+
+
+def scans(store, devices, per_device):
+    end = START + per_device * INTERVAL
+    end_ms = int(end * 1000)
+    full = timed(lambda: store.read("dev-00000", "temperature", 0, end_ms))
+    hour = timed(lambda: store.read("dev-00000", "temperature", end_ms - 3600 * 1000, end_ms))
+    downsampled = timed(lambda: run_query(store, {"device": "dev-00000", "metric": "temperature", "start": "0",
+                                                  "end": str(end), "step": "3600"}, 10 ** 8))
+    fleet = timed(lambda: run_query(store, {"start": "0", "end": str(end), "step": "3600", "agg": "max"}, 10 ** 8), repeat=5)
+    print(f"  read one series, {per_device:,} points:{'':<14}{full * 1e3:8.2f} ms")
+    print(f"  read one series, last hour ({int(3600 / INTERVAL)} points):{'':<8}{hour * 1e3:8.2f} ms")
+    print(f"  one series downsampled to 1h:{'':<17}{downsampled * 1e3:8.2f} ms")
+    print(f"  {devices * 2} series ({devices * 2 * per_device:,} points) downsampled to 1h: {fleet * 1e3:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--readings", type=int, default=1000, help="Readings per device")
+    parser.add_argument("--scan-devices", type=int, default=10)
+    parser.add_argument("--scan-readings", type=int, default=100000, help="Readings per device of the range-scan store")
+    args = parser.parse_args()
+    print(f"Codecs vectorized with NumPy: {chunks.np is not None}")
+    for name, decimals, compress in (("0.1-resolution, compressed", True, True),
+                                     ("full-precision, compressed", False, True),
+                                     ("0.1-resolution, raw", True, False)):
+        store, directory = run(name, args.devices, args.readings, decimals, compress)
+        store.close()
+        shutil.rmtree(directory)
+    store, directory = run("long series, compressed", args.scan_devices, args.scan_readings, True, True)
+    try:
+        scans(store, args.scan_devices, args.scan_readings)
+    finally:
+        store.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
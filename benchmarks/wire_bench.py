@@ -0,0 +1,127 @@
+"""
+Bytes on the wire and encoding cost per reading for each body format.
+
+Readings look like what the bridges forward (fleets.py payloads plus the
+source, topic and device fields a bridge adds). Each format is measured for
+one reading per request (single), BATCH_MAX_ITEMS-sized batches (batch) and an
+NDJSON stream with one compressor across chunks (stream). "with headers" adds
+the request line and headers of each request (the chunk framing for streams),
+which dominate small single-reading requests.
+
+A preset dictionary is trained from readings other than the measured ones;
+--write-dict saves it for HTTP_COMPRESSION_DICT and the gateway's
+ingest.deflate_dictionary. --samples trains and measures on captured readings
+instead (a file with one JSON reading per line).
+
+Usage: PYTHONPATH=. python benchmarks/wire_bench.py [--shape dht11|wide] [--count N]
+       [--samples FILE] [--write-dict FILE]
+"""
+import argparse
+import random
+import time
+import zlib
+
+from benchmarks.fleets import PAYLOADS, make_reading
+from iot_bridge import codec, wire
+
+BATCH_SIZE = 500
+STREAM_CHUNK = 60 # Readings per stream chunk: 20 ms at 3,000 readings/s
+HEADERS = (
+    "POST /data/batch HTTP/1.1\r\nHost: gateway.local:8080\r\nUser-Agent: python-requests/2.32.3\r\n"
+    "Accept-Encoding: gzip, deflate\r\nAccept: */*\r\nConnection: keep-alive\r\n"
+    "X-API-Key: 0123456789abcdef0123456789abcdef\r\nX-Source-Identifier: mqtt\r\n"
+    "Content-Type: application/json\r\nContent-Length: 1234\r\n\r\n"
+)
+FORMATS = [ # (name, compression, envelope, use dictionary)
+    ("json", "none", "json", False),
+    ("gzip", "gzip", "json", False),
+    ("deflate", "deflate", "json", False),
+    ("deflate+dict", "deflate", "json", True),
+    ("msgpack", "none", "msgpack", False),
+    ("msgpack+deflate", "deflate", "msgpack", False),
+    ("msgpack+deflate+dict", "deflate", "msgpack", True),
+]
+
+
+def simulated(shape, count, seed):
+    random.seed(seed)
+    readings = []
+    for seq in range(count):
+        device = f"dev-{seq % 50}"
+        reading = make_reading(shape, device, seq)
+        reading.update(source="mqtt", topic=f"bench/{shape}/{device}", device_id=device)
+        readings.append(codec.dumps(reading))
+    return readings
+
+
+def request_bodies(encoder, encoded, per_request):
+    for i in range(0, len(encoded), per_request):
+        yield encoder.encode(b"[" + b",".join(encoded[i:i + per_request]) + b"]" if per_request > 1 else encoded[i])
+
+
+def measure_requests(encoder, encoded, per_request):
+    """(body bytes, header bytes, seconds of CPU) to send `encoded` in requests of `per_request` readings."""
+    body_bytes = header_bytes = 0
+    started = time.process_time()
+    for body, headers in request_bodies(encoder, encoded, per_request):
+        body_bytes += len(body)
+        header_bytes += len(HEADERS) + sum(len(name) + len(value) + 4 for name, value in headers.items())
+    return body_bytes, header_bytes, time.process_time() - started
+
+
+def measure_stream(encoder, encoded):
+    """The same for one stream: NDJSON chunks through one compressor, sync-flushed after each."""
+    body_bytes = framing = 0
+    started = time.process_time()
+    compressor = encoder.compressor()
+    for i in range(0, len(encoded), STREAM_CHUNK):
+        chunk = b"\n".join(encoded[i:i + STREAM_CHUNK]) + b"\n"
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        body_bytes += len(chunk)
+        framing += len(b"%x\r\n\r\n" % len(chunk))
+    return body_bytes, framing + len(HEADERS), time.process_time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shape", choices=sorted(PAYLOADS), default="dht11")
+    parser.add_argument("--count", type=int, default=20000, help="readings measured")
+    parser.add_argument("--samples", help="file of captured readings, one JSON object per line")
+    parser.add_argument("--dict-size", type=int, default=16 * 1024)
+    parser.add_argument("--write-dict", help="save the trained dictionary to this file")
+    args = parser.parse_args()
+
+    if args.samples:
+        with open(args.samples, "rb") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        split = max(1, len(lines) // 5) # Train on the first fifth, measure on the rest
+        training, encoded = lines[:split], lines[split:]
+    else:
+        training = simulated(args.shape, 2000, seed=1)
+        encoded = simulated(args.shape, args.count, seed=2)
+    dictionary = wire.train_dictionary(training, args.dict_size)
+    if args.write_dict:
+        with open(args.write_dict, "wb") as f:
+            f.write(dictionary)
+        print(f"Wrote a {len(dictionary)}-byte dictionary to {args.write_dict}")
+
+    count = len(encoded)
+    print(f"{count} readings, {sum(map(len, encoded)) / count:.0f} bytes of JSON each; "
+          f"{len(dictionary)}-byte dictionary; bytes and CPU per reading\n")
+    print(f"{'mode':<8} {'format':<22} {'body':>8} {'with headers':>13} {'encode us':>10}")
+    for mode, per_request in (("single", 1), ("batch", BATCH_SIZE), ("stream", None)):
+        for name, compression, envelope, use_dict in FORMATS:
+            if envelope == "msgpack" and (mode == "stream" or wire.msgspec is None):
+                continue # Streams stay NDJSON
+            encoder = wire.BodyEncoder(compression, envelope, min_bytes=0, dictionary=dictionary if use_dict else None)
+            if per_request is None:
+                body, headers, seconds = measure_stream(encoder, encoded)
+            else:
+                body, headers, seconds = measure_requests(encoder, encoded, per_request)
+            print(f"{mode:<8} {name:<22} {body / count:8.1f} {(body + headers) / count:13.1f} {seconds / count * 1e6:10.2f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
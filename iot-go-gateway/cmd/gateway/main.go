@@ -42,7 +42,16 @@ func main() {
 	detector := anomaly.NewDetector(cfg)
 	alerter := alerting.NewAlerter(hub) // Pass hub to alerter
 
-	apiHandler := api.NewAPIHandler(store, detector, hub, alerter, *webDir, apiKey)
+	var deflateDict []byte
+	if cfg.Ingest.DeflateDictionary != "" {
+		deflateDict, err = os.ReadFile(cfg.Ingest.DeflateDictionary)
+		if err != nil {
+			log.Fatalf("Error reading deflate dictionary: %v", err)
+		}
+		log.Printf("Decoding deflate request bodies with a %d-byte preset dictionary", len(deflateDict))
+	}
+
+	apiHandler := api.NewAPIHandler(store, detector, hub, alerter, *webDir, apiKey, deflateDict, cfg.Ingest.MaxBodyBytes)
 
 	// --- Start WebSocket Hub ---
 	go hub.Run()
@@ -0,0 +1,72 @@
+package api
+
+import (
+	"bytes"
+	"compress/gzip"
+	"compress/zlib"
+	"errors"
+	"fmt"
+	"io"
+	"iot-go-gateway/internal/data"
+	"net/http"
+	"strings"
+)
+
+// defaultMaxBodyBytes bounds request bodies after decoding when ingest.max_body_bytes is unset,
+// so a small compressed body cannot expand without limit
+const defaultMaxBodyBytes = 64 << 20
+
+var errBodyTooLarge = errors.New("body too large")
+
+// supportedEncoding reports whether a request's Content-Encoding can be decoded
+func supportedEncoding(encoding string) bool {
+	switch encoding {
+	case "", "identity", "gzip", "deflate":
+		return true
+	}
+	return false
+}
+
+// isEnvelope reports whether a request body is in the bridges' binary envelope rather than JSON
+func isEnvelope(r *http.Request) bool {
+	return strings.HasPrefix(r.Header.Get("Content-Type"), data.EnvelopeContentType)
+}
+
+// decodingReader undoes a supported Content-Encoding on body. Deflate bodies (the zlib format)
+// may start from the preset dictionary shared with the bridges. Reads the compression header.
+func (h *APIHandler) decodingReader(encoding string, body io.Reader) (io.ReadCloser, error) {
+	switch encoding {
+	case "gzip":
+		return gzip.NewReader(body)
+	case "deflate":
+		return zlib.NewReaderDict(body, h.deflateDict)
+	}
+	return io.NopCloser(body), nil
+}
+
+// readBody reads and decodes a whole request body. On error it also returns the HTTP status to reply with.
+func (h *APIHandler) readBody(r *http.Request) ([]byte, int, error) {
+	encoding := strings.ToLower(r.Header.Get("Content-Encoding"))
+	if !supportedEncoding(encoding) {
+		return nil, http.StatusUnsupportedMediaType, fmt.Errorf("unsupported Content-Encoding %q", encoding)
+	}
+	limit := h.maxBodyBytes
+	if limit <= 0 {
+		limit = defaultMaxBodyBytes
+	}
+
+	reader, err := h.decodingReader(encoding, r.Body)
+	if err != nil {
+		return nil, http.StatusBadRequest, fmt.Errorf("invalid %s body: %w", encoding, err)
+	}
+	defer reader.Close()
+	var body bytes.Buffer
+	n, err := body.ReadFrom(io.LimitReader(reader, limit+1))
+	if err != nil {
+		return nil, http.StatusBadRequest, err
+	}
+	if n > limit {
+		return nil, http.StatusRequestEntityTooLarge, errBodyTooLarge
+	}
+	return body.Bytes(), http.StatusOK, nil
+}
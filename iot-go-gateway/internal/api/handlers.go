@@ -1,9 +1,11 @@
 package api
 
 import (
+	"bufio"
+	"bytes"
 	"encoding/json"
+	"errors"
 	"html/template"
-	"io"
 	"iot-go-gateway/internal/alerting"
 	"iot-go-gateway/internal/anomaly"
 	"iot-go-gateway/internal/data"
@@ -14,6 +16,9 @@ import (
 	"net/http"
 	"path/filepath"
 	"fmt"
+	"strconv"
+	"strings"
+	"sync"
 
 	gwebsocket "github.com/gorilla/websocket" // Alias to avoid name conflict
 )
@@ -32,9 +37,12 @@ type APIHandler struct {
 	tmpl     *template.Template
 	webDir   string
 	apiKey   string
+
+	deflateDict  []byte // Preset dictionary for deflate request bodies, shared with the bridges
+	maxBodyBytes int64  // Largest request body after decoding
 }
 
-func NewAPIHandler(store *storage.MemoryStore, detector *anomaly.Detector, hub *websocket.Hub, alerter *alerting.Alerter, webDir string, apiKey string) *APIHandler {
+func NewAPIHandler(store *storage.MemoryStore, detector *anomaly.Detector, hub *websocket.Hub, alerter *alerting.Alerter, webDir string, apiKey string, deflateDict []byte, maxBodyBytes int64) *APIHandler {
 	// Load templates
     tmplPath := filepath.Join(webDir, "templates", "*.html")
 	tmpl, err := template.ParseGlob(tmplPath)
@@ -50,6 +58,8 @@ func NewAPIHandler(store *storage.MemoryStore, detector *anomaly.Detector, hub *
 		tmpl:     tmpl,
 		webDir:   webDir,
 		apiKey:	  apiKey,
+		deflateDict:  deflateDict,
+		maxBodyBytes: maxBodyBytes,
 	}
 }
 
@@ -73,18 +83,230 @@ func (h *APIHandler) Authenticate(next http.HandlerFunc) http.HandlerFunc {
 
 // HandleDataIngest receives data from the Python translators
 func (h *APIHandler) HandleDataIngest(w http.ResponseWriter, r *http.Request) {
+	started := time.Now()
 	if r.Method != http.MethodPost {
 		http.Error(w, "Method Not Allowed", http.StatusMethodNotAllowed)
 		return
 	}
 
-	body, err := io.ReadAll(r.Body)
+	body, status, err := h.readBody(r)
 	if err != nil {
 		log.Printf("Error reading request body: %v", err)
-		http.Error(w, "Bad Request: Cannot read body", http.StatusBadRequest)
+		http.Error(w, fmt.Sprintf("Cannot read body: %v", err), status)
+		return
+	}
+	defer r.Body.Close()
+	source := sourceFromRequest(r)
+
+	if isEnvelope(r) {
+		points, err := data.ParseEnvelope(body, source)
+		if err != nil {
+			log.Printf("Error parsing envelope from source '%s': %v", source, err)
+			http.Error(w, fmt.Sprintf("Bad Request: Cannot parse envelope. Error: %v", err), http.StatusBadRequest)
+			return
+		}
+		for _, point := range points {
+			h.processPoint(point, source)
+		}
+		logTraces(r, source, points, started)
+	} else {
+		// Pass nil for config if parser doesn't use it, or pass h.detector.config if needed
+		parsedData, err := data.Parse(body, source, nil)
+		if err != nil {
+			log.Printf("Error parsing data from source '%s': %v", source, err)
+			// Provide more specific error message if possible
+			errMsg := fmt.Sprintf("Bad Request: Cannot parse payload. Error: %v", err)
+			http.Error(w, errMsg, http.StatusBadRequest)
+			return
+		}
+		h.processPoint(parsedData, source)
+		logTraces(r, source, []*data.UniversalDataPoint{parsedData}, started)
+	}
+
+	w.Header().Set("Content-Type", "application/json")
+	w.WriteHeader(http.StatusOK)
+	json.NewEncoder(w).Encode(map[string]string{"status": "received", "source": source})
+}
+
+// HandleBatchIngest receives a JSON array of readings from the Python translators in one request
+func (h *APIHandler) HandleBatchIngest(w http.ResponseWriter, r *http.Request) {
+	started := time.Now()
+	if r.Method != http.MethodPost {
+		http.Error(w, "Method Not Allowed", http.StatusMethodNotAllowed)
+		return
+	}
+
+	body, status, err := h.readBody(r)
+	if err != nil {
+		log.Printf("Error reading batch request body: %v", err)
+		http.Error(w, fmt.Sprintf("Cannot read body: %v", err), status)
 		return
 	}
 	defer r.Body.Close()
+	source := sourceFromRequest(r)
+
+	var points []*data.UniversalDataPoint
+	if isEnvelope(r) {
+		points, err = data.ParseEnvelope(body, source)
+	} else {
+		points, err = data.ParseBatch(body, source, nil)
+	}
+	if err != nil {
+		log.Printf("Error parsing batch from source '%s': %v", source, err)
+		errMsg := fmt.Sprintf("Bad Request: Cannot parse batch payload. Error: %v", err)
+		http.Error(w, errMsg, http.StatusBadRequest)
+		return
+	}
+
+	for _, point := range points {
+		h.processPoint(point, source)
+	}
+	logTraces(r, source, points, started)
+
+	w.Header().Set("Content-Type", "application/json")
+	w.WriteHeader(http.StatusOK)
+	json.NewEncoder(w).Encode(map[string]interface{}{"status": "received", "source": source, "count": len(points)})
+}
+
+const (
+	streamAckEvery     = 1000        // Lines consumed between progress acks on a busy stream
+	streamAckInterval  = time.Second // Progress is sent at least this often, doubling as a heartbeat
+	streamMaxLineBytes = 1 << 20     // Longest accepted line; a longer one ends the stream
+)
+
+// streamProgress is one line of the response to a stream. Acked counts the lines consumed so far
+// (stored or rejected), so the bridge knows which of its readings it no longer has to resend.
+type streamProgress struct {
+	Acked    int    `json:"acked"`
+	Rejected int    `json:"rejected"`
+	Status   string `json:"status,omitempty"` // "received" once the bridge ended the stream cleanly
+	Error    string `json:"error,omitempty"`  // Why the gateway ended the stream
+	Line     int    `json:"line,omitempty"`   // The line (1-based, in this stream) at fault, when one was
+}
+
+// HandleStreamIngest receives newline-delimited readings on one long-lived request (a chunked
+// HTTP/1.1 POST or an HTTP/2 stream) and writes progress acks back while it reads
+func (h *APIHandler) HandleStreamIngest(w http.ResponseWriter, r *http.Request) {
+	if r.Method != http.MethodPost {
+		http.Error(w, "Method Not Allowed", http.StatusMethodNotAllowed)
+		return
+	}
+	defer r.Body.Close()
+	source := sourceFromRequest(r)
+	if isEnvelope(r) {
+		http.Error(w, "Streams carry newline-delimited JSON, not the binary envelope", http.StatusUnsupportedMediaType)
+		return
+	}
+	encoding := strings.ToLower(r.Header.Get("Content-Encoding"))
+	if !supportedEncoding(encoding) {
+		http.Error(w, fmt.Sprintf("Unsupported Content-Encoding %q", encoding), http.StatusUnsupportedMediaType)
+		return
+	}
+
+	// HTTP/1.x handlers may only write while reading the body when asked to; HTTP/2 streams always can
+	rc := http.NewResponseController(w)
+	if err := rc.EnableFullDuplex(); err != nil && !errors.Is(err, http.ErrNotSupported) {
+		log.Printf("Stream from source '%s': cannot enable full duplex: %v", source, err)
+	}
+	w.Header().Set("Content-Type", "application/x-ndjson")
+	w.WriteHeader(http.StatusOK)
+
+	var mu sync.Mutex // Guards progress and writes to w
+	var progress streamProgress
+	lastSent := 0
+	encoder := json.NewEncoder(w)
+	send := func() error { // mu held
+		lastSent = progress.Acked
+		if err := encoder.Encode(progress); err != nil {
+			return err
+		}
+		return rc.Flush()
+	}
+	mu.Lock()
+	send() // Tells the bridge the stream was accepted
+	mu.Unlock()
+
+	done := make(chan struct{})
+	var heartbeat sync.WaitGroup
+	heartbeat.Add(1)
+	go func() {
+		defer heartbeat.Done()
+		ticker := time.NewTicker(streamAckInterval)
+		defer ticker.Stop()
+		for {
+			select {
+			case <-done:
+				return
+			case <-ticker.C:
+				mu.Lock()
+				err := send()
+				mu.Unlock()
+				if err != nil {
+					return // Bridge gone; the read below fails too
+				}
+			}
+		}
+	}()
+
+	started := time.Now()
+	log.Printf("Stream opened from source '%s' (%s)", source, r.Proto)
+	// A compressed stream is one compressed body, flushed at the end of every chunk. Its header is
+	// read here, after the first ack, as the bridge only starts writing once it has that ack.
+	body, err := h.decodingReader(encoding, r.Body)
+	if err != nil {
+		close(done)
+		heartbeat.Wait()
+		progress.Error = fmt.Sprintf("invalid %s body: %v", encoding, err)
+		log.Printf("Ending stream from source '%s': %s", source, progress.Error)
+		send()
+		return
+	}
+	defer body.Close()
+	scanner := bufio.NewScanner(body)
+	scanner.Buffer(make([]byte, 0, 64*1024), streamMaxLineBytes)
+	for scanner.Scan() {
+		line := bytes.TrimSpace(scanner.Bytes())
+		if len(line) == 0 {
+			continue
+		}
+		point, err := data.ParseLine(line, source)
+		if err == nil && point != nil {
+			h.processPoint(point, source)
+		}
+		mu.Lock()
+		progress.Acked++
+		if err != nil {
+			progress.Rejected++
+			if progress.Rejected == 1 { // Once per stream; the final count is logged below
+				log.Printf("Rejected line %d of stream from source '%s': %v", progress.Acked, source, err)
+			}
+		}
+		if progress.Acked-lastSent >= streamAckEvery {
+			send()
+		}
+		mu.Unlock()
+	}
+	close(done)
+	heartbeat.Wait()
+
+	if err := scanner.Err(); err != nil {
+		if !errors.Is(err, bufio.ErrTooLong) {
+			log.Printf("Stream from source '%s' broken after %d readings: %v", source, progress.Acked, err)
+			return
+		}
+		progress.Line = progress.Acked + 1
+		progress.Error = fmt.Sprintf("line %d exceeds %d bytes", progress.Line, streamMaxLineBytes)
+		log.Printf("Ending stream from source '%s': %s", source, progress.Error)
+	} else {
+		progress.Status = "received"
+	}
+	send()
+	log.Printf("Stream from source '%s' ended after %s: %d readings, %d rejected",
+		source, time.Since(started).Round(time.Millisecond), progress.Acked, progress.Rejected)
+}
+
+// sourceFromRequest determines the data source from the query string or X-Source-Identifier header
+func sourceFromRequest(r *http.Request) string {
 	source := r.URL.Query().Get("source")
 	if source == "" {
 		source = r.Header.Get("X-Source-Identifier") // Or check a header
@@ -92,19 +314,33 @@ func (h *APIHandler) HandleDataIngest(w http.ResponseWriter, r *http.Request) {
 	if source == "" {
 		source = "unknown" // Default if not specified
 	}
-	// --- End Determine Source ---
+	return source
+}
 
+// TraceHeader carries the IDs of readings a bridge is tracing, as "<id>@<index in the body>,..."
+const TraceHeader = "X-Trace-Id"
 
-	// Pass nil for config if parser doesn't use it, or pass h.detector.config if needed
-	parsedData, err := data.Parse(body, source, nil)
-	if err != nil {
-		log.Printf("Error parsing data from source '%s': %v", source, err)
-		// Provide more specific error message if possible
-		errMsg := fmt.Sprintf("Bad Request: Cannot parse payload. Error: %v", err)
-		http.Error(w, errMsg, http.StatusBadRequest)
+// logTraces logs the traced readings of a request once they are processed, so they can be matched
+// to the bridge's trace log
+func logTraces(r *http.Request, source string, points []*data.UniversalDataPoint, started time.Time) {
+	header := r.Header.Get(TraceHeader)
+	if header == "" {
 		return
 	}
+	elapsed := time.Since(started)
+	for _, entry := range strings.Split(header, ",") {
+		id, index, _ := strings.Cut(strings.TrimSpace(entry), "@")
+		device := ""
+		if i, err := strconv.Atoi(index); err == nil && i >= 0 && i < len(points) {
+			device = points[i].DeviceID
+		}
+		log.Printf("Trace %s: source '%s', device '%s', processed in %s (%d readings in request)",
+			id, source, device, elapsed, len(points))
+	}
+}
 
+// processPoint stores a parsed data point, checks it for anomalies and broadcasts it
+func (h *APIHandler) processPoint(parsedData *data.UniversalDataPoint, source string) {
     // Ensure DeviceID is populated if possible (e.g. from source-specific logic if not in payload)
     if parsedData.DeviceID == "" {
          parsedData.DeviceID = fmt.Sprintf("device_from_%s", source) // Example default
@@ -124,11 +360,8 @@ func (h *APIHandler) HandleDataIngest(w http.ResponseWriter, r *http.Request) {
 
 	// 4. Broadcast the received data via WebSocket
 	h.hub.BroadcastData(parsedData)
-
-	w.Header().Set("Content-Type", "application/json")
-	w.WriteHeader(http.StatusOK)
-	json.NewEncoder(w).Encode(map[string]string{"status": "received", "source": source})
 }
+
 // HandleWebSocket upgrades connections and registers clients with the hub
 func (h *APIHandler) HandleWebSocket(w http.ResponseWriter, r *http.Request) {
 	conn, err := upgrader.Upgrade(w, r, nil)
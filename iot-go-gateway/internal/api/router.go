@@ -14,6 +14,9 @@ func SetupDataRouter(apiHandler *APIHandler) *chi.Mux {
 
 	// --> Apply Authentication Middleware to /data endpoint <--
 	r.Post("/data", apiHandler.Authenticate(apiHandler.HandleDataIngest))
+	r.Post("/data/batch", apiHandler.Authenticate(apiHandler.HandleBatchIngest))
+	// Checked once per stream rather than per reading
+	r.Post("/data/stream", apiHandler.Authenticate(apiHandler.HandleStreamIngest))
 
 	return r
 }
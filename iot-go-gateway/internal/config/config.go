@@ -14,6 +14,10 @@ type Config struct {
 	Anomaly struct {
 		Rules map[string]Rule `mapstructure:"rules"`
 	} `mapstructure:"anomaly"`
+	Ingest struct {
+		DeflateDictionary string `mapstructure:"deflate_dictionary"` // Preset dictionary file shared with the bridges (HTTP_COMPRESSION_DICT)
+		MaxBodyBytes      int64  `mapstructure:"max_body_bytes"`     // Largest request body after decoding; 0 means 64 MiB
+	} `mapstructure:"ingest"`
 	// Add other config sections
 }
 
@@ -0,0 +1,306 @@
+// internal/data/envelope.go
+package data
+
+import (
+	"encoding/binary"
+	"errors"
+	"fmt"
+	"math"
+)
+
+// EnvelopeContentType marks request bodies in the bridges' binary envelope: a MessagePack map
+//
+//	{"k": [field names], "s": [string values], "r": [{field index: value}, ...]}
+//
+// in which string values are sent as extension type 1 holding their index in "s"
+const EnvelopeContentType = "application/vnd.iot-envelope+msgpack"
+
+const (
+	internedString   = 1  // MessagePack extension type of a reference into the string table
+	envelopeMaxDepth = 32 // Deepest nesting accepted in an envelope
+)
+
+var errTruncated = errors.New("truncated msgpack data")
+
+// stringRef is an interned string not yet resolved against the string table
+type stringRef uint32
+
+// ParseEnvelope decodes a binary envelope into UniversalDataPoints
+func ParseEnvelope(rawData []byte, source string) ([]*UniversalDataPoint, error) {
+	d := &msgpackDecoder{buf: rawData}
+	value, err := d.decode(0)
+	if err != nil {
+		return nil, fmt.Errorf("invalid envelope: %w", err)
+	}
+	if d.pos != len(d.buf) {
+		return nil, fmt.Errorf("invalid envelope: %d trailing bytes", len(d.buf)-d.pos)
+	}
+	top, ok := value.(map[interface{}]interface{})
+	if !ok {
+		return nil, fmt.Errorf("invalid envelope: expected a map, got %T", value)
+	}
+
+	keys, err := stringList(top["k"])
+	if err != nil {
+		return nil, fmt.Errorf("invalid envelope field names: %w", err)
+	}
+	strs, err := stringList(top["s"])
+	if err != nil {
+		return nil, fmt.Errorf("invalid envelope strings: %w", err)
+	}
+	rows, ok := top["r"].([]interface{})
+	if !ok && top["r"] != nil {
+		return nil, fmt.Errorf("invalid envelope: rows are %T, expected an array", top["r"])
+	}
+
+	points := make([]*UniversalDataPoint, 0, len(rows))
+	for i, row := range rows {
+		fields, ok := row.(map[interface{}]interface{})
+		if !ok {
+			if row == nil {
+				continue // Skip null entries, as ParseBatch does
+			}
+			return nil, fmt.Errorf("invalid envelope row %d: %T, expected a map", i, row)
+		}
+		genericPayload := make(map[string]interface{}, len(fields))
+		for k, v := range fields {
+			index, ok := k.(int64)
+			if !ok || index < 0 || index >= int64(len(keys)) {
+				return nil, fmt.Errorf("invalid envelope row %d: unknown field %v", i, k)
+			}
+			if v, err = resolve(v, strs); err != nil {
+				return nil, fmt.Errorf("invalid envelope row %d: %w", i, err)
+			}
+			genericPayload[keys[index]] = v
+		}
+		points = append(points, pointFromPayload(genericPayload, source))
+	}
+	return points, nil
+}
+
+// stringList converts a decoded array of strings
+func stringList(value interface{}) ([]string, error) {
+	if value == nil {
+		return nil, nil
+	}
+	items, ok := value.([]interface{})
+	if !ok {
+		return nil, fmt.Errorf("%T, expected an array", value)
+	}
+	strs := make([]string, len(items))
+	for i, item := range items {
+		if strs[i], ok = item.(string); !ok {
+			return nil, fmt.Errorf("item %d is %T, expected a string", i, item)
+		}
+	}
+	return strs, nil
+}
+
+// resolve replaces interned string references in a value by their strings.
+// Nested arrays and maps are left as decoded; pointFromPayload skips them.
+func resolve(value interface{}, strs []string) (interface{}, error) {
+	ref, ok := value.(stringRef)
+	if !ok {
+		return value, nil
+	}
+	if int(ref) >= len(strs) {
+		return nil, fmt.Errorf("string reference %d out of range", ref)
+	}
+	return strs[ref], nil
+}
+
+// msgpackDecoder decodes the subset of MessagePack the envelope uses into Go values:
+// nil, bool, int64 (float64 above MaxInt64), float64, string, []byte, []interface{},
+// map[interface{}]interface{}, and stringRef for interned strings
+type msgpackDecoder struct {
+	buf []byte
+	pos int
+}
+
+func (d *msgpackDecoder) take(n int) ([]byte, error) {
+	if n < 0 || n > len(d.buf)-d.pos {
+		return nil, errTruncated
+	}
+	b := d.buf[d.pos : d.pos+n]
+	d.pos += n
+	return b, nil
+}
+
+// length reads a big-endian length of size bytes
+func (d *msgpackDecoder) length(size int) (int, error) {
+	b, err := d.take(size)
+	if err != nil {
+		return 0, err
+	}
+	switch size {
+	case 1:
+		return int(b[0]), nil
+	case 2:
+		return int(binary.BigEndian.Uint16(b)), nil
+	default:
+		n := binary.BigEndian.Uint32(b)
+		if uint64(n) > uint64(len(d.buf)) {
+			return 0, errTruncated // Every element takes at least a byte
+		}
+		return int(n), nil
+	}
+}
+
+func (d *msgpackDecoder) decode(depth int) (interface{}, error) {
+	if depth > envelopeMaxDepth {
+		return nil, errors.New("msgpack data nested too deeply")
+	}
+	b, err := d.take(1)
+	if err != nil {
+		return nil, err
+	}
+	c := b[0]
+	switch {
+	case c <= 0x7f: // positive fixint
+		return int64(c), nil
+	case c >= 0xe0: // negative fixint
+		return int64(int8(c)), nil
+	case c&0xf0 == 0x80: // fixmap
+		return d.decodeMap(int(c&0x0f), depth)
+	case c&0xf0 == 0x90: // fixarray
+		return d.decodeArray(int(c&0x0f), depth)
+	case c&0xe0 == 0xa0: // fixstr
+		return d.decodeString(int(c & 0x1f))
+	}
+
+	switch c {
+	case 0xc0:
+		return nil, nil
+	case 0xc2:
+		return false, nil
+	case 0xc3:
+		return true, nil
+	case 0xc4, 0xc5, 0xc6: // bin 8/16/32
+		n, err := d.length(1 << (c - 0xc4))
+		if err != nil {
+			return nil, err
+		}
+		return d.take(n)
+	case 0xc7, 0xc8, 0xc9: // ext 8/16/32
+		n, err := d.length(1 << (c - 0xc7))
+		if err != nil {
+			return nil, err
+		}
+		return d.decodeExt(n)
+	case 0xca:
+		b, err := d.take(4)
+		if err != nil {
+			return nil, err
+		}
+		return float64(math.Float32frombits(binary.BigEndian.Uint32(b))), nil
+	case 0xcb:
+		b, err := d.take(8)
+		if err != nil {
+			return nil, err
+		}
+		return math.Float64frombits(binary.BigEndian.Uint64(b)), nil
+	case 0xcc, 0xcd, 0xce, 0xcf: // uint 8/16/32/64
+		b, err := d.take(1 << (c - 0xcc))
+		if err != nil {
+			return nil, err
+		}
+		v := bigEndian(b)
+		if v > math.MaxInt64 {
+			return float64(v), nil
+		}
+		return int64(v), nil
+	case 0xd0, 0xd1, 0xd2, 0xd3: // int 8/16/32/64
+		b, err := d.take(1 << (c - 0xd0))
+		if err != nil {
+			return nil, err
+		}
+		shift := 64 - 8*uint(len(b))
+		return int64(bigEndian(b)<<shift) >> shift, nil // Sign-extend
+	case 0xd4, 0xd5, 0xd6, 0xd7, 0xd8: // fixext 1/2/4/8/16
+		return d.decodeExt(1 << (c - 0xd4))
+	case 0xd9, 0xda, 0xdb: // str 8/16/32
+		n, err := d.length(1 << (c - 0xd9))
+		if err != nil {
+			return nil, err
+		}
+		return d.decodeString(n)
+	case 0xdc, 0xdd: // array 16/32
+		n, err := d.length(2 << (c - 0xdc))
+		if err != nil {
+			return nil, err
+		}
+		return d.decodeArray(n, depth)
+	case 0xde, 0xdf: // map 16/32
+		n, err := d.length(2 << (c - 0xde))
+		if err != nil {
+			return nil, err
+		}
+		return d.decodeMap(n, depth)
+	}
+	return nil, fmt.Errorf("unsupported msgpack type 0x%02x", c)
+}
+
+func bigEndian(b []byte) uint64 {
+	var v uint64
+	for _, x := range b {
+		v = v<<8 | uint64(x)
+	}
+	return v
+}
+
+func (d *msgpackDecoder) decodeString(n int) (interface{}, error) {
+	b, err := d.take(n)
+	if err != nil {
+		return nil, err
+	}
+	return string(b), nil
+}
+
+func (d *msgpackDecoder) decodeExt(n int) (interface{}, error) {
+	b, err := d.take(1 + n)
+	if err != nil {
+		return nil, err
+	}
+	if int8(b[0]) != internedString || n > 4 {
+		return nil, fmt.Errorf("unsupported msgpack extension %d of %d bytes", int8(b[0]), n)
+	}
+	return stringRef(bigEndian(b[1:])), nil
+}
+
+func (d *msgpackDecoder) decodeArray(n int, depth int) (interface{}, error) {
+	if n > len(d.buf)-d.pos {
+		return nil, errTruncated
+	}
+	items := make([]interface{}, n)
+	for i := range items {
+		item, err := d.decode(depth + 1)
+		if err != nil {
+			return nil, err
+		}
+		items[i] = item
+	}
+	return items, nil
+}
+
+func (d *msgpackDecoder) decodeMap(n int, depth int) (interface{}, error) {
+	if 2*n > len(d.buf)-d.pos {
+		return nil, errTruncated
+	}
+	m := make(map[interface{}]interface{}, n)
+	for i := 0; i < n; i++ {
+		k, err := d.decode(depth + 1)
+		if err != nil {
+			return nil, err
+		}
+		switch k.(type) {
+		case []interface{}, map[interface{}]interface{}, []byte:
+			return nil, fmt.Errorf("unsupported msgpack map key %T", k)
+		}
+		v, err := d.decode(depth + 1)
+		if err != nil {
+			return nil, err
+		}
+		m[k] = v
+	}
+	return m, nil
+}
@@ -19,11 +19,56 @@ func Parse(rawData []byte, source string, cfg *config.Config) (*UniversalDataPoi
 
 	log.Printf("Received payload from source '%s': %+v", source, genericPayload)
 
+	point := pointFromPayload(genericPayload, source)
+	point.OriginalPayload = rawData
+
+    if len(point.Metrics) == 0 {
+         log.Printf("Warning: No metrics extracted from payload for source '%s'. Original: %s", source, string(rawData))
+    }
+
+	log.Printf("Parsed data for source '%s': DeviceID=%s, Timestamp=%s, Metrics=%+v", source, point.DeviceID, point.Timestamp.Format(time.RFC3339), point.Metrics)
+	return point, nil
+}
+
+// ParseBatch unmarshals a JSON array of payloads into UniversalDataPoints in a single decode pass
+func ParseBatch(rawData []byte, source string, cfg *config.Config) ([]*UniversalDataPoint, error) {
+	var genericPayloads []map[string]interface{}
+	if err := json.Unmarshal(rawData, &genericPayloads); err != nil {
+		log.Printf("Error unmarshalling batch for source %s: %v", source, err)
+		return nil, fmt.Errorf("invalid JSON array format: %w", err)
+	}
+
+	points := make([]*UniversalDataPoint, 0, len(genericPayloads))
+	for _, genericPayload := range genericPayloads {
+		if genericPayload == nil {
+			continue // Skip null entries
+		}
+		points = append(points, pointFromPayload(genericPayload, source))
+	}
+
+	log.Printf("Parsed batch of %d data points for source '%s'", len(points), source)
+	return points, nil
+}
+
+// ParseLine unmarshals one line of a newline-delimited JSON stream; returns nil for a null line.
+// Unlike Parse it logs nothing per line, as a stream carries many readings.
+func ParseLine(line []byte, source string) (*UniversalDataPoint, error) {
+	var genericPayload map[string]interface{}
+	if err := json.Unmarshal(line, &genericPayload); err != nil {
+		return nil, fmt.Errorf("invalid JSON format: %w", err)
+	}
+	if genericPayload == nil {
+		return nil, nil
+	}
+	return pointFromPayload(genericPayload, source), nil
+}
+
+// pointFromPayload converts one decoded JSON object into a UniversalDataPoint
+func pointFromPayload(genericPayload map[string]interface{}, source string) *UniversalDataPoint {
 	point := &UniversalDataPoint{
 		Timestamp:     time.Now(), // Default, try to overwrite
 		Source:        source,
 		Metrics:       make(map[string]interface{}),
-		OriginalPayload: rawData,
 	}
 
 	// --- Extract Common Fields ---
@@ -72,13 +117,7 @@ func Parse(rawData []byte, source string, cfg *config.Config) (*UniversalDataPoi
 		}
 	}
 
-    if len(point.Metrics) == 0 {
-         log.Printf("Warning: No metrics extracted from payload for source '%s'. Original: %s", source, string(rawData))
-    }
-
-
-	log.Printf("Parsed data for source '%s': DeviceID=%s, Timestamp=%s, Metrics=%+v", source, point.DeviceID, point.Timestamp.Format(time.RFC3339), point.Metrics)
-	return point, nil
+	return point
 }
 
 // parseTimestamp tries various common formats
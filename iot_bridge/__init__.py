@@ -0,0 +1,24 @@
+"""
+Shared building blocks for the protocol-to-HTTP bridges.
+"""
+from .batching import Batcher
+from .deadband import DeadbandFilter, DeadbandRule, open_filter_from_env
+from .forwarder import AsyncForwarder, Forwarder, check_response, is_retryable
+from .journal import Journal, JournalReplayer, open_journal_from_env
+from .queueing import ForwardQueue, WorkerPool
+
+__all__ = [
+    "AsyncForwarder",
+    "Batcher",
+    "DeadbandFilter",
+    "DeadbandRule",
+    "Forwarder",
+    "ForwardQueue",
+    "Journal",
+    "JournalReplayer",
+    "WorkerPool",
+    "check_response",
+    "is_retryable",
+    "open_filter_from_env",
+    "open_journal_from_env",
+]
@@ -0,0 +1,4 @@
+"""Run the bridge runtime: ``BRIDGE_PLUGINS=mqtt,coap python -m iot_bridge``."""
+from .runtime import main
+
+main()
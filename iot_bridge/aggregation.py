@@ -0,0 +1,395 @@
+"""
+Windowed aggregation (downsampling) of readings before they are forwarded.
+
+An ``Aggregator`` replaces the raw values of matching metrics with one summary
+per device and window: ``<metric>_min``, ``_max``, ``_mean``, ``_last``,
+``_count`` (and ``_sum``), plus ``_p<N>`` percentiles estimated with a
+``QuantileSketch``. Rules choose what is aggregated:
+
+- ``topic``: MQTT topic filter (``+`` and ``#`` wildcards) the reading arrived on
+- ``path``: glob of the CoAP URI path (or observed URI)
+- ``device``: glob of the device id, e.g. a Modbus device from the register map
+- ``metrics``: metric names to aggregate (Modbus point names); all numeric ones if omitted
+- ``window``: window length in seconds
+- ``step``: emit a sliding window every ``step`` seconds; tumbling when omitted
+- ``stats``, ``percentiles``: what to emit per metric
+- ``keep_raw``: also forward the raw values
+
+Windows are aligned to the wall clock and kept per device in array-backed rings
+of ``window / step`` panes, each holding count/sum/min/max of the values that
+arrived during one step; a window's summary merges its panes. Memory per series
+is bounded by the pane count, whatever the reading rate. Metrics no rule
+aggregates are forwarded as they are; a reading left with no numeric metric is
+dropped entirely.
+"""
+import fnmatch
+import json
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+AGGREGATE_VALUES = metrics.counter("bridge_aggregate_values_total", "Numeric values seen by the aggregator, by outcome")
+AGGREGATE_WINDOWS = metrics.counter("bridge_aggregate_windows_total", "Aggregated windows emitted, by source")
+AGGREGATE_SERIES = metrics.gauge("bridge_aggregate_series", "Device/metric series with an open window, by source")
+
+STATS = ("min", "max", "mean", "last", "count", "sum")
+DEFAULT_STATS = ("min", "max", "mean", "last", "count")
+
+_ID_FIELDS = ("device_id", "sensor_id", "source", "topic")
+
+
+def topic_matches(topic_filter, topic):
+    """Whether an MQTT topic matches a filter with + and # wildcards."""
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    return len(levels) == len(filter_levels)
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with bounded relative error (logarithmic buckets, as in DDSketch).
+
+    Every estimate is within `accuracy` (relative) of a value that was added;
+    memory grows with the logarithm of the value range, not the value count.
+    """
+    __slots__ = ("_log_gamma", "_positive", "_negative", "zeros", "count")
+
+    def __init__(self, accuracy=0.01):
+        self._log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self._positive = {} # bucket index -> count
+        self._negative = {} # ...of the absolute values
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        if value > 0:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._positive[index] = self._positive.get(index, 0) + 1
+        elif value < 0:
+            index = math.ceil(math.log(-value) / self._log_gamma)
+            self._negative[index] = self._negative.get(index, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def merge(self, other):
+        for mine, theirs in ((self._positive, other._positive), (self._negative, other._negative)):
+            for index, count in theirs.items():
+                mine[index] = mine.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate of the `q` quantile (0..1); None when empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self._negative, reverse=True): # Most negative first
+            seen += self._negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._positive):
+            seen += self._positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self._positive))
+
+    def _value(self, index):
+        gamma = math.exp(self._log_gamma)
+        return 2 * gamma ** index / (gamma + 1)
+
+
+class AggregationRule:
+    """What to aggregate for readings matching the selectors, and how."""
+
+    def __init__(self, window, step=None, stats=DEFAULT_STATS, percentiles=(), keep_raw=False,
+                 topic=None, path=None, device=None, metrics=None, source=None, sketch_accuracy=0.01):
+        step = step or window
+        if window <= 0 or step <= 0:
+            raise ValueError("Aggregation window and step must be positive")
+        panes = window / step
+        if abs(panes - round(panes)) > 1e-9:
+            raise ValueError(f"Aggregation window {window} is not a multiple of its step {step}")
+        unknown = set(stats) - set(STATS)
+        if unknown:
+            raise ValueError(f"Unknown aggregation stats {sorted(unknown)}, expected some of {STATS}")
+        self.window = window
+        self.step = step
+        self.panes = int(round(panes))
+        self.stats = tuple(stats)
+        self.percentiles = tuple(percentiles) # e.g. (50, 95, 99)
+        self.keep_raw = keep_raw
+        self.topic = topic
+        self.path = path
+        self.device = device
+        self.metrics = frozenset(metrics) if metrics is not None else None
+        self.source = source
+        self.sketch_accuracy = sketch_accuracy
+
+    def matches(self, reading, path):
+        if self.topic is not None and not topic_matches(self.topic, str(reading.get("topic", ""))):
+            return False
+        if self.path is not None and (path is None or not fnmatch.fnmatchcase(path, self.path)):
+            return False
+        if self.device is not None:
+            device = next((str(reading[f]) for f in ("device_id", "sensor_id") if f in reading), "")
+            if not fnmatch.fnmatchcase(device, self.device):
+                return False
+        return True
+
+    def aggregates(self, name):
+        return self.metrics is None or name in self.metrics
+
+
+class _Series:
+    """Ring of per-pane count/sum/min/max for one metric of one device."""
+    __slots__ = ("counts", "sums", "mins", "maxs", "last", "sketches")
+
+    def __init__(self, panes, sketches):
+        self.counts = array("L", [0]) * panes
+        self.sums = array("d", [0.0]) * panes
+        self.mins = array("d", [math.inf]) * panes
+        self.maxs = array("d", [-math.inf]) * panes
+        self.last = None
+        self.sketches = [None] * panes if sketches else None
+
+    def add(self, slot, value, accuracy):
+        self.counts[slot] += 1
+        self.sums[slot] += value
+        if value < self.mins[slot]:
+            self.mins[slot] = value
+        if value > self.maxs[slot]:
+            self.maxs[slot] = value
+        self.last = value
+        if self.sketches is not None:
+            sketch = self.sketches[slot]
+            if sketch is None:
+                sketch = self.sketches[slot] = QuantileSketch(accuracy)
+            sketch.add(value)
+
+    def clear(self, slot):
+        self.counts[slot] = 0
+        self.sums[slot] = 0.0
+        self.mins[slot] = math.inf
+        self.maxs[slot] = -math.inf
+        if self.sketches is not None:
+            self.sketches[slot] = None
+
+    def summarize(self, name, rule, out):
+        """Add this window's summary fields to `out`; False if the window saw no value."""
+        count = sum(self.counts)
+        if not count:
+            return False
+        total = sum(self.sums)
+        values = {"min": min(self.mins), "max": max(self.maxs), "mean": total / count, "last": self.last,
+                  "count": count, "sum": total}
+        for stat in rule.stats:
+            out[f"{name}_{stat}"] = values[stat]
+        if rule.percentiles:
+            merged = QuantileSketch(rule.sketch_accuracy)
+            for sketch in self.sketches:
+                if sketch is not None:
+                    merged.merge(sketch)
+            for percentile in rule.percentiles:
+                out[f"{name}_p{percentile:g}"] = merged.quantile(percentile / 100.0)
+        return True
+
+
+class _Group:
+    """Open windows of one device under one rule: its series share the pane clock."""
+    __slots__ = ("rule", "identity", "pane", "series", "idle")
+
+    def __init__(self, rule, identity, pane):
+        self.rule = rule
+        self.identity = identity # Envelope fields copied into every summary
+        self.pane = pane # Wall-clock pane (time // step) values are added to
+        self.series = {}
+        self.idle = 0 # Consecutive empty windows
+
+    def add(self, name, value):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = _Series(self.rule.panes, bool(self.rule.percentiles))
+        series.add(self.pane % self.rule.panes, value, self.rule.sketch_accuracy)
+
+    def close_pane(self):
+        """Summarize the window ending with the current pane and start the next one; None if empty."""
+        rule = self.rule
+        end = (self.pane + 1) * rule.step
+        summary = dict(self.identity)
+        summary["timestamp"] = end
+        summary["window_start"] = end - rule.window
+        summary["window"] = rule.window
+        emitted = False
+        for name, series in self.series.items():
+            emitted = series.summarize(name, rule, summary) or emitted
+        self.pane += 1
+        slot = self.pane % rule.panes
+        for series in self.series.values():
+            series.clear(slot)
+        self.idle = 0 if emitted else self.idle + 1
+        return summary if emitted else None
+
+
+class Aggregator:
+    """Per-device windowed aggregation for one source; summaries go to `emit` from a background thread."""
+
+    def __init__(self, rules, emit, source="bridge", max_series=100000):
+        self.rules = list(rules)
+        self.emit = emit
+        self.source = source
+        self.max_series = max_series
+        self._groups = {} # (rule index, identity) -> _Group
+        self._series = 0
+        self._matches = {} # (topic, device, path) -> rule index or None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        min_step = min(rule.step for rule in self.rules)
+        self._tick = max(0.05, min(1.0, min_step / 10))
+        self._thread = threading.Thread(target=self._run, name=f"aggregator-{source}", daemon=True)
+        self._thread.start()
+
+    def apply(self, reading, path=None):
+        """Aggregate the matching metrics of `reading`; return what to forward raw (None for nothing)."""
+        index = self._match(reading, path)
+        if index is None:
+            return reading
+        rule = self.rules[index]
+        numeric = [name for name, value in reading.items()
+                   if name != "timestamp" and isinstance(value, (int, float)) and not isinstance(value, bool)]
+        names = [name for name in numeric if rule.aggregates(name)]
+        if not names:
+            return reading
+        with self._lock:
+            group = self._group(index, rule, reading, time.time())
+            if group is not None:
+                for name in names:
+                    if name not in group.series:
+                        self._series += 1
+                    group.add(name, reading[name])
+                AGGREGATE_SERIES.set(self._series, source=self.source)
+        if group is None:
+            AGGREGATE_VALUES.inc(len(names), outcome="overflow") # Series limit reached: forward raw
+            return reading
+        AGGREGATE_VALUES.inc(len(names), outcome="aggregated")
+        if rule.keep_raw:
+            return reading
+        if len(names) == len(numeric):
+            return None
+        names = set(names)
+        return {name: value for name, value in reading.items() if name not in names}
+
+    def _match(self, reading, path):
+        key = (reading.get("topic"), reading.get("device_id", reading.get("sensor_id")), path)
+        try:
+            return self._matches[key]
+        except KeyError:
+            pass
+        except TypeError:
+            key = None # Unhashable field values; match without caching
+        index = next((i for i, rule in enumerate(self.rules) if rule.matches(reading, path)), None)
+        if key is not None:
+            if len(self._matches) >= 10000:
+                self._matches.clear()
+            self._matches[key] = index
+        return index
+
+    def _group(self, index, rule, reading, now):
+        """The group of `reading` under `rule` (lock held); None when at the series limit."""
+        identity = tuple((f, reading[f]) for f in _ID_FIELDS if f in reading)
+        key = (index, identity)
+        group = self._groups.get(key)
+        if group is None:
+            if self._series >= self.max_series:
+                return None
+            group = self._groups[key] = _Group(rule, dict(identity), int(now // rule.step))
+        return group
+
+    def flush(self, now=None, force=False):
+        """Emit every window that ended by `now`; with `force`, also the open ones and forget all devices."""
+        now = time.time() if now is None else now
+        summaries = []
+        with self._lock:
+            for key, group in list(self._groups.items()):
+                rule = group.rule
+                while (group.pane + 1) * rule.step <= now or force:
+                    summary = group.close_pane()
+                    if summary is not None:
+                        summaries.append(summary)
+                    if group.idle >= rule.panes or force:
+                        # A whole window without values (or shutting down): stop tracking the device
+                        self._series -= len(group.series)
+                        del self._groups[key]
+                        break
+            AGGREGATE_SERIES.set(self._series, source=self.source)
+        for summary in summaries:
+            try:
+                self.emit(summary)
+            except Exception as e:
+                log.exception("Error forwarding %s aggregate: %s", self.source, e)
+        if summaries:
+            AGGREGATE_WINDOWS.inc(len(summaries), source=self.source)
+        return summaries
+
+    def _run(self):
+        while not self._stopped.wait(self._tick):
+            self.flush()
+
+    def close(self, timeout=None):
+        """Stop the background thread and emit the windows still open."""
+        self._stopped.set()
+        self._thread.join(timeout)
+        self.flush(force=True)
+
+
+def _rule_from_settings(settings):
+    settings = dict(settings)
+    unknown = set(settings) - {"window", "step", "stats", "percentiles", "keep_raw", "topic", "path", "device",
+                               "metrics", "source", "sketch_accuracy"}
+    if unknown:
+        raise ValueError(f"Unknown aggregation rule settings {sorted(unknown)}")
+    return AggregationRule(**settings)
+
+
+def _csv(name, default=""):
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+
+def open_aggregator_from_env(source, emit):
+    """Build the aggregator configured by AGGREGATE_* variables for one source; None when none is set."""
+    rules_path = os.getenv("AGGREGATE_RULES") # JSON list of rules; see the module docstring
+    window = os.getenv("AGGREGATE_WINDOW") # Seconds; aggregates every numeric metric without rules
+    if rules_path:
+        with open(rules_path) as f:
+            rules = [_rule_from_settings(settings) for settings in json.load(f)]
+    elif window:
+        step = os.getenv("AGGREGATE_STEP")
+        rules = [AggregationRule(
+            float(window),
+            step=float(step) if step else None,
+            stats=_csv("AGGREGATE_STATS", ",".join(DEFAULT_STATS)),
+            percentiles=[float(p) for p in _csv("AGGREGATE_PERCENTILES")],
+            keep_raw=os.getenv("AGGREGATE_KEEP_RAW", "false").lower() == "true",
+        )]
+    else:
+        return None
+    rules = [rule for rule in rules if rule.source in (None, source)]
+    if not rules:
+        return None
+    log.info("Aggregating %s readings (%d rules)", source, len(rules))
+    return Aggregator(rules, emit, source=source, max_series=int(os.getenv("AGGREGATE_MAX_SERIES", "100000")))
@@ -0,0 +1,212 @@
+"""
+Edge anomaly pre-screening of readings, ahead of the gateway's own checks.
+
+An ``AnomalyScreen`` loads the gateway's threshold rules (``anomaly.rules`` in
+iot-go-gateway/config.yaml) and checks every reading inline, so an alert can
+leave the bridge without waiting for batching or aggregation. Optional
+statistical detectors run per (device, metric) series:
+
+- ``zscore``: flag values more than this many standard deviations from the
+  mean of the last ``window`` values (a ring buffer per series)
+- ``ewma_alpha`` / ``ewma_threshold``: flag values more than ``ewma_threshold``
+  standard deviations from an exponentially weighted moving average
+
+Both can be set for every metric (ANOMALY_ZSCORE, ANOMALY_EWMA_ALPHA) or per
+metric next to ``min``/``max`` in the rules file; the gateway ignores keys it
+does not know. A detector only flags once it has seen ``min_samples`` values.
+"""
+import json
+import logging
+import math
+import os
+import threading
+from array import array
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+ANOMALIES = metrics.counter("bridge_anomalies_total", "Readings flagged by the edge anomaly screen, by metric and check")
+ANOMALY_SERIES = metrics.gauge("bridge_anomaly_series", "Series tracked by the statistical anomaly detectors")
+
+_ID_FIELDS = ("device_id", "sensor_id", "topic")
+RULE_KEYS = ("min", "max", "zscore", "window", "ewma_alpha", "ewma_threshold", "min_samples")
+
+
+class AnomalyRule:
+    """Checks for one metric: thresholds from the gateway's rules plus optional detectors."""
+
+    def __init__(self, min=None, max=None, zscore=None, window=60, ewma_alpha=None, ewma_threshold=4.0, min_samples=10):
+        self.min = -math.inf if min is None else float(min) # A missing bound does not limit
+        self.max = math.inf if max is None else float(max)
+        self.zscore = None if zscore is None else float(zscore)
+        self.window = int(window)
+        self.ewma_alpha = None if ewma_alpha is None else float(ewma_alpha)
+        self.ewma_threshold = float(ewma_threshold)
+        self.min_samples = int(min_samples)
+        if self.window < 1:
+            raise ValueError("window must be at least 1")
+
+    @property
+    def stateful(self):
+        return self.zscore is not None or self.ewma_alpha is not None
+
+
+class _SeriesState:
+    """Ring buffer (with its mean and squared deviations) and EWMA state for one series."""
+    __slots__ = ("values", "head", "size", "window_mean", "m2", "mean", "variance", "seen")
+
+    def __init__(self, rule):
+        self.values = array("d", [0.0]) * rule.window if rule.zscore is not None else None
+        self.head = self.size = 0
+        self.window_mean = self.m2 = 0.0 # Welford updates: running sums of squares cancel out on large offsets
+        self.mean = self.variance = 0.0
+        self.seen = 0
+
+    def zscore(self, value):
+        """Z-score of `value` against the values in the ring, then add it."""
+        score = None
+        if self.size:
+            variance = max(self.m2 / self.size, 0.0)
+            if variance > 0:
+                score = (value - self.window_mean) / math.sqrt(variance)
+        values = self.values
+        mean = self.window_mean
+        if self.size == len(values):
+            old = values[self.head]
+            self.window_mean = mean + (value - old) / self.size
+            self.m2 += (value - old) * (value - self.window_mean + old - mean)
+        else:
+            self.size += 1
+            self.window_mean = mean + (value - mean) / self.size
+            self.m2 += (value - mean) * (value - self.window_mean)
+        values[self.head] = value
+        self.head = (self.head + 1) % len(values)
+        if self.head == 0 and self.size == len(values):
+            # Once per lap of the ring, so rounding errors cannot build up
+            self.window_mean = math.fsum(values) / self.size
+            self.m2 = math.fsum((v - self.window_mean) ** 2 for v in values)
+        return score
+
+    def ewma(self, value, alpha):
+        """Deviation of `value` from the moving average in standard deviations, then update it."""
+        if self.seen == 0:
+            self.mean = value
+            return None
+        deviation = value - self.mean
+        score = abs(deviation) / math.sqrt(self.variance) if self.variance > 0 else None
+        increment = alpha * deviation
+        self.mean += increment
+        self.variance = (1 - alpha) * (self.variance + deviation * increment)
+        return score
+
+
+class AnomalyScreen:
+    """Inline per-metric checks shared by the bridges."""
+
+    def __init__(self, rules=None, default=None, max_series=100000):
+        self.rules = rules or {}
+        self.default = default # Applies to metrics without a rule; None checks only those
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def check(self, reading):
+        """Names of the anomalous metrics of `reading` with the check that flagged them, e.g. "temperature:max"."""
+        flagged = []
+        device = None
+        for name, value in reading.items():
+            rule = self.rules.get(name, self.default)
+            if rule is None or isinstance(value, bool) or not isinstance(value, (int, float)) or name == "timestamp":
+                continue
+            if value < rule.min:
+                flagged.append(f"{name}:min")
+            elif value > rule.max:
+                flagged.append(f"{name}:max")
+            elif rule.stateful:
+                if device is None:
+                    device = next((str(reading[f]) for f in _ID_FIELDS if f in reading), "")
+                check = self._detect(rule, (device, name), value)
+                if check is not None:
+                    flagged.append(f"{name}:{check}")
+        for flag in flagged:
+            name, _, check = flag.rpartition(":")
+            ANOMALIES.inc(metric=name, check=check)
+        return flagged
+
+    def _detect(self, rule, key, value):
+        """Run the statistical detectors of one series; the name of the one that fired, or None."""
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                if len(self._series) >= self.max_series:
+                    return None # Thresholds still apply; new series are not tracked
+                state = self._series[key] = _SeriesState(rule)
+                ANOMALY_SERIES.set(len(self._series))
+            fired = None
+            warmed_up = state.seen >= rule.min_samples
+            if rule.zscore is not None:
+                score = state.zscore(value)
+                if warmed_up and score is not None and abs(score) > rule.zscore:
+                    fired = "zscore"
+            if rule.ewma_alpha is not None:
+                score = state.ewma(value, rule.ewma_alpha)
+                if warmed_up and score is not None and score > rule.ewma_threshold and fired is None:
+                    fired = "ewma"
+            state.seen += 1
+            return fired
+
+
+def load_rules(path):
+    """Per-metric settings from the gateway's config.yaml (anomaly.rules) or a JSON file of the same shape."""
+    with open(path) as f:
+        if path.endswith(".json"):
+            config = json.load(f)
+        else:
+            import yaml
+            config = yaml.safe_load(f)
+    rules = ((config or {}).get("anomaly") or {}).get("rules") or {}
+    if not isinstance(rules, dict):
+        raise ValueError(f"anomaly.rules in {path} must map metric names to settings")
+    return rules
+
+
+def _optional_float(name):
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else None
+
+
+def _rule(name, settings, detectors):
+    """AnomalyRule for one metric of the rules file; keys it does not know (e.g. severity) are for the gateway."""
+    settings = settings or {} # `temperature:` with nothing under it
+    if not isinstance(settings, dict):
+        raise ValueError(f"Anomaly rule {name}: expected a mapping of settings, got {settings!r}")
+    unknown = sorted(set(settings) - set(RULE_KEYS))
+    if unknown:
+        log.warning("Anomaly rule %s: ignoring %s", name, ", ".join(map(str, unknown)))
+    try:
+        return AnomalyRule(**dict(detectors, **{key: value for key, value in settings.items() if key in RULE_KEYS}))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Anomaly rule {name}: {e}") from e
+
+
+def open_screen_from_env():
+    """Build the screen configured by ANOMALY_* variables; None when none is set."""
+    rules_path = os.getenv("ANOMALY_RULES") # e.g. the gateway's config.yaml
+    detectors = {
+        "zscore": _optional_float("ANOMALY_ZSCORE"),
+        "window": int(os.getenv("ANOMALY_WINDOW", "60")), # Values in the z-score ring
+        "ewma_alpha": _optional_float("ANOMALY_EWMA_ALPHA"),
+        "ewma_threshold": float(os.getenv("ANOMALY_EWMA_THRESHOLD", "4")),
+        "min_samples": int(os.getenv("ANOMALY_MIN_SAMPLES", "10")),
+    }
+    statistical = detectors["zscore"] is not None or detectors["ewma_alpha"] is not None
+    if not rules_path and not statistical:
+        return None
+    rules = {}
+    if rules_path:
+        rules = {name: _rule(name, settings, detectors) for name, settings in load_rules(rules_path).items()}
+    default = AnomalyRule(**detectors) if statistical else None
+    log.info("Anomaly pre-screen enabled (%d threshold rules, statistical detectors %s)",
+             len(rules), "on" if statistical else "off")
+    return AnomalyScreen(rules, default, max_series=int(os.getenv("ANOMALY_MAX_SERIES", "100000")))
@@ -0,0 +1,184 @@
+"""
+Micro-batching stage between the bridges and the gateway.
+
+Readings are serialized once on submit() and coalesced into a single JSON
+array that is POSTed to the gateway's batch endpoint. A batch is flushed as
+soon as it reaches `max_items` readings, `max_bytes` of encoded JSON, or has
+been open for `max_latency_ms`, whichever comes first. At most `max_pending`
+readings wait for the batch thread: beyond that, while the gateway is slow or
+down, new readings go to the journal, or replace the oldest without one.
+"""
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from . import codec, metrics, tracing
+from .forwarder import check_response, is_retryable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+DEFAULT_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(256 * 1024)))
+DEFAULT_MAX_LATENCY_MS = int(os.getenv("BATCH_MAX_LATENCY_MS", "200"))
+DEFAULT_MAX_PENDING = int(os.getenv("BATCH_MAX_PENDING", "100000"))
+
+BATCHES_SENT = metrics.counter("bridge_batches_total", "Batches flushed, labelled by flush reason and outcome")
+BATCH_ITEMS = metrics.histogram("bridge_batch_items", "Readings per flushed batch", buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+BATCH_BYTES = metrics.histogram("bridge_batch_bytes", "Encoded size of flushed batches", buckets=(1024, 8192, 65536, 262144, 1048576, 4194304))
+BATCH_SEND_SECONDS = metrics.histogram("bridge_batch_send_seconds", "Time to POST one batch to the gateway")
+BATCH_DROPPED = metrics.counter("bridge_batch_readings_dropped_total", "Readings dropped because their batch failed or too many were pending")
+BATCH_JOURNALED = metrics.counter("bridge_batch_readings_journaled_total", "Readings from failed batches, or beyond max_pending, kept in the journal")
+
+
+def batch_endpoint(endpoint):
+    """Default batch URL next to the single-reading endpoint, e.g. /data -> /data/batch."""
+    return os.getenv("HTTP_BATCH_ENDPOINT") or endpoint.rstrip("/") + "/batch"
+
+
+class Batcher:
+    """Collects readings and flushes them as JSON-array POSTs from a background thread."""
+
+    def __init__(self, forwarder, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_latency_ms=DEFAULT_MAX_LATENCY_MS, max_pending=DEFAULT_MAX_PENDING, endpoint=None, journal=None):
+        self.forwarder = forwarder
+        self.journal = journal # Failed batches are kept here for replay, if set
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_pending = max_pending
+        self.endpoint = endpoint or batch_endpoint(forwarder.endpoint)
+
+        self._items = collections.deque()
+        self._size = 2 # Enclosing brackets
+        self._opened_at = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"batcher-{forwarder.source}", daemon=True)
+        self._thread.start()
+
+    def submit(self, payload):
+        """Add one reading (a dict or encoded bytes) to the current batch. Never blocks on the network."""
+        trace = tracing.take(payload, "enqueue") if tracing.active else None
+        encoded = codec.encoded(payload)
+        if trace is not None:
+            trace.mark("serialize")
+            tracing.attach(encoded, trace) # Follows the bytes through the batch
+        self.submit_encoded(encoded)
+
+    def submit_encoded(self, encoded):
+        """Add one reading that is already encoded as a JSON object (bytes)."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batcher is closed")
+            if len(self._items) >= self.max_pending:
+                if self.journal is not None:
+                    self._spill([encoded])
+                    return
+                dropped = self._items.popleft() # Without a journal the newest readings win
+                self._size -= len(dropped) + 1
+                BATCH_DROPPED.inc()
+            opening = not self._items
+            if opening:
+                self._opened_at = time.monotonic()
+            self._items.append(encoded)
+            self._size += len(encoded) + 1
+            # A new batch wakes the thread to start its latency timer
+            if opening or len(self._items) >= self.max_items or self._size >= self.max_bytes:
+                self._cond.notify()
+
+    def _take(self):
+        """Wait until a batch is due and detach it. Returns (items, reason) or (None, None) on close."""
+        with self._cond:
+            while True:
+                if self._items:
+                    if len(self._items) >= self.max_items:
+                        reason = "items"
+                    elif self._size >= self.max_bytes:
+                        reason = "bytes"
+                    elif self._closed:
+                        reason = "close"
+                    elif time.monotonic() - self._opened_at >= self.max_latency:
+                        reason = "time"
+                    else:
+                        self._cond.wait(self.max_latency - (time.monotonic() - self._opened_at))
+                        continue
+                    return self._detach(), reason
+                if self._closed:
+                    return None, None
+                self._cond.wait()
+
+    def _detach(self):
+        """Remove up to max_items / max_bytes worth of readings from the pending list (lock held)."""
+        count, size = 0, 2
+        for encoded in itertools.islice(self._items, self.max_items):
+            if count and size + len(encoded) + 1 > self.max_bytes:
+                break
+            count += 1
+            size += len(encoded) + 1
+        items = [self._items.popleft() for _ in range(count)]
+        self._size -= size - 2
+        # Readings left behind start a new batch window now
+        self._opened_at = time.monotonic() if self._items else None
+        return items
+
+    def _run(self):
+        while True:
+            items, reason = self._take()
+            if items is None:
+                return
+            self._send(items, reason)
+
+    def _send(self, items, reason):
+        traces = None
+        if tracing.active:
+            traces = [(index, trace) for index, trace in enumerate(tracing.take(item, "enqueue") for item in items)
+                      if trace is not None]
+        body = b"[" + b",".join(items) + b"]"
+        BATCH_ITEMS.observe(len(items))
+        BATCH_BYTES.observe(len(body))
+        started = time.monotonic()
+        outcome = "error"
+        retryable = True
+        try:
+            response = self.forwarder.post_body(body, url=self.endpoint, traces=traces)
+            if check_response(response):
+                outcome = "ok"
+            else:
+                retryable = is_retryable(response)
+        except requests.exceptions.Timeout:
+            log.error("Batch post of %d readings timed out to %s", len(items), self.endpoint)
+        except requests.exceptions.RequestException as e:
+            log.error("Batch post error to %s: %s", self.endpoint, e)
+        finally:
+            BATCH_SEND_SECONDS.observe(time.monotonic() - started)
+            BATCHES_SENT.inc(reason=reason, outcome=outcome)
+        if outcome != "ok":
+            if retryable:
+                self._spill(items)
+            else:
+                BATCH_DROPPED.inc(len(items))
+        log.debug("Flushed batch of %d readings (%d bytes, reason=%s, outcome=%s)", len(items), len(body), reason, outcome)
+
+    def _spill(self, items):
+        if self.journal is not None:
+            kept = sum(1 for encoded in items if self.journal.append(encoded))
+            BATCH_JOURNALED.inc(kept)
+            BATCH_DROPPED.inc(len(items) - kept)
+        else:
+            BATCH_DROPPED.inc(len(items))
+
+    def retarget(self, endpoint):
+        """Post to the batch URL next to `endpoint` from the next batch on."""
+        self.endpoint = batch_endpoint(endpoint)
+
+    def close(self, timeout=None):
+        """Flush whatever is pending and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
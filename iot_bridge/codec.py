@@ -0,0 +1,138 @@
+"""
+Pluggable JSON codec for the bridges.
+
+Uses msgspec or orjson when installed (``JSON_CODEC=auto``, the default) and the
+standard library otherwise. Payloads are parsed straight from the received
+``bytes``/``memoryview`` without decoding to ``str`` first, and everything is
+encoded to compact UTF-8 bytes.
+
+``enrich()`` is the fast path for incoming readings: it parses the payload once
+(validating it) and splices the missing envelope fields (``source``, ``topic``,
+``device_id``) into the original bytes instead of re-encoding the whole reading.
+With ``JSON_VALIDATE=true`` readings must be flat objects of scalars, the shape
+the gateway's ``UniversalDataPoint`` parser accepts; msgspec checks this during
+the parse itself.
+"""
+import json
+import os
+from typing import Dict, Union
+
+BACKENDS = ("msgspec", "orjson", "json")
+
+try:
+    import msgspec
+except ImportError: # Optional
+    msgspec = None
+try:
+    import orjson
+except ImportError: # Optional
+    orjson = None
+
+_SCALARS = (str, int, float, bool, type(None))
+
+# Below this size re-encoding with a C backend is cheaper than splicing bytes in Python
+SPLICE_MIN_BYTES = 256
+
+
+class DecodeError(ValueError):
+    """The payload is not valid JSON, not an object, or fails the reading schema."""
+
+
+def _available(backend):
+    return {"msgspec": msgspec, "orjson": orjson, "json": json}[backend] is not None
+
+
+class Codec:
+    """JSON encode/decode using the fastest available backend."""
+
+    def __init__(self, backend="auto", validate=False):
+        if backend == "auto":
+            backend = next(b for b in BACKENDS if _available(b))
+        elif backend not in BACKENDS:
+            raise ValueError(f"Unknown JSON codec {backend!r}, expected one of {BACKENDS} or 'auto'")
+        elif not _available(backend):
+            raise ValueError(f"JSON codec {backend!r} is not installed")
+        self.backend = backend
+        self.validate = validate
+
+        if backend == "msgspec":
+            self._decode = msgspec.json.decode
+            self._dumps = msgspec.json.encode
+        elif backend == "orjson":
+            self._decode = orjson.loads
+            self._dumps = orjson.dumps
+        else:
+            self._decode = json.loads
+            self._dumps = lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf-8")
+        self._decode_reading = self._decode
+        if backend == "msgspec" and validate:
+            # Typed decode: a flat object of scalars, checked during the parse
+            self._decode_reading = msgspec.json.Decoder(Dict[str, Union[str, int, float, bool, None]]).decode
+
+    def loads(self, data):
+        """Parse JSON from bytes, bytearray, memoryview or str."""
+        return self._parse(self._decode, data)
+
+    def _parse(self, decode, data):
+        if self.backend == "json" and isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            return decode(data)
+        except ValueError as e: # All backends' decode errors are ValueErrors
+            raise DecodeError(str(e)) from e
+
+    def dumps(self, obj):
+        """Encode to compact UTF-8 JSON bytes."""
+        return self._dumps(obj)
+
+    def decode_reading(self, data, defaults=None):
+        """Parse a reading (a JSON object) and add `defaults` for missing keys."""
+        reading = self._parse(self._decode_reading, data)
+        if not isinstance(reading, dict):
+            raise DecodeError("Reading is not a JSON object")
+        if self.validate and self.backend != "msgspec":
+            for key, value in reading.items():
+                if not isinstance(value, _SCALARS):
+                    raise DecodeError(f"Field {key!r} is not a scalar")
+        for key, value in (defaults or {}).items():
+            reading.setdefault(key, value)
+        return reading
+
+    def enrich(self, data, defaults):
+        """Return the reading as encoded bytes with `defaults` added for missing keys.
+
+        The payload is parsed once to validate it and find which keys are missing.
+        Those are spliced into the original bytes rather than re-encoding the reading,
+        except for small payloads where a fast backend re-encodes more cheaply.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        reading = self.decode_reading(data, None)
+        missing = {key: value for key, value in defaults.items() if key not in reading}
+        if not missing:
+            return data
+        if b"\n" in data or (len(data) < SPLICE_MIN_BYTES and self.backend != "json"):
+            # Re-encode compactly (this also keeps one reading per line for spill files)
+            reading.update(missing)
+            return self.dumps(reading)
+        start = 1 if data[:1] == b"{" else data.index(b"{") + 1
+        fields = self.dumps(missing)[1:-1]
+        return data[:start] + fields + (b"," if reading else b"") + data[start:]
+
+
+def _codec_from_env():
+    return Codec(os.getenv("JSON_CODEC", "auto"), validate=os.getenv("JSON_VALIDATE", "false").lower() == "true")
+
+
+CODEC = _codec_from_env()
+loads = CODEC.loads
+dumps = CODEC.dumps
+decode_reading = CODEC.decode_reading
+enrich = CODEC.enrich
+
+
+def encoded(payload):
+    """Encoded JSON bytes for a payload that may already be encoded."""
+    return bytes(payload) if isinstance(payload, (bytes, bytearray, memoryview)) else CODEC.dumps(payload)
@@ -0,0 +1,224 @@
+"""
+Declarative bridge configuration, reloaded without restarting.
+
+``BRIDGE_CONFIG`` names a YAML or JSON file describing the pipeline::
+
+    settings:                          # Any of the environment variables in the README
+      HTTP_ENDPOINT: https://go-iot-gateway:8080/data
+      DEADBAND_ABSOLUTE: 0.5
+      AGGREGATE_WINDOW: 60
+    mqtt:
+      topics: ["sensor/+/dht11:1", "plant/#"]
+    coap:
+      observe: ["coap://sensor-1/temperature"]
+    modbus:
+      poll_interval: 5
+      buses:                           # Serial lines, RTU gateways and pipelined TCP gateways
+        line-a: {transport: rtu, serial_port: /dev/ttyUSB0, baudrate: 19200}
+      devices:                         # Register map entries, see modbus/register_map.py
+        - {name: boiler-1, host: 192.168.1.100, unit: 1, points: [{name: temperature, address: 1, scale: 0.1}]}
+
+``settings`` override the process environment; a setting removed from the file
+falls back to the environment again. The runtime watches the file (inotify on
+Linux, modification times elsewhere, and SIGHUP) and applies a change in place:
+MQTT subscriptions, CoAP observations and Modbus pollers are added or removed
+without touching the others, the deadband/aggregation/anomaly/rate-limit stages
+are rebuilt, and a new HTTP endpoint is used for the next request. Queued
+readings stay queued. Settings read only at startup (ports, queue and pool
+sizes, ...) are logged as needing a restart.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# Settings applied in place; anything else needs a restart
+LIVE_PREFIXES = ("DEADBAND_", "AGGREGATE_", "ANOMALY_", "RATE_LIMIT_", "SCHEDULE_RULES", "SCHEDULE_DEFAULT_CLASS",
+                 "HTTP_ENDPOINT", "HTTP_BATCH_ENDPOINT", "HTTP_STREAM_ENDPOINT", "MQTT_TOPIC", "MQTT_QOS", "COAP_OBSERVE",
+                 "MODBUS_REGISTER_MAP", "POLL_INTERVAL")
+
+_IN_EVENTS = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 # CLOSE_WRITE, MOVED_FROM, MOVED_TO, CREATE, DELETE
+
+
+def load_config(path):
+    """Parse a config file: JSON for .json, YAML otherwise (requires PyYAML)."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".json"):
+        data = json.loads(raw)
+    else:
+        import yaml
+        data = yaml.safe_load(raw)
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected a mapping at the top level")
+    return data, hashlib.sha256(raw).hexdigest()
+
+
+class BridgeConfig:
+    """The current contents of the config file and the environment it was applied on top of."""
+
+    def __init__(self, path):
+        self.path = path
+        self.base_env = dict(os.environ) # Before any settings were applied
+        self.data = {}
+        self.digest = None
+        self.settings = {}
+
+    def section(self, name):
+        """The `name` section (e.g. "mqtt"), or an empty dict."""
+        return self.data.get(name) or {}
+
+    def load(self):
+        """Read the file and apply its settings to os.environ; return the names of settings that changed.
+
+        After the first load, settings that only take effect on a restart are
+        reported but left out of os.environ, so code reading the environment
+        keeps seeing what the running bridge was built with. Returns None when
+        the file is unchanged. Raises ValueError when it cannot be read or
+        parsed; the previous configuration then stays in effect.
+        """
+        try:
+            data, digest = load_config(self.path)
+        except ValueError:
+            raise
+        except Exception as e: # OSError, yaml.YAMLError
+            raise ValueError(f"{self.path}: {e}") from e
+        if digest == self.digest:
+            return None
+        settings = {str(k): _env_value(v) for k, v in (data.get("settings") or {}).items()}
+        changed = {name for name in set(settings) | set(self.settings) if settings.get(name) != self.settings.get(name)}
+        deferred = set(needs_restart(changed)) if self.digest is not None else set()
+        for name in changed - deferred:
+            if name in settings:
+                os.environ[name] = settings[name]
+            elif name in self.base_env:
+                os.environ[name] = self.base_env[name]
+            else:
+                os.environ.pop(name, None)
+        self.data, self.digest, self.settings = data, digest, settings
+        return changed
+
+
+def _env_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def needs_restart(changed):
+    """The changed settings that only take effect after a restart."""
+    return sorted(name for name in changed if not name.startswith(LIVE_PREFIXES))
+
+
+def open_config_from_env():
+    """Load BRIDGE_CONFIG into the environment; None when it is not set."""
+    path = os.getenv("BRIDGE_CONFIG")
+    if not path:
+        return None
+    config = BridgeConfig(path)
+    config.load()
+    log.info("Loaded bridge configuration from %s (%d settings)", path, len(config.settings))
+    return config
+
+
+class ConfigWatcher:
+    """Calls `on_change()` (a coroutine function) when the config file may have changed.
+
+    Watches the file's directory with inotify, which also sees editors that
+    replace the file and Kubernetes ConfigMap symlink swaps; without inotify the
+    modification time is polled every `poll_interval` seconds.
+    """
+
+    def __init__(self, path, on_change, poll_interval=2.0, debounce=0.2):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._fd = None
+        self._pending = None
+        self._again = False
+        self._task = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._fd = _inotify_watch(os.path.dirname(self.path))
+        if self._fd is not None:
+            loop.add_reader(self._fd, self._on_events)
+            log.info("Watching %s for changes (inotify)", self.path)
+        else:
+            self._task = asyncio.create_task(self._poll())
+            log.info("Watching %s for changes (every %.0f seconds)", self.path, self.poll_interval)
+
+    def _on_events(self):
+        try:
+            os.read(self._fd, 64 * 1024) # Any event in the directory: check the file after a pause
+        except BlockingIOError:
+            return
+        self._again = True
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._fire())
+
+    async def _fire(self):
+        while self._again: # Also catches writes made while a change was being applied
+            await asyncio.sleep(self.debounce) # Let the writer finish
+            self._again = False
+            try:
+                await self.on_change()
+            except Exception as e:
+                log.exception("Error applying configuration change: %s", e)
+
+    async def _poll(self):
+        last = _stat(self.path)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = _stat(self.path)
+            if current != last:
+                last = current
+                try:
+                    await self.on_change()
+                except Exception as e:
+                    log.exception("Error applying configuration change: %s", e)
+
+    def stop(self):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        for task in (self._task, self._pending):
+            if task is not None:
+                task.cancel()
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+    except OSError:
+        return None
+
+
+def _inotify_watch(directory):
+    """A non-blocking inotify descriptor watching `directory`, or None where inotify is unavailable."""
+    if not hasattr(os, "O_NONBLOCK"):
+        return None
+    library = ctypes.util.find_library("c")
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_EVENTS) < 0:
+        log.warning("Cannot watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
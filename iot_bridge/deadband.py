@@ -0,0 +1,210 @@
+"""
+Report-by-exception filtering of readings before they are forwarded.
+
+A ``DeadbandFilter`` keeps the last published value of every (device, metric)
+and drops numeric metrics that have not moved enough to be worth sending:
+
+- ``absolute``: publish when the value moved more than this from the last published one
+- ``percent``: publish when it moved more than this percentage of the last published one
+- ``min_interval``: never publish a metric more often than this (seconds)
+- ``max_interval``: always publish after this long, as a heartbeat (seconds)
+- ``swinging_door``: compression deviation for swinging-door trending; when set it
+  replaces the deadband test and emits the turning points of the signal, each with
+  its own timestamp
+
+With no band configured, a metric is published whenever its value changes.
+Non-numeric fields (device_id, source, topic, ...) are passed through; a reading
+whose numeric metrics were all suppressed is dropped entirely.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+FILTER_VALUES = metrics.counter("bridge_filter_values_total", "Numeric values seen by the deadband filter, by outcome")
+FILTER_READINGS = metrics.counter("bridge_filter_readings_total", "Readings seen by the deadband filter, by outcome")
+FILTER_RATIO = metrics.gauge("bridge_filter_suppression_ratio", "Share of numeric values suppressed by the deadband filter")
+FILTER_ENTRIES = metrics.gauge("bridge_filter_entries", "Entries in the deadband filter's last-value table")
+
+_ID_FIELDS = ("device_id", "sensor_id", "topic")
+
+
+class DeadbandRule:
+    """Filter settings for one metric name (or the default for all)."""
+
+    def __init__(self, absolute=None, percent=None, min_interval=0.0, max_interval=None, swinging_door=None):
+        self.absolute = absolute
+        self.percent = percent
+        self.min_interval = min_interval or 0.0
+        self.max_interval = max_interval
+        self.swinging_door = swinging_door
+
+    def exceeded(self, value, last):
+        """Whether `value` moved far enough from the last published value."""
+        if self.absolute is None and self.percent is None:
+            return value != last
+        change = abs(value - last)
+        if self.absolute is not None and change > self.absolute:
+            return True
+        return self.percent is not None and change > abs(last) * self.percent / 100.0
+
+
+class _State:
+    """Last-value table entry; also holds the swinging-door corridor."""
+    __slots__ = ("value", "time", "published_at", "held_value", "held_time", "upper", "lower")
+
+    def __init__(self, value, at):
+        self.value = value # Last published (archived) value
+        self.time = at # ...and its timestamp
+        self.published_at = at
+        self.held_value = None # Latest suppressed value (swinging door)
+        self.held_time = None
+        self.upper = float("inf")
+        self.lower = float("-inf")
+
+
+class DeadbandFilter:
+    """Per (device, metric) report-by-exception filter shared by the bridges."""
+
+    def __init__(self, default=None, rules=None, max_entries=100000):
+        self.default = default or DeadbandRule()
+        self.rules = rules or {}
+        self.max_entries = max_entries
+        self._table = {}
+        self._lock = threading.Lock()
+        self._seen = 0
+        self._suppressed = 0
+
+    def apply(self, payload):
+        """Return the list of payloads to forward for `payload` (possibly empty).
+
+        The first element, if any, is `payload` with suppressed metrics removed;
+        swinging-door compression may add earlier turning points with their own
+        timestamps.
+        """
+        device = next((str(payload[f]) for f in _ID_FIELDS if f in payload), "")
+        timestamp = payload.get("timestamp")
+        now = timestamp if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool) else time.time()
+        out = dict(payload)
+        numeric, kept, extra = 0, 0, []
+        with self._lock:
+            for name, value in payload.items():
+                if name == "timestamp" or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                numeric += 1
+                publish, turning_point = self._check(device, name, value, now)
+                if turning_point is not None:
+                    extra.append(turning_point)
+                if publish:
+                    kept += 1
+                else:
+                    del out[name]
+            self._seen += numeric
+            self._suppressed += numeric - kept - len(extra) # Turning points were counted when held
+            if self._seen:
+                FILTER_RATIO.set(self._suppressed / self._seen)
+            FILTER_ENTRIES.set(len(self._table))
+
+        results = [out] if kept or not numeric else []
+        FILTER_READINGS.inc(outcome="forwarded" if results else "suppressed")
+        for name, (at, value) in extra:
+            point = {f: payload[f] for f in ("device_id", "sensor_id", "source", "topic") if f in payload}
+            point["timestamp"] = at
+            point[name] = value
+            results.append(point)
+        return results
+
+    def _check(self, device, name, value, now):
+        """Return (publish, (name, (time, value)) or None) for one value (lock held)."""
+        rule = self.rules.get(name, self.default)
+        key = (device, name)
+        state = self._table.get(key)
+        if state is None:
+            if len(self._table) >= self.max_entries:
+                # Drop the oldest quarter of the table; those series restart with a publish
+                for stale in list(self._table)[:self.max_entries // 4 or 1]:
+                    del self._table[stale]
+            self._table[key] = _State(value, now)
+            FILTER_VALUES.inc(outcome="first")
+            return True, None
+
+        elapsed = now - state.published_at
+        if rule.max_interval and elapsed >= rule.max_interval:
+            self._archive(state, value, now)
+            FILTER_VALUES.inc(outcome="heartbeat")
+            return True, None
+        if elapsed < rule.min_interval:
+            FILTER_VALUES.inc(outcome="suppressed")
+            return False, None
+        if rule.swinging_door is not None:
+            return self._swinging_door(state, rule.swinging_door, name, value, now)
+        if rule.exceeded(value, state.value):
+            self._archive(state, value, now)
+            FILTER_VALUES.inc(outcome="published")
+            return True, None
+        FILTER_VALUES.inc(outcome="suppressed")
+        return False, None
+
+    def _swinging_door(self, state, deviation, name, value, now):
+        span = now - state.time
+        if span <= 0:
+            FILTER_VALUES.inc(outcome="suppressed")
+            return False, None
+        upper = min(state.upper, (value + deviation - state.value) / span)
+        lower = max(state.lower, (value - deviation - state.value) / span)
+        if lower <= upper:
+            # Still inside the corridor: hold the value
+            state.upper, state.lower = upper, lower
+            state.held_value, state.held_time = value, now
+            FILTER_VALUES.inc(outcome="suppressed")
+            return False, None
+
+        # Door closed: the held value is a turning point; restart the corridor from it
+        turning_point = None
+        if state.held_time is not None:
+            turning_point = (name, (state.held_time, state.held_value))
+            state.value, state.time = state.held_value, state.held_time
+            span = now - state.time
+            state.upper = (value + deviation - state.value) / span
+            state.lower = (value - deviation - state.value) / span
+        state.held_value, state.held_time = value, now
+        state.published_at = now
+        FILTER_VALUES.inc(outcome="compressed")
+        return False, turning_point
+
+    def _archive(self, state, value, now):
+        state.value, state.time, state.published_at = value, now, now
+        state.held_value = state.held_time = None
+        state.upper, state.lower = float("inf"), float("-inf")
+
+
+def _optional_float(name):
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else None
+
+
+def open_filter_from_env():
+    """Build the filter configured by DEADBAND_* variables; None when none is set."""
+    settings = {
+        "absolute": _optional_float("DEADBAND_ABSOLUTE"),
+        "percent": _optional_float("DEADBAND_PERCENT"),
+        "min_interval": _optional_float("DEADBAND_MIN_INTERVAL"),
+        "max_interval": _optional_float("DEADBAND_MAX_INTERVAL"),
+        "swinging_door": _optional_float("DEADBAND_SWINGING_DOOR"),
+    }
+    rules_path = os.getenv("DEADBAND_RULES") # JSON object of metric name -> settings
+    enabled = os.getenv("DEADBAND_ENABLED", "false").lower() == "true" # Publish on any change
+    if not enabled and not rules_path and all(v is None for v in settings.values()):
+        return None
+    default = DeadbandRule(**settings)
+    rules = {}
+    if rules_path:
+        with open(rules_path) as f:
+            rules = {name: DeadbandRule(**settings) for name, settings in json.load(f).items()}
+    log.info("Deadband filter enabled (%d per-metric rules)", len(rules))
+    return DeadbandFilter(default, rules)
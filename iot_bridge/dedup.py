@@ -0,0 +1,56 @@
+"""
+Time-bounded duplicate suppression for requests that clients may resend.
+
+A ``DedupCache`` remembers recently seen request keys for ``ttl`` seconds and
+at most ``max_entries`` of them; the oldest entries are evicted first, so its
+memory stays bounded however many distinct requests arrive. Callers store the
+task handling the first request under its key, so a duplicate that arrives while
+the original is still being handled can wait for it and give the same answer.
+"""
+import collections
+import time
+
+from . import metrics
+
+DEDUP_REQUESTS = metrics.counter("bridge_dedup_requests_total", "Requests checked against the dedup cache, by outcome (hit/miss)")
+DEDUP_ENTRIES = metrics.gauge("bridge_dedup_entries", "Entries in the dedup cache")
+
+
+class DedupCache:
+    """Recently seen request keys, each with a value such as the task handling it."""
+
+    def __init__(self, ttl=30.0, max_entries=100000, name="coap"):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.name = name
+        self._entries = collections.OrderedDict() # key -> (expires_at, value), oldest first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The value stored for `key` within the TTL, else None."""
+        self._expire(time.monotonic())
+        entry = self._entries.get(key)
+        DEDUP_REQUESTS.inc(cache=self.name, outcome="hit" if entry is not None else "miss")
+        return entry[1] if entry is not None else None
+
+    def add(self, key, value):
+        """Remember `key` (with `value`) for the TTL, evicting the oldest entry when full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        DEDUP_ENTRIES.set(len(self._entries), cache=self.name)
+
+    def forget(self, key):
+        """Drop `key`, so a resend is handled again (e.g. after the original failed)."""
+        self._entries.pop(key, None)
+        DEDUP_ENTRIES.set(len(self._entries), cache=self.name)
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            key, (expires_at, _) = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            del entries[key]
@@ -0,0 +1,327 @@
+"""
+Shared HTTP forwarding engine for the protocol bridges.
+
+Every bridge posts its readings to the Go gateway through a ``Forwarder``.
+It holds one ``requests.Session`` backed by a bounded pool of keep-alive
+connections, so TCP connections are reused across messages and new
+connections resume the previous TLS session instead of doing a full handshake.
+
+Coroutines post through an ``AsyncForwarder`` instead when aiohttp is installed:
+requests run natively on the event loop, with one cap on requests in flight
+shared by every source, rather than on a thread pool.
+
+Both pass request bodies through a ``BodyEncoder`` (wire.py), which may
+compress them or re-encode them as a binary envelope.
+"""
+import asyncio
+import copy
+import logging
+import os
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import codec, metrics, tracing
+from .logsampling import SampledLogger
+from .wire import BodyEncoder
+
+try:
+    import aiohttp
+except ImportError: # Optional; coroutines use Forwarder.post_async's thread pool without it
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "4"))
+DEFAULT_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("HTTP_MAX_IN_FLIGHT", "64"))
+
+REQUESTS_SENT = metrics.counter("bridge_http_requests_total", "HTTP requests sent to the gateway")
+CONNECTIONS_OPENED = metrics.counter("bridge_http_connections_opened_total", "New connections opened to the gateway")
+TLS_HANDSHAKES = metrics.counter("bridge_tls_handshakes_total", "TLS handshakes, labelled by session resumption")
+IN_FLIGHT = metrics.gauge("bridge_http_in_flight", "Requests from the async client waiting on the gateway")
+HTTP_RESPONSES = metrics.counter("bridge_http_responses_total", "Gateway responses by source and status (or timeout/error)")
+HTTP_SECONDS = metrics.histogram("bridge_http_request_seconds", "Time from sending a request to the gateway to its response, by source")
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        CONNECTIONS_OPENED.inc(scheme="http")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        CONNECTIONS_OPENED.inc(scheme="https")
+        return super()._new_conn()
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+    """SSLContext that offers the last negotiated session on every new connection."""
+
+    def __init__(self, protocol=None):
+        self._resume_lock = threading.Lock()
+        self._resume_session = None
+        self._last_sock = None
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        with self._resume_lock:
+            # TLS 1.3 tickets arrive after the handshake, so read the session
+            # from the previous socket as late as possible.
+            if self._last_sock is not None and self._last_sock.session is not None:
+                self._resume_session = self._last_sock.session
+            if session is None:
+                session = self._resume_session
+        ssl_sock = super().wrap_socket(sock, *args, session=session, **kwargs)
+        TLS_HANDSHAKES.inc(resumed="true" if ssl_sock.session_reused else "false")
+        with self._resume_lock:
+            self._last_sock = ssl_sock
+        return ssl_sock
+
+
+def _build_ssl_context(verify_ssl):
+    context = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if verify_ssl:
+        context.load_verify_locations(cafile=requests.certs.where())
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _PooledAdapter(HTTPAdapter):
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs["ssl_context"] = self._ssl_context
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def default_verify_ssl(endpoint):
+    """The bundled gateway uses a self-signed certificate, so skip verification for it."""
+    return "go-iot-gateway" not in endpoint
+
+
+class Forwarder:
+    """Posts readings to the gateway over a bounded pool of persistent connections."""
+
+    def __init__(self, endpoint, api_key, source, verify_ssl=None, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 encoder=None):
+        self.endpoint = endpoint
+        self.source = source
+        self.verify_ssl = default_verify_ssl(endpoint) if verify_ssl is None else verify_ssl
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.encoder = encoder or BodyEncoder() # Plain JSON by default
+
+        if not self.verify_ssl:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        # pool_block keeps the number of open connections at pool_size;
+        # extra callers wait for a free connection instead of opening one.
+        adapter = _PooledAdapter(
+            _build_ssl_context(self.verify_ssl),
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=0,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "X-API-Key": api_key,
+        })
+        self._source_header = {"X-Source-Identifier": source}
+        # Threads are only started on first use
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="forward")
+
+    def for_source(self, source):
+        """A forwarder for another source that shares this one's connections and thread pool."""
+        view = copy.copy(self)
+        view.source = source
+        view._source_header = {"X-Source-Identifier": source}
+        return view
+
+    def post(self, payload, **kwargs):
+        """POST a reading (a dict, or already-encoded JSON bytes) and return the response."""
+        return self.post_body(codec.encoded(payload), **kwargs)
+
+    def post_body(self, body, url=None, traces=None, **kwargs):
+        """POST an already-encoded JSON body (bytes) and return the response.
+
+        `traces` are the (index, Trace) pairs of traced readings in the body; they
+        end once the gateway answers.
+        """
+        body, headers = self.encoder.encode(body)
+        if traces:
+            headers = tracing.request_headers(traces, headers)
+        REQUESTS_SENT.inc(source=self.source)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.post(url or self.endpoint, data=body, headers=dict(self._source_header, **headers),
+                                         verify=self.verify_ssl, timeout=self.timeout, **kwargs)
+            status = response.status_code
+            return response
+        except requests.exceptions.Timeout:
+            status = "timeout"
+            raise
+        finally:
+            HTTP_SECONDS.observe(time.perf_counter() - started, source=self.source)
+            HTTP_RESPONSES.inc(source=self.source, status=status)
+            if traces:
+                tracing.finish(traces, "send", status)
+
+    async def post_async(self, payload, **kwargs):
+        """Run post() on the forwarder's own thread pool, sized to the connection pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self.post(payload, **kwargs))
+
+    def stats(self):
+        """Connection reuse and TLS handshake counters for this process."""
+        requests_sent = REQUESTS_SENT.total()
+        opened = CONNECTIONS_OPENED.total()
+        return {
+            "requests": requests_sent,
+            "connections_opened": opened,
+            "connections_reused": max(requests_sent - opened, 0),
+            "tls_handshakes_full": TLS_HANDSHAKES.value(resumed="false"),
+            "tls_handshakes_resumed": TLS_HANDSHAKES.value(resumed="true"),
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+class AsyncResponse:
+    """A gateway response read in full, with the attributes check_response() uses."""
+    __slots__ = ("status_code", "reason", "text")
+
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+
+class _AsyncPool:
+    """aiohttp session and in-flight limit shared by an AsyncForwarder and its source views."""
+
+    def __init__(self, verify_ssl, max_in_flight):
+        self.verify_ssl = verify_ssl
+        self.max_in_flight = max_in_flight
+        self.limit = asyncio.Semaphore(max_in_flight)
+        self.session = None
+
+    def get(self):
+        # Created on first use: an aiohttp session belongs to the running loop
+        if self.session is None:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._connection_opened)
+            ssl_context = ssl.create_default_context(cafile=requests.certs.where()) if self.verify_ssl else False
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=ssl_context)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self.session
+
+    async def _connection_opened(self, session, context, params):
+        CONNECTIONS_OPENED.inc(scheme="async")
+
+
+class AsyncForwarder:
+    """Posts readings from coroutines with aiohttp, at most `max_in_flight` at a time.
+
+    Timeouts and connection errors are raised as the matching requests
+    exceptions, so callers handle both forwarders alike.
+    """
+
+    def __init__(self, endpoint, api_key, source, verify_ssl=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, timeout=DEFAULT_TIMEOUT,
+                 encoder=None):
+        if aiohttp is None:
+            raise RuntimeError("AsyncForwarder requires aiohttp")
+        self.endpoint = endpoint
+        self.source = source
+        self.verify_ssl = default_verify_ssl(endpoint) if verify_ssl is None else verify_ssl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.encoder = encoder or BodyEncoder()
+        self._headers = {"Content-Type": "application/json", "X-API-Key": api_key, "X-Source-Identifier": source}
+        self._pool = _AsyncPool(self.verify_ssl, max_in_flight)
+
+    def for_source(self, source):
+        """A forwarder for another source that shares this one's session and in-flight limit."""
+        view = copy.copy(self)
+        view.source = source
+        view._headers = dict(self._headers, **{"X-Source-Identifier": source})
+        return view
+
+    async def post(self, payload, traces=None):
+        """POST a reading (a dict, or already-encoded JSON bytes) and return the response."""
+        return await self.post_body(codec.encoded(payload), traces=traces)
+
+    async def post_body(self, body, url=None, traces=None):
+        """POST an already-encoded JSON body, waiting for a free slot first.
+
+        `traces` are the (index, Trace) pairs of traced readings in the body.
+        """
+        body, headers = self.encoder.encode(body)
+        headers = dict(self._headers, **headers) if headers else self._headers
+        if traces:
+            headers = tracing.request_headers(traces, headers)
+        async with self._pool.limit:
+            REQUESTS_SENT.inc(source=self.source)
+            IN_FLIGHT.inc()
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with self._pool.get().post(url or self.endpoint, data=body, headers=headers,
+                                                 timeout=self.timeout) as response:
+                    status = response.status
+                    return AsyncResponse(response.status, response.reason, await response.text())
+            except asyncio.TimeoutError as e:
+                status = "timeout"
+                raise requests.exceptions.Timeout(f"Timed out posting to {url or self.endpoint}") from e
+            except aiohttp.ClientError as e:
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            finally:
+                IN_FLIGHT.dec()
+                HTTP_SECONDS.observe(time.perf_counter() - started, source=self.source)
+                HTTP_RESPONSES.inc(source=self.source, status=status)
+                if traces:
+                    tracing.finish(traces, "send", status)
+
+    async def close(self):
+        if self._pool.session is not None:
+            await self._pool.session.close()
+
+
+def check_response(response):
+    """Log gateway errors for a response; return True on 2xx."""
+    if 200 <= response.status_code < 300:
+        return True
+    # Sampled: during a gateway outage every reading fails the same way
+    if response.status_code == 403:
+        sampled_log.error("HTTP Error 403: Forbidden. Check GATEWAY_API_KEY.")
+    elif response.status_code == 400:
+        sampled_log.error("HTTP Error 400: Bad Request. Check payload format. Response: %s", response.text)
+    else:
+        sampled_log.error("HTTP Error %d: %s", response.status_code, response.text)
+    return False
+
+
+def is_retryable(response):
+    """Whether a failed response is worth retrying later (gateway overloaded or down)."""
+    return response.status_code >= 500 or response.status_code == 429
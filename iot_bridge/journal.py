@@ -0,0 +1,306 @@
+"""
+Durable store-and-forward journal for readings the gateway could not accept.
+
+Readings are appended as length-prefixed, CRC-checked records to fixed-size,
+memory-mapped segment files in a directory. A checkpoint file records the
+read position of the last replayed batch, so a restarted bridge resumes
+replay where it left off. Fully replayed segments are deleted. When the
+journal would exceed `max_bytes`, the eviction policy either deletes the
+oldest segment (``drop_oldest``) or refuses new records (``reject``).
+
+A ``JournalReplayer`` drains the journal in batches to the gateway's batch
+endpoint at a bounded rate, backing off while the gateway keeps failing.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import requests
+
+from . import codec, metrics
+from .batching import batch_endpoint
+
+log = logging.getLogger(__name__)
+
+EVICTION_POLICIES = ("drop_oldest", "reject")
+
+_HEADER = struct.Struct("<II") # record length, crc32
+_CHECKPOINT = struct.Struct("<QQQ") # segment id, byte offset, record index
+_SEGMENT_SUFFIX = ".seg"
+
+JOURNAL_APPENDED = metrics.counter("bridge_journal_appended_total", "Readings written to the journal")
+JOURNAL_REPLAYED = metrics.counter("bridge_journal_replayed_total", "Readings replayed from the journal to the gateway")
+JOURNAL_EVICTED = metrics.counter("bridge_journal_evicted_total", "Readings lost to the journal size cap, by policy")
+JOURNAL_PENDING = metrics.gauge("bridge_journal_pending", "Readings waiting in the journal")
+JOURNAL_BYTES = metrics.gauge("bridge_journal_bytes", "Disk space used by journal segments")
+
+
+class _Segment:
+    def __init__(self, path, size, create=False):
+        self.path = path
+        mode = "w+b" if create else "r+b"
+        self.file = open(path, mode)
+        if create:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.records = 0
+        self.write_offset = 0
+
+    def scan(self):
+        """Find the end of valid data and count records (used when reopening)."""
+        offset, records = 0, 0
+        size = len(self.map)
+        while offset + _HEADER.size <= size:
+            length, crc = _HEADER.unpack_from(self.map, offset)
+            end = offset + _HEADER.size + length
+            if length == 0 or end > size or zlib.crc32(self.map[offset + _HEADER.size:end]) != crc:
+                break
+            offset, records = end, records + 1
+        self.write_offset, self.records = offset, records
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Journal:
+    """Append-only, segment-based journal with a checkpointed read position."""
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=512 * 1024 * 1024, eviction="drop_oldest"):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {eviction!r}, expected one of {EVICTION_POLICIES}")
+        if max_bytes < 2 * segment_bytes:
+            raise ValueError("max_bytes must allow at least two segments")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self._lock = threading.Lock()
+        self._segments = {}
+        os.makedirs(directory, exist_ok=True)
+        self._checkpoint_path = os.path.join(directory, "checkpoint")
+        self._recover()
+
+    # --- Recovery ---
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:020d}{_SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        ids = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+        for segment_id in ids:
+            segment = _Segment(self._segment_path(segment_id), self.segment_bytes)
+            segment.scan()
+            self._segments[segment_id] = segment
+        if not self._segments:
+            self._segments[1] = _Segment(self._segment_path(1), self.segment_bytes, create=True)
+
+        first = min(self._segments)
+        self._read = (first, 0, 0)
+        if os.path.exists(self._checkpoint_path):
+            with open(self._checkpoint_path, "rb") as f:
+                data = f.read()
+            if len(data) == _CHECKPOINT.size:
+                segment_id, offset, index = _CHECKPOINT.unpack(data)
+                if segment_id in self._segments:
+                    self._read = (segment_id, offset, index)
+        self._write_id = max(self._segments)
+        self._update_gauges()
+        if self.pending():
+            log.info("Journal %s reopened with %d readings pending replay", self.directory, self.pending())
+
+    # --- Writing ---
+
+    def append(self, record):
+        """Append one encoded reading (bytes). Returns False if rejected by the size cap."""
+        if not record:
+            raise ValueError("Cannot journal an empty record")
+        needed = _HEADER.size + len(record)
+        if needed > self.segment_bytes:
+            raise ValueError(f"Record of {len(record)} bytes does not fit in a {self.segment_bytes}-byte segment")
+        with self._lock:
+            segment = self._segments[self._write_id]
+            if segment.write_offset + needed > self.segment_bytes:
+                if not self._roll():
+                    JOURNAL_EVICTED.inc(policy="reject")
+                    return False
+                segment = self._segments[self._write_id]
+            offset = segment.write_offset
+            _HEADER.pack_into(segment.map, offset, len(record), zlib.crc32(record))
+            segment.map[offset + _HEADER.size:offset + needed] = record
+            segment.write_offset += needed
+            segment.records += 1
+            JOURNAL_APPENDED.inc()
+            self._update_gauges()
+            return True
+
+    def append_json(self, payload):
+        """Append a reading given as a dict or as already-encoded JSON bytes."""
+        return self.append(codec.encoded(payload))
+
+    def _roll(self):
+        """Seal the current segment and open the next one, evicting if over the cap (lock held)."""
+        if (len(self._segments) + 1) * self.segment_bytes > self.max_bytes:
+            if self.eviction == "reject":
+                return False
+            self._evict_oldest()
+        self._segments[self._write_id].map.flush()
+        self._write_id += 1
+        self._segments[self._write_id] = _Segment(self._segment_path(self._write_id), self.segment_bytes, create=True)
+        return True
+
+    def _evict_oldest(self):
+        oldest = min(self._segments)
+        segment = self._segments.pop(oldest)
+        lost = segment.records
+        if self._read[0] == oldest:
+            lost -= self._read[2]
+            self._read = (min(self._segments), 0, 0)
+            self._write_checkpoint()
+        segment.close()
+        os.remove(segment.path)
+        JOURNAL_EVICTED.inc(lost, policy="drop_oldest")
+        log.warning("Journal size cap reached; evicted segment %d with %d unreplayed readings", oldest, lost)
+
+    # --- Reading ---
+
+    def read_batch(self, max_records):
+        """Return (records, position) for up to `max_records` of the oldest unreplayed readings.
+
+        Records stay in the journal until commit(position) is called.
+        """
+        records = []
+        with self._lock:
+            segment_id, offset, index = self._read
+            while len(records) < max_records:
+                segment = self._segments.get(segment_id)
+                if segment is None:
+                    break
+                if offset >= segment.write_offset:
+                    if segment_id >= self._write_id:
+                        break
+                    segment_id, offset, index = segment_id + 1, 0, 0
+                    continue
+                length, _ = _HEADER.unpack_from(segment.map, offset)
+                start = offset + _HEADER.size
+                records.append(segment.map[start:start + length])
+                offset, index = start + length, index + 1
+        return records, (segment_id, offset, index)
+
+    def commit(self, position):
+        """Mark everything before `position` as replayed and delete finished segments."""
+        with self._lock:
+            if position[0] not in self._segments:
+                return # Segment was evicted while the batch was in flight
+            self._read = position
+            self._write_checkpoint()
+            for segment_id in [s for s in self._segments if s < position[0]]:
+                segment = self._segments.pop(segment_id)
+                segment.close()
+                os.remove(segment.path)
+            self._update_gauges()
+
+    def _write_checkpoint(self):
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_CHECKPOINT.pack(*self._read))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def pending(self):
+        """Number of readings not yet replayed."""
+        total = sum(segment.records for segment_id, segment in self._segments.items() if segment_id >= self._read[0])
+        return total - self._read[2]
+
+    def _update_gauges(self):
+        JOURNAL_PENDING.set(self.pending())
+        JOURNAL_BYTES.set(len(self._segments) * self.segment_bytes)
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.map.flush()
+                segment.close()
+            self._segments.clear()
+
+
+class JournalReplayer:
+    """Replays journaled readings to the gateway in batches at a bounded rate."""
+
+    def __init__(self, journal, forwarder, batch_size=500, rate=2000.0, max_backoff=60.0, endpoint=None):
+        self.journal = journal
+        self.forwarder = forwarder
+        self.batch_size = batch_size
+        self.rate = rate # Readings per second
+        self.max_backoff = max_backoff
+        self.endpoint = endpoint or batch_endpoint(forwarder.endpoint)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="journal-replayer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stopping.is_set():
+            records, position = self.journal.read_batch(self.batch_size)
+            if not records:
+                self._stopping.wait(1.0)
+                continue
+            started = time.monotonic()
+            if self._send(records):
+                self.journal.commit(position)
+                JOURNAL_REPLAYED.inc(len(records))
+                backoff = 1.0
+                # Pace replay so a recovering gateway is not flooded
+                self._stopping.wait(max(len(records) / self.rate - (time.monotonic() - started), 0))
+            else:
+                log.warning("Journal replay failed; %d readings pending, retrying in %.0fs", self.journal.pending(), backoff)
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _send(self, records):
+        body = b"[" + b",".join(records) + b"]"
+        try:
+            response = self.forwarder.post_body(body, url=self.endpoint)
+        except requests.exceptions.RequestException as e:
+            log.debug("Journal replay post error: %s", e)
+            return False
+        if response.status_code == 400:
+            # The gateway will never accept these; drop them rather than block replay forever
+            log.error("Gateway rejected %d journaled readings as malformed; discarding them", len(records))
+            return True
+        return 200 <= response.status_code < 300
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._thread.join(timeout)
+
+
+def open_journal_from_env(forwarder, name=None):
+    """Open the journal configured by JOURNAL_DIR and start replaying it; None when unset.
+
+    `name` selects a subdirectory, so each source keeps its own journal.
+    """
+    directory = os.getenv("JOURNAL_DIR")
+    if not directory:
+        return None
+    if name:
+        directory = os.path.join(directory, name)
+    journal = Journal(
+        directory,
+        segment_bytes=int(os.getenv("JOURNAL_SEGMENT_BYTES", str(16 * 1024 * 1024))),
+        max_bytes=int(os.getenv("JOURNAL_MAX_BYTES", str(512 * 1024 * 1024))),
+        eviction=os.getenv("JOURNAL_EVICTION", "drop_oldest"),
+    )
+    journal.replayer = JournalReplayer(
+        journal,
+        forwarder,
+        batch_size=int(os.getenv("JOURNAL_REPLAY_BATCH", "500")),
+        rate=float(os.getenv("JOURNAL_REPLAY_RATE", "2000")),
+    )
+    log.info("Store-and-forward journal enabled at %s", directory)
+    return journal
@@ -0,0 +1,57 @@
+"""
+Rate-limited logging for per-message log lines.
+
+At thousands of messages per second, one INFO line per message costs more
+than forwarding the message. A ``SampledLogger`` emits each distinct log call
+(same level and format string) at most once per ``LOG_SAMPLE_INTERVAL``
+seconds and notes how many were suppressed in between. Counts belong in
+metrics; these lines only show that traffic is flowing and what it looks like.
+"""
+import logging
+import os
+import threading
+import time
+
+DEFAULT_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", "10")) # Seconds, 0 logs every call
+
+
+class SampledLogger:
+    """Wraps a logger; each (level, format) pair logs at most once per interval."""
+
+    def __init__(self, logger, interval=DEFAULT_INTERVAL):
+        self.logger = logger
+        self.interval = interval
+        self._next = {} # (level, msg) -> [next allowed time, suppressed since]
+        self._lock = threading.Lock()
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.interval <= 0:
+            self.logger.log(level, msg, *args, stacklevel=3)
+            return
+        now = time.monotonic()
+        key = (level, msg)
+        with self._lock:
+            entry = self._next.get(key)
+            if entry is not None and now < entry[0]:
+                entry[1] += 1
+                return
+            suppressed = entry[1] if entry is not None else 0
+            self._next[key] = [now + self.interval, 0]
+        if suppressed:
+            self.logger.log(level, msg + " (%d similar messages suppressed)", *args, suppressed, stacklevel=3)
+        else:
+            self.logger.log(level, msg, *args, stacklevel=3)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
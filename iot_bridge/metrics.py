@@ -0,0 +1,305 @@
+"""
+In-process metrics shared by the protocol bridges.
+
+Counters, gauges and histograms are kept per label set and can be read back
+with ``snapshot()``, logged periodically with ``start_log_reporter()``, or
+scraped in the Prometheus text format from ``start_http_server()``.
+
+Counters and histograms sit on hot paths (every message), so they take no
+lock: each thread updates its own shard and readers add the shards up.
+"""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Metric:
+    type_name = "untyped"
+
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Return a list of (labels_dict, value) pairs."""
+        with self._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def total(self):
+        """Sum of the metric across all label sets."""
+        with self._lock:
+            return sum(self._values.values())
+
+
+class _Sharded(Metric):
+    """Metric updated without a lock: every thread writes only its own shard,
+    and readers merge the shards."""
+
+    def __init__(self, name, help_text=""):
+        super().__init__(name, help_text)
+        self._local = threading.local()
+        self._shards = []
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def _merged(self):
+        """{label_key: [value per shard, ...]}"""
+        with self._lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for key, value in list(shard.items()): # Copied in one step, so the owner may keep writing
+                merged.setdefault(key, []).append(value)
+        return merged
+
+
+class Counter(_Sharded):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = _label_key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self):
+        return [(dict(key), sum(values)) for key, values in self._merged().items()]
+
+    def value(self, **labels):
+        return sum(self._merged().get(_label_key(labels), ()))
+
+    def total(self):
+        return sum(sum(values) for values in self._merged().values())
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Sharded):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = _label_key(labels)
+        state = shard.get(key)
+        if state is None:
+            # [per-bucket counts..., +Inf count, sum]
+            state = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def _states(self):
+        """{label_key: merged state}"""
+        return {key: [sum(column) for column in zip(*states)] for key, states in self._merged().items()}
+
+    def value(self, **labels):
+        state = self._states().get(_label_key(labels))
+        return self._summarise(state) if state else {"count": 0, "sum": 0.0}
+
+    def samples(self):
+        return [(dict(key), self._summarise(state)) for key, state in self._states().items()]
+
+    def total(self):
+        return sum(sum(state[:-1]) for state in self._states().values())
+
+    def _summarise(self, state):
+        return {"count": sum(state[:-1]), "sum": state[-1], "buckets": list(zip(self.buckets + (float("inf"),), state[:-1]))}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric.type_name}")
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def collect(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """Return {metric_name: [(labels, value), ...]} for every registered metric."""
+        return {metric.name: metric.samples() for metric in self.collect()}
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
+
+
+class LabelLimiter:
+    """Caps the distinct values of a high-cardinality label (such as a device ID):
+    the first `limit` values are kept, later ones are reported as `overflow`."""
+
+    def __init__(self, limit, overflow="other"):
+        self.limit = limit
+        self.overflow = overflow
+        self._seen = set()
+
+    def __call__(self, value):
+        if value in self._seen:
+            return value
+        if len(self._seen) >= self.limit:
+            return self.overflow
+        self._seen.add(value)
+        return value
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())) + "}"
+
+
+def render(registry=REGISTRY):
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in registry.collect():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        for labels, value in metric.samples():
+            if metric.type_name != "histogram":
+                lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in value["buckets"]:
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{_format_labels(dict(labels, le=_format_value(float(bound))))} {cumulative}")
+            lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+            lines.append(f"{metric.name}_count{_format_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.registry).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are not worth a log line each
+
+
+def start_http_server(port, bind="0.0.0.0", registry=REGISTRY):
+    """Serve GET /metrics on `bind`:`port` from a daemon thread; None if `port` is 0."""
+    if port <= 0:
+        return None
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    log.info("Serving metrics on http://%s:%d/metrics", bind, port)
+    return server
+
+
+def start_log_reporter(interval, registry=REGISTRY):
+    """Log a metrics snapshot every `interval` seconds from a daemon thread."""
+    if interval <= 0:
+        return None
+
+    def report():
+        while True:
+            time.sleep(interval)
+            for name, samples in registry.snapshot().items():
+                for labels, value in samples:
+                    log.info("metric %s%s = %s", name, labels or "", value)
+
+    thread = threading.Thread(target=report, name="metrics-log-reporter", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_rate_reporter(metric, interval, description=None):
+    """Log the per-second rate of every label set of a counter every `interval` seconds."""
+    if interval <= 0:
+        return None
+    description = description or metric.name
+
+    def report():
+        previous = {}
+        while True:
+            time.sleep(interval)
+            for labels, value in metric.samples():
+                key = _label_key(labels)
+                rate = (value - previous.get(key, 0)) / interval
+                previous[key] = value
+                log.info("%s %s: %.1f/s (total %d)", description, labels, rate, value)
+
+    thread = threading.Thread(target=report, name=f"rate-reporter-{metric.name}", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,19 @@
+"""
+Modbus polling (TCP, RTU over TCP and RTU serial): declarative register maps and the concurrent poller.
+"""
+from .pipeline import ExceptionResponse, PipelinedTcpClient
+from .poller import ModbusPoller
+from .register_map import Bus, Device, Point, ReadBlock, load_register_map, parse_register_map, plan_reads
+
+__all__ = [
+    "Bus",
+    "Device",
+    "ExceptionResponse",
+    "ModbusPoller",
+    "PipelinedTcpClient",
+    "Point",
+    "ReadBlock",
+    "load_register_map",
+    "parse_register_map",
+    "plan_reads",
+]
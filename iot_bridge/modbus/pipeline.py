@@ -0,0 +1,153 @@
+"""
+Modbus TCP client that pipelines requests on one connection.
+
+pymodbus waits for each response before sending the next request. Modbus TCP
+does not need to: every request carries a transaction ID in its MBAP header
+and the server echoes it in the response, so several requests (for any unit
+IDs behind a gateway) can be outstanding at once and their responses matched
+as they arrive. ``PipelinedTcpClient`` keeps up to `depth` requests in
+flight; servers and gateways that answer strictly one at a time still queue
+them on their side, so the round trips overlap either way.
+"""
+import asyncio
+import logging
+import struct
+
+log = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">HHHB") # transaction id, protocol id (0), length, unit id
+_READ = struct.Struct(">BHH") # function code, address, count
+MAX_TID = 0xFFFF
+MAX_LENGTH = 254 # MBAP length: unit id plus a PDU of at most 253 bytes
+
+
+class ExceptionResponse(Exception):
+    """The server answered a request with a Modbus exception code."""
+
+    def __init__(self, function, code):
+        super().__init__(f"Modbus exception {code} for function {function}")
+        self.function = function
+        self.code = code
+
+
+class PipelinedTcpClient:
+    """Reads coils and registers over Modbus TCP with up to `depth` requests outstanding."""
+
+    def __init__(self, host, port=502, timeout=5.0, depth=8):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.depth = depth
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._pending = {} # transaction id -> future of (unit, PDU)
+        self._tid = 0
+        self._slots = asyncio.Semaphore(depth)
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        """Open the connection; False if it could not be opened."""
+        try:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug("Could not connect to %s:%s: %s", self.host, self.port, e)
+            return False
+        self._receiver = asyncio.create_task(self._receive(self._reader))
+        return True
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        self._fail(ConnectionError(f"Connection to {self.host}:{self.port} closed"))
+
+    def _fail(self, error):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    def _next_tid(self):
+        for _ in range(MAX_TID):
+            self._tid = self._tid % MAX_TID + 1
+            if self._tid not in self._pending:
+                return self._tid
+        raise RuntimeError("No free transaction ID")
+
+    async def _receive(self, reader):
+        """Hand each response to the request with its transaction ID."""
+        try:
+            while True:
+                tid, protocol, length, unit = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                if not 2 <= length <= MAX_LENGTH: # A PDU holds at least a function code
+                    raise ConnectionError(f"Invalid MBAP length {length} (transaction ID {tid})")
+                pdu = await reader.readexactly(length - 1)
+                future = self._pending.pop(tid, None)
+                if protocol != 0 or future is None or future.done():
+                    log.debug("Ignoring response with transaction ID %d from %s:%s (late or unknown)", tid, self.host, self.port)
+                    continue
+                future.set_result((unit, pdu))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: # Anything else leaves the stream out of step: treat it as a lost connection
+            log.debug("Receiver for %s:%s stopped: %r", self.host, self.port, e)
+            self._fail(ConnectionError(f"Connection to {self.host}:{self.port} lost: {e}"))
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    async def read(self, function, address, count, unit):
+        """Read `count` registers (function 3/4) or bits (function 1/2) from `unit`.
+
+        Raises ExceptionResponse for a Modbus exception, asyncio.TimeoutError
+        when no response arrives within the timeout and ConnectionError when
+        the connection is gone or the response does not match the request.
+        """
+        async with self._slots:
+            if not self.connected:
+                raise ConnectionError(f"Not connected to {self.host}:{self.port}")
+            tid = self._next_tid()
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[tid] = future
+            self._writer.write(_HEADER.pack(tid, 0, 6, unit) + _READ.pack(function, address, count))
+            # A timer rather than wait_for, which on Python < 3.12 can swallow a cancellation
+            # that arrives together with the response
+            timer = loop.call_later(self.timeout, self._expire, future)
+            try:
+                answered, pdu = await future
+            finally:
+                timer.cancel()
+                self._pending.pop(tid, None)
+        if answered != unit:
+            raise ConnectionError(f"Response to transaction ID {tid} came from unit {answered}, not {unit}")
+        return decode_response(function, count, pdu)
+
+    def _expire(self, future):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError(f"No response from {self.host}:{self.port} in {self.timeout}s"))
+
+
+def decode_response(function, count, pdu):
+    """Values of a read response PDU: registers as ints, or `count` bits as bools."""
+    if not pdu:
+        raise ConnectionError(f"Empty response to function {function}")
+    if pdu[0] == function | 0x80:
+        raise ExceptionResponse(function, pdu[1] if len(pdu) > 1 else None)
+    if pdu[0] != function or len(pdu) < 2 or len(pdu) - 2 != pdu[1]:
+        raise ConnectionError(f"Malformed response to function {function}: {pdu[:16].hex()}")
+    data = pdu[2:]
+    if function in (1, 2):
+        if len(data) * 8 < count:
+            raise ConnectionError(f"Short response: {len(data)} bytes for {count} bits")
+        return [bool(data[i >> 3] >> (i & 7) & 1) for i in range(count)]
+    if len(data) != 2 * count:
+        raise ConnectionError(f"Short response: {len(data)} bytes for {count} registers")
+    return list(struct.unpack(f">{count}H", data))
@@ -0,0 +1,340 @@
+"""
+Concurrent asyncio poller for Modbus devices.
+
+Every device runs in its own task on a fixed-rate schedule: deadlines are
+``start + n * poll_interval`` on the event loop's monotonic clock, so read and
+forwarding time never accumulate into drift. A poll that overruns skips the
+deadlines it missed instead of bursting to catch up. Devices on the same bus
+(a host:port, an RTU gateway or a serial line) share one connection, and a
+device whose connection fails backs off on its own without holding up the
+others. On Modbus TCP a unit that does not answer fails only its own polls;
+RTU buses reconnect after a timeout to get back in step. ``update()`` swaps the device list while polling.
+
+A bus carries one request at a time unless it pipelines (Modbus TCP only, see
+pipeline.py); requests to one host over connections that do not pipeline are
+also limited by a per-host semaphore. Each bus reports how busy it is (time
+with a request outstanding) and its request turnaround, to size polling
+against what the bus can carry.
+"""
+import asyncio
+import inspect
+import logging
+
+from pymodbus import FramerType
+from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException
+
+try:
+    import serial
+except ImportError: # Optional; only RTU serial buses need pyserial
+    serial = None
+
+from .. import metrics
+from ..logsampling import SampledLogger
+from .pipeline import ExceptionResponse, PipelinedTcpClient
+from .register_map import BIT_FUNCTIONS
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+READERS = {1: "read_coils", 2: "read_discrete_inputs", 3: "read_holding_registers", 4: "read_input_registers"}
+# pymodbus renamed the unit id argument from slave= to device_id= in 3.10
+UNIT_KWARG = "device_id" if "device_id" in inspect.signature(AsyncModbusTcpClient.read_holding_registers).parameters else "slave"
+
+MODBUS_REQUESTS = metrics.counter("bridge_modbus_requests_total", "Modbus read requests, by outcome")
+POLL_JITTER = metrics.histogram("bridge_modbus_poll_jitter_seconds", "Delay between a poll's deadline and its start",
+                                buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+POLL_MISSED = metrics.counter("bridge_modbus_missed_deadlines_total", "Poll deadlines skipped because the previous poll overran, by device")
+POLL_RTT = metrics.histogram("bridge_modbus_poll_seconds", "Time to read all of a device's blocks, by device")
+CONNECTS = metrics.counter("bridge_modbus_connects_total", "Connection attempts to Modbus servers, by outcome")
+BUS_BUSY = metrics.counter("bridge_modbus_bus_busy_seconds_total",
+                           "Time a bus was busy, by bus: requests outstanding over time, divided by its pipeline depth; its rate is the bus utilization")
+BUS_TURNAROUND = metrics.histogram("bridge_modbus_turnaround_seconds", "Time from sending a request to its response, by bus",
+                                   buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+BUS_IN_FLIGHT = metrics.gauge("bridge_modbus_bus_in_flight", "Requests outstanding on a bus")
+BUS_UTILIZATION = metrics.gauge("bridge_modbus_bus_utilization", "Busy share of a bus over the last stats interval")
+
+
+def _client(bus, timeout):
+    # Reconnects and retries are driven by the poller's per-device backoff, not pymodbus, whose
+    # retries would hold a shared bus for every unit on it while one unit does not answer
+    if bus.transport == "rtu":
+        if serial is None:
+            raise RuntimeError(f"Bus {bus.name} is a serial line, which needs pyserial (pip install pyserial)")
+        return AsyncModbusSerialClient(bus.serial_port, framer=FramerType.RTU, baudrate=bus.baudrate, bytesize=bus.bytesize,
+                                       parity=bus.parity, stopbits=bus.stopbits, timeout=timeout, reconnect_delay=0, retries=0)
+    if bus.pipeline > 1:
+        return PipelinedTcpClient(bus.host, port=bus.port, timeout=timeout, depth=bus.pipeline)
+    framer = FramerType.RTU if bus.transport == "rtu_over_tcp" else FramerType.SOCKET
+    return AsyncModbusTcpClient(bus.host, port=bus.port, framer=framer, timeout=timeout, reconnect_delay=0, retries=0)
+
+
+class _Connection:
+    """The client of one bus, shared by the devices on it."""
+
+    def __init__(self, bus, timeout):
+        self.bus = bus
+        self.client = _client(bus, timeout)
+        self.name = bus.name
+        self.pipelined = bus.pipeline > 1
+        # Modbus TCP matches responses by transaction ID, so a request that times out leaves the
+        # connection in step; RTU frames do not, and a late response could pass for the next one's
+        self.resync_on_timeout = bus.transport != "tcp"
+        self._lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(bus.pipeline)
+        self.in_flight = 0
+        self.requests = 0
+        self.busy = 0.0 # Request-seconds outstanding / pipeline depth, up to _changed
+        self._changed = 0.0
+
+    async def ensure_connected(self):
+        if self.client.connected:
+            return True
+        async with self._lock:
+            if not self.client.connected:
+                log.info("Attempting to connect to Modbus server at %s", self.name)
+                if not await self.client.connect():
+                    CONNECTS.inc(outcome="failed")
+                    return False
+                CONNECTS.inc(outcome="connected")
+                log.info("Successfully connected to Modbus server at %s.", self.name)
+        return True
+
+    async def read(self, function, start, count, unit):
+        """Registers or bits read from `unit`; raises ExceptionResponse if the unit refused."""
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            sent = loop.time()
+            self._account(sent)
+            self.in_flight += 1
+            BUS_IN_FLIGHT.set(self.in_flight, bus=self.name)
+            try:
+                if self.pipelined:
+                    return await self.client.read(function, start, count, unit)
+                rr = await getattr(self.client, READERS[function])(start, count=count, **{UNIT_KWARG: unit})
+                if rr.isError():
+                    raise ExceptionResponse(function, getattr(rr, "exception_code", None))
+                return rr.bits if function in BIT_FUNCTIONS else rr.registers
+            finally:
+                now = loop.time()
+                self._account(now)
+                self.requests += 1
+                self.in_flight -= 1
+                BUS_IN_FLIGHT.set(self.in_flight, bus=self.name)
+                BUS_TURNAROUND.observe(now - sent, bus=self.name)
+
+    def _account(self, now):
+        """Add the busy time since the last change in requests outstanding."""
+        if self.in_flight:
+            busy = self.in_flight * (now - self._changed) / self.bus.pipeline
+            self.busy += busy
+            BUS_BUSY.inc(busy, bus=self.name)
+        self._changed = now
+
+    def busy_seconds(self, now):
+        """Busy seconds so far: all of them while a bus without pipelining has a request outstanding."""
+        return self.busy + self.in_flight * (now - self._changed) / self.bus.pipeline
+
+
+async def _stop(tasks):
+    """Cancel `tasks` and wait until they are done.
+
+    wait_for inside pymodbus (Python < 3.12) drops a cancellation that arrives
+    together with a response, so tasks still running are cancelled again.
+    """
+    pending = set(tasks)
+    while pending:
+        for task in pending:
+            task.cancel()
+        _, pending = await asyncio.wait(pending, timeout=1.0)
+
+
+class ModbusPoller:
+    """Polls devices concurrently and hands each decoded reading to `on_reading(device, values)`."""
+
+    def __init__(self, devices, on_reading, default_interval=5.0, max_concurrency_per_host=1, timeout=5.0,
+                 retry_interval=3.0, max_retry_interval=60.0, stats_interval=0):
+        self.devices = {device.name: device for device in devices}
+        self.on_reading = on_reading
+        self.default_interval = default_interval
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.stats_interval = stats_interval # Seconds between bus stats log lines, 0 disables
+        self.connections = {}
+        self._host_limits = {}
+        self._tasks = {}
+        self._running = False
+        for device in devices:
+            self._connect(device)
+
+    def _connect(self, device):
+        key = device.bus.signature()
+        if key not in self.connections:
+            self.connections[key] = _Connection(device.bus, self.timeout)
+        if device.host is not None and device.host not in self._host_limits:
+            self._host_limits[device.host] = asyncio.Semaphore(self.max_concurrency_per_host)
+
+    def _start(self, devices):
+        for index, device in enumerate(devices):
+            # Spread first polls across the interval so devices do not all fire at once
+            self._tasks[device.name] = asyncio.create_task(self._run_device(device, index / len(devices)))
+
+    async def run(self):
+        """Poll every device until cancelled."""
+        self._running = True
+        self._start(list(self.devices.values()))
+        try:
+            if self.stats_interval > 0:
+                await self._report_buses() # Until cancelled, like the device tasks
+            else:
+                await asyncio.Future() # Device tasks come and go with update()
+        finally:
+            # Before the connections close, or a read failing on a closed connection could mask the cancellation
+            await _stop(self._tasks.values())
+            for connection in self.connections.values():
+                connection.client.close()
+
+    def update(self, devices, default_interval=None):
+        """Poll `devices` from now on and return the names of the (added, removed) devices.
+
+        Devices that did not change keep their task, schedule and connection; a
+        changed device counts as removed and added again. Connections no device
+        uses any more are closed.
+        """
+        default_changed = default_interval is not None and default_interval != self.default_interval
+        if default_interval is not None:
+            self.default_interval = default_interval
+        wanted = {device.name: device for device in devices}
+        removed = [name for name, device in self.devices.items()
+                   if name not in wanted or wanted[name].signature() != device.signature()
+                   or (default_changed and device.poll_interval is None)]
+        stopped = []
+        for name in removed:
+            del self.devices[name]
+            task = self._tasks.pop(name, None)
+            if task is not None:
+                task.cancel()
+                stopped.append(task)
+        added = [device for name, device in wanted.items() if name not in self.devices]
+        for device in added:
+            self.devices[device.name] = device
+            self._connect(device)
+        if self._running:
+            self._start(added)
+        used = {device.bus.signature() for device in self.devices.values()}
+        unused = [self.connections.pop(key) for key in list(self.connections) if key not in used]
+        if unused:
+            if stopped:
+                asyncio.ensure_future(self._close_after(stopped, unused))
+            else:
+                for connection in unused:
+                    connection.client.close()
+        return [device.name for device in added], removed
+
+    async def _close_after(self, tasks, connections):
+        """Close `connections` once the cancelled `tasks` that used them are done."""
+        await _stop(tasks)
+        for connection in connections:
+            connection.client.close()
+
+    async def _run_device(self, device, offset):
+        loop = asyncio.get_running_loop()
+        interval = device.poll_interval or self.default_interval
+        deadline = loop.time() + interval * offset # offset: fraction of the interval before the first poll
+        backoff = self.retry_interval
+        retry_at = 0.0
+        while True:
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = loop.time()
+            POLL_JITTER.observe(started - deadline)
+
+            if started >= retry_at:
+                if await self._poll(device):
+                    backoff = self.retry_interval
+                else:
+                    log.error("Could not poll %s; retrying in %.0f seconds.", device.name, backoff)
+                    retry_at = loop.time() + backoff
+                    backoff = min(backoff * 2, self.max_retry_interval)
+
+            deadline += interval
+            now = loop.time()
+            if now > deadline:
+                missed = int((now - deadline) // interval) + 1
+                POLL_MISSED.inc(missed, device=device.name)
+                log.warning("Poll of %s overran its %.1fs interval; skipping %d deadline(s)", device.name, interval, missed)
+                deadline += missed * interval
+
+    def bus_stats(self, since, now):
+        """{bus: (utilization, requests)} between the bus_snapshot `since` and `now`."""
+        at, previous = since
+        stats = {}
+        for connection in self.connections.values():
+            busy, requests = previous.get(connection.name, (0.0, 0))
+            stats[connection.name] = ((connection.busy_seconds(now) - busy) / max(now - at, 1e-9), connection.requests - requests)
+        return stats
+
+    def bus_snapshot(self, now):
+        """(now, {bus: (busy seconds, requests)}): the `since` argument of a later bus_stats call."""
+        return now, {connection.name: (connection.busy_seconds(now), connection.requests) for connection in self.connections.values()}
+
+    async def _report_buses(self):
+        """Log each bus's utilization and request rate every stats_interval seconds."""
+        loop = asyncio.get_running_loop()
+        snapshot = self.bus_snapshot(loop.time())
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            now = loop.time()
+            for name, (utilization, requests) in self.bus_stats(snapshot, now).items():
+                BUS_UTILIZATION.set(utilization, bus=name)
+                log.info("Modbus bus %s: %.1f%% busy, %.1f requests/s", name, utilization * 100, requests / (now - snapshot[0]))
+            snapshot = self.bus_snapshot(now)
+
+    async def _read(self, connection, device, block):
+        """A block's values, or None if the device answered with an exception."""
+        try:
+            if connection.pipelined or device.host is None:
+                values = await connection.read(block.function, block.start, block.count, device.unit)
+            else:
+                async with self._host_limits[device.host]:
+                    values = await connection.read(block.function, block.start, block.count, device.unit)
+        except ExceptionResponse as e:
+            MODBUS_REQUESTS.inc(outcome="error")
+            sampled_log.error("Modbus read error from %s (function %d, %d+%d): %s", device.name, block.function, block.start, block.count, e)
+            return None
+        MODBUS_REQUESTS.inc(outcome="ok")
+        return values
+
+    async def _poll(self, device):
+        """Read all of a device's blocks; False if the connection failed."""
+        connection = self.connections[device.bus.signature()]
+        try:
+            if not await connection.ensure_connected():
+                return False
+            started = asyncio.get_running_loop().time()
+            if connection.pipelined:
+                results = await asyncio.gather(*(self._read(connection, device, block) for block in device.blocks))
+            else:
+                results = [await self._read(connection, device, block) for block in device.blocks]
+            responses = [(block, values) for block, values in zip(device.blocks, results) if values is not None]
+            POLL_RTT.observe(asyncio.get_running_loop().time() - started, device=device.name)
+        except (ModbusException, asyncio.TimeoutError, OSError) as e:
+            MODBUS_REQUESTS.inc(outcome="error")
+            request_failed = isinstance(e, asyncio.TimeoutError) or (
+                isinstance(e, ModbusException) and not isinstance(e, ConnectionException))
+            if request_failed and not connection.resync_on_timeout and connection.client.connected:
+                # Only this unit failed; the other units on the bus keep the connection
+                log.error("Modbus request to %s failed: %s", device.name, e)
+                return False
+            log.error("Modbus communication error with %s: %s. Closing connection.", device.name, e)
+            connection.client.close()
+            return False
+
+        if responses:
+            values = device.decode(responses)
+            sampled_log.info("Read %d points from %s", len(values), device.name)
+            self.on_reading(device, values)
+        return True
@@ -0,0 +1,289 @@
+"""
+Declarative Modbus register maps and coalesced read planning.
+
+A register map lists devices (host and port, or a named bus, and a unit id)
+and, for each, the points to poll: address, function code, data type, byte/word order, scale and the
+metric name used in the forwarded payload. ``plan_reads`` merges adjacent or
+nearby points of a device into the fewest read requests within the protocol
+limits, and each ``ReadBlock`` decodes its response for all of its points at
+once (with NumPy when installed, struct otherwise).
+
+Devices share one connection per bus. A device with a host and port is on
+the Modbus TCP bus of that host:port; ``buses`` declares others: TCP buses
+that pipeline requests, RTU over TCP (serial gateways passing raw RTU frames)
+and RTU serial lines.
+
+Example (YAML or JSON)::
+
+    max_gap: 8                       # registers worth reading over to merge two requests
+    buses:
+      line-a: {transport: rtu, serial_port: /dev/ttyUSB0, baudrate: 19200, parity: E}
+      gw-1: {transport: tcp, host: 192.168.1.50, pipeline: 8}   # up to 8 requests outstanding
+    devices:
+      - name: boiler-1               # device_id in forwarded payloads
+        host: 192.168.1.100
+        port: 502
+        unit: 1
+        poll_interval: 5             # seconds; defaults to POLL_INTERVAL
+        points:
+          - {name: temperature, address: 1, type: uint16, scale: 0.1}
+          - {name: flow, address: 10, function: input, type: float32, word_order: little}
+          - {name: pump_on, address: 0, function: coil}
+      - name: meter-3
+        bus: line-a
+        unit: 3
+        points:
+          - {name: energy, address: 0, type: uint32}
+"""
+import json
+import struct
+
+try:
+    import numpy as np
+except ImportError: # Optional; struct is used per point without it
+    np = None
+
+# Read function codes and the largest count one request may ask for
+FUNCTIONS = {"coil": 1, "discrete_input": 2, "holding": 3, "input": 4}
+MAX_COUNT = {1: 2000, 2: 2000, 3: 125, 4: 125}
+BIT_FUNCTIONS = (1, 2)
+
+# type -> (registers, struct code)
+TYPES = {
+    "int16": (1, "h"), "uint16": (1, "H"),
+    "int32": (2, "i"), "uint32": (2, "I"), "float32": (2, "f"),
+    "int64": (4, "q"), "uint64": (4, "Q"), "float64": (4, "d"),
+}
+ORDERS = ("big", "little")
+
+DEFAULT_MAX_GAP = 8
+
+TRANSPORTS = ("tcp", "rtu_over_tcp", "rtu")
+PARITIES = ("N", "E", "O")
+
+
+class Point:
+    """One value to poll from a device."""
+
+    def __init__(self, name, address, function="holding", type="uint16", byte_order="big",
+                 word_order="big", scale=1.0, offset=0.0):
+        self.name = name
+        self.address = int(address)
+        self.function = FUNCTIONS.get(function, function)
+        if self.function not in MAX_COUNT:
+            raise ValueError(f"Point {name}: unknown function {function!r}, expected one of {list(FUNCTIONS)} or 1-4")
+        if self.function in BIT_FUNCTIONS:
+            type = "bool"
+        elif type not in TYPES:
+            raise ValueError(f"Point {name}: unknown type {type!r}, expected one of {list(TYPES)}")
+        if byte_order not in ORDERS or word_order not in ORDERS:
+            raise ValueError(f"Point {name}: byte_order and word_order must be 'big' or 'little'")
+        self.type = type
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    @property
+    def width(self):
+        """Number of registers (or bits) the point occupies."""
+        return 1 if self.type == "bool" else TYPES[self.type][0]
+
+    def word_indexes(self):
+        """Register offsets from the point's address, in most-significant-word-first order."""
+        indexes = list(range(self.width))
+        return indexes[::-1] if self.word_order == "little" else indexes
+
+
+class Bus:
+    """A connection shared by the units on it: a Modbus TCP server or gateway, or a serial line.
+
+    Only Modbus TCP matches responses to requests (by transaction ID), so only
+    a ``tcp`` bus may have more than one request outstanding (`pipeline`).
+    """
+
+    def __init__(self, name=None, transport="tcp", host=None, port=502, serial_port=None, baudrate=19200,
+                 bytesize=8, parity="N", stopbits=1, pipeline=1):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Bus {name}: unknown transport {transport!r}, expected one of {list(TRANSPORTS)}")
+        self.transport = transport
+        if transport == "rtu":
+            if not serial_port:
+                raise ValueError(f"Bus {name}: a serial bus needs serial_port, e.g. /dev/ttyUSB0")
+            self.host, self.port = None, None
+        elif not host:
+            raise ValueError(f"Bus {name}: transport {transport} needs a host")
+        else:
+            self.host, self.port = host, int(port)
+        self.serial_port = serial_port if transport == "rtu" else None
+        self.baudrate = int(baudrate)
+        self.bytesize = int(bytesize)
+        self.parity = str(parity).upper()[:1]
+        self.stopbits = int(stopbits)
+        if self.parity not in PARITIES:
+            raise ValueError(f"Bus {name}: parity must be one of {list(PARITIES)}")
+        self.pipeline = int(pipeline)
+        if self.pipeline < 1:
+            raise ValueError(f"Bus {name}: pipeline must be at least 1")
+        if self.pipeline > 1 and transport != "tcp":
+            raise ValueError(f"Bus {name}: only Modbus TCP can pipeline requests; RTU frames carry no transaction ID")
+        self.name = name or self.serial_port or f"{self.host}:{self.port}"
+
+    def signature(self):
+        """Everything the connection depends on; devices on buses with one signature share a connection."""
+        if self.transport == "rtu":
+            return self.transport, self.serial_port, self.baudrate, self.bytesize, self.parity, self.stopbits
+        return self.transport, self.host, self.port, self.pipeline
+
+
+class Device:
+    """A Modbus unit and the points polled from it."""
+
+    def __init__(self, name, host=None, points=None, port=502, unit=1, max_gap=DEFAULT_MAX_GAP, poll_interval=None,
+                 bus=None):
+        if bus is None:
+            if not host:
+                raise ValueError(f"Device {name}: set host (Modbus TCP) or bus")
+            bus = Bus(host=host, port=port)
+        self.name = name
+        self.bus = bus
+        self.host = bus.host
+        self.port = bus.port
+        self.unit = int(unit)
+        self.poll_interval = float(poll_interval) if poll_interval is not None else None # None: bridge default
+        self.points = list(points or [])
+        self.blocks = plan_reads(self.points, max_gap=max_gap)
+
+    def signature(self):
+        """Everything polling depends on; a device with a different signature must be polled anew."""
+        points = tuple((p.name, p.address, p.function, p.type, p.byte_order, p.word_order, p.scale, p.offset)
+                       for p in self.points)
+        blocks = tuple((b.function, b.start, b.count) for b in self.blocks)
+        return self.bus.signature(), self.unit, self.poll_interval, points, blocks
+
+    def decode(self, responses):
+        """Merge decoded blocks into one {metric: value} dict; `responses` pairs each block with its values."""
+        values = {}
+        for block, raw in responses:
+            values.update(block.decode(raw))
+        return values
+
+
+class ReadBlock:
+    """One read request covering several points, with a precompiled decoder."""
+
+    def __init__(self, function, start, count, points):
+        self.function = function
+        self.start = start
+        self.count = count
+        self.points = points
+        self._groups = self._compile() if np is not None else None
+
+    def _compile(self):
+        # Points with the same layout are decoded together with one gather and one frombuffer
+        layouts = {}
+        for point in self.points:
+            layouts.setdefault((point.type, point.byte_order, point.word_order), []).append(point)
+        groups = []
+        for (type_name, byte_order, _), points in layouts.items():
+            index = np.array([[p.address - self.start + i for i in p.word_indexes()] for p in points], dtype=np.intp)
+            dtype = None if type_name == "bool" else np.dtype(">" + TYPES[type_name][1])
+            groups.append((
+                [p.name for p in points],
+                index,
+                dtype,
+                byte_order == "little",
+                np.array([p.scale for p in points]),
+                np.array([p.offset for p in points]),
+            ))
+        return groups
+
+    def decode(self, raw):
+        """Decode the registers (or bits) returned for this block into {metric: value}."""
+        if self._groups is None:
+            return self._decode_struct(raw)
+        if self.function in BIT_FUNCTIONS:
+            bits = np.asarray(raw[:self.count], dtype=bool)
+            return {name: value for names, index, *_ in self._groups for name, value in zip(names, bits[index[:, 0]].tolist())}
+        registers = np.asarray(raw[:self.count], dtype=np.uint16)
+        values = {}
+        for names, index, dtype, swap_bytes, scales, offsets in self._groups:
+            words = registers[index]
+            if swap_bytes:
+                words = words.byteswap()
+            decoded = np.frombuffer(words.astype(">u2").tobytes(), dtype=dtype)
+            values.update(zip(names, (decoded * scales + offsets).tolist()))
+        return values
+
+    def _decode_struct(self, raw):
+        values = {}
+        for point in self.points:
+            position = point.address - self.start
+            if point.type == "bool":
+                values[point.name] = bool(raw[position])
+                continue
+            words = [raw[position + i] for i in point.word_indexes()]
+            if point.byte_order == "little":
+                words = [((w & 0xFF) << 8) | (w >> 8) for w in words]
+            value = struct.unpack(">" + TYPES[point.type][1], struct.pack(f">{len(words)}H", *words))[0]
+            values[point.name] = value * point.scale + point.offset
+        return values
+
+
+def plan_reads(points, max_gap=DEFAULT_MAX_GAP):
+    """Group points into the fewest ReadBlocks per function code.
+
+    Points are merged when the hole between them is at most `max_gap` registers
+    and the request stays within the function's maximum count (125 registers,
+    2000 bits).
+    """
+    blocks = []
+    for function in sorted({p.function for p in points}):
+        limit = MAX_COUNT[function]
+        current, start, end = [], None, None
+        for point in sorted((p for p in points if p.function == function), key=lambda p: p.address):
+            point_end = point.address + point.width
+            if point.width > limit:
+                raise ValueError(f"Point {point.name} is wider than one request")
+            if current and point.address - end <= max_gap and max(end, point_end) - start <= limit:
+                current.append(point)
+                end = max(end, point_end)
+                continue
+            if current:
+                blocks.append(ReadBlock(function, start, end - start, current))
+            current, start, end = [point], point.address, point_end
+        if current:
+            blocks.append(ReadBlock(function, start, end - start, current))
+    return blocks
+
+
+def parse_register_map(config):
+    """Build Devices from a parsed register map (dict with a `devices` list and optional `buses`)."""
+    max_gap = int(config.get("max_gap", DEFAULT_MAX_GAP))
+    buses = {name: Bus(name=name, **spec) for name, spec in (config.get("buses") or {}).items()}
+    devices = []
+    for entry in config.get("devices", []):
+        entry = dict(entry)
+        points = [Point(**p) for p in entry.pop("points", [])]
+        if not points:
+            raise ValueError(f"Device {entry.get('name')} has no points")
+        if "bus" in entry:
+            if entry.get("host"):
+                raise ValueError(f"Device {entry.get('name')}: set host or bus, not both")
+            if entry["bus"] not in buses:
+                raise ValueError(f"Device {entry.get('name')}: unknown bus {entry['bus']!r}")
+            entry["bus"] = buses[entry["bus"]]
+        entry.setdefault("max_gap", max_gap)
+        devices.append(Device(points=points, **entry))
+    if not devices:
+        raise ValueError("Register map defines no devices")
+    return devices
+
+
+def load_register_map(path):
+    """Load a register map from a .json file, or YAML otherwise (requires PyYAML)."""
+    with open(path) as f:
+        if path.endswith(".json"):
+            return parse_register_map(json.load(f))
+        import yaml
+        return parse_register_map(yaml.safe_load(f))
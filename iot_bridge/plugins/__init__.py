@@ -0,0 +1,25 @@
+"""
+Protocol front ends hosted by the bridge runtime (see iot_bridge.runtime).
+"""
+
+
+class Plugin:
+    """A front end: receives or polls readings and hands them to its runtime lane."""
+
+    name = None
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    async def start(self):
+        """Start listening/polling; return once running."""
+
+    async def stop(self):
+        """Stop and release the front end's sockets and tasks."""
+
+    async def reconfigure(self, config):
+        """Apply a changed bridge config (see iot_bridge.config) without restarting.
+
+        Settings have already been applied to the environment. Front ends apply
+        what they can in place, e.g. subscriptions or polled devices.
+        """
@@ -0,0 +1,336 @@
+"""
+CoAP front end: POSTs to /sensor/ir or /data carry one reading, or a pack of them.
+
+Payloads are decoded by content-format: JSON (50, or none), CBOR (60), and
+SenML packs in JSON (110) or CBOR (112), which may hold many readings. CBOR
+needs cbor2.
+
+``COAP_RESPONSE_MODE`` picks when a POST is answered:
+
+- ``forward`` (default): after the gateway's answer, so the response code
+  reflects it. aiocoap sends an empty ACK first when that takes longer than
+  its ACK delay, so clients get a separate response rather than retransmit.
+- ``queued``: as soon as the readings are on the forwarding queue; worker
+  threads forward them in the background.
+- ``journal``: once the readings are durably appended to the journal, which
+  replays them to the gateway (requires JOURNAL_DIR).
+
+With ``COAP_OBSERVE`` the bridge also acts as an Observe client: it registers
+with each listed device resource and forwards every notification.
+
+aiocoap answers retransmissions of a confirmable message (same message ID)
+itself. Requests a client sends again under a new message ID, after its own
+timeout, are caught by a dedup cache keyed on the client endpoint, token and
+payload (``COAP_DEDUP_TTL``): the resend gets the first request's response code
+and nothing is forwarded twice.
+
+aiocoap binds its UDP server socket with SO_REUSEPORT, so worker processes
+(``BRIDGE_PROCESSES`` or ``COAP_WORKER_PROCESSES``) can share the port; the
+kernel spreads datagrams across them by source address, so a client's resends
+reach the same worker and its dedup cache.
+"""
+import asyncio
+import logging
+import os
+
+import requests
+from aiocoap import Code, Context, Message, resource
+
+from .. import check_response, codec, is_retryable, metrics, senml, tracing
+from ..dedup import DedupCache
+from ..logsampling import SampledLogger
+from . import Plugin
+
+try:
+    import cbor2
+except ImportError: # Optional; CBOR and SenML-CBOR payloads are refused without it
+    cbor2 = None
+
+# Decode errors of a CBOR payload (cbor2's are not all ValueErrors)
+DECODE_ERRORS = (ValueError, cbor2.CBORDecodeError) if cbor2 is not None else (ValueError,)
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+# CoAP content-formats the bridge decodes
+JSON, CBOR, SENML_JSON, SENML_CBOR = 50, 60, 110, 112
+FORMAT_NAMES = {None: "json", JSON: "json", CBOR: "cbor", SENML_JSON: "senml+json", SENML_CBOR: "senml+cbor"}
+RESPONSE_MODES = ("forward", "queued", "journal")
+
+COAP_REQUESTS = metrics.counter("bridge_coap_requests_total", "CoAP POSTs received, by content-format")
+COAP_NOTIFICATIONS = metrics.counter("bridge_coap_notifications_total", "CoAP Observe notifications received, by resource")
+
+
+class UnsupportedFormat(Exception):
+    """The payload's content-format cannot be decoded."""
+
+
+class SensorResource(resource.Resource):
+    def __init__(self, plugin):
+        super().__init__()
+        self.plugin = plugin
+        self.lane = plugin.lane
+
+    async def forward(self, payload_json):
+        """Forward one reading to the gateway and return the CoAP response for it."""
+        forwarder = self.lane.forwarder
+        log.debug("Forwarding payload to HTTP: %s", forwarder.endpoint)
+        coap_code = Code.INTERNAL_SERVER_ERROR # Default error code
+        retryable = True
+        try:
+            trace = tracing.take(payload_json, "enqueue") if tracing.active else None
+            response = await self.lane.post_async(payload_json, traces=[(0, trace)] if trace is not None else None)
+
+            sampled_log.info("HTTP Response: %d %s", response.status_code, response.reason)
+            if check_response(response):
+                coap_code = Code.CHANGED # Success
+            elif response.status_code == 403:
+                coap_code = Code.FORBIDDEN
+            elif response.status_code == 400:
+                coap_code = Code.BAD_REQUEST
+            else:
+                coap_code = Code.BAD_GATEWAY # Or other suitable 5.xx code
+            retryable = is_retryable(response)
+
+        except requests.exceptions.Timeout:
+            sampled_log.error("HTTP post timed out to %s", forwarder.endpoint)
+            coap_code = Code.GATEWAY_TIMEOUT
+        except requests.exceptions.RequestException as e:
+            sampled_log.error("HTTP post error to %s: %s", forwarder.endpoint, e)
+            coap_code = Code.SERVICE_UNAVAILABLE
+
+        if coap_code != Code.CHANGED and retryable and self.lane.store_for_replay(payload_json):
+            # Durably stored for replay, so the client must not resend it
+            return Message(code=Code.CHANGED, payload=b"Stored")
+
+        # Return success/error to CoAP client
+        return Message(code=coap_code, payload=b"Forwarded" if coap_code == Code.CHANGED else b"Error forwarding")
+
+    async def render_post(self, request):
+        dedup = self.plugin.dedup
+        if dedup is None:
+            return await self.handle_post(request)
+        # A resent request repeats its token; zero-length tokens only identify it with the message ID
+        key = (request.remote.hostinfo, request.token or request.mid, hash(request.payload))
+        handling = dedup.get(key)
+        if handling is not None:
+            sampled_log.info("Duplicate CoAP POST from %s", request.remote.uri)
+            response = await asyncio.shield(handling)
+            return Message(code=response.code, payload=b"Duplicate")
+        # Its own task: aiocoap cancels this render when the client resends with the same
+        # token, and the resend should wait for the forward rather than repeat it
+        handling = asyncio.ensure_future(self.handle_post(request))
+        dedup.add(key, handling)
+        handling.add_done_callback(lambda task: self.settled(key, task))
+        return await asyncio.shield(handling)
+
+    def settled(self, key, task):
+        if task.cancelled() or task.exception() is not None or not task.result().code.is_successful():
+            self.plugin.dedup.forget(key) # Let the client's resend try again
+
+    async def handle_post(self, request):
+        source_addr = request.remote.uri # Get client address if needed
+        content_format = request.opt.content_format
+        content_format = int(content_format) if content_format is not None else None
+        try:
+            sampled_log.info("CoAP POST received on /sensor/ir from %s", source_addr)
+            log.debug("Payload: %s", request.payload)
+            COAP_REQUESTS.inc(format=FORMAT_NAMES.get(content_format, "other"))
+
+            # Ensure 'source' identifier is present, and add a device identifier
+            # if possible (e.g., based on CoAP source address)
+            envelope = {'source': 'coap', 'device_id': f"coap_{source_addr}"}
+            self.lane.received(len(request.payload), envelope['device_id'])
+            try:
+                readings = self.plugin.decode(request.payload, content_format, envelope, "/".join(request.opt.uri_path))
+            except UnsupportedFormat as e:
+                return Message(code=Code.UNSUPPORTED_CONTENT_FORMAT, payload=str(e).encode("utf-8"))
+            except codec.DecodeError:
+                if content_format not in (None, JSON):
+                    return Message(code=Code.BAD_REQUEST, payload=b"Invalid payload")
+                payload_str = request.payload.decode('utf-8')
+                sampled_log.warning("Received non-JSON CoAP payload: %s", payload_str)
+                # Wrap non-JSON as a 'value' field
+                readings = [{'value': payload_str, 'source': 'coap_raw', 'device_id': f"coap_{source_addr}"}]
+
+            if not readings:
+                # Unchanged within the deadband; nothing to forward
+                return Message(code=Code.CHANGED, payload=b"Suppressed")
+
+            if self.lane.batcher is not None:
+                # Batched readings are acknowledged once queued; delivery happens in the background
+                for reading in readings:
+                    self.lane.batcher.submit(reading)
+                return Message(code=Code.CHANGED, payload=b"Queued")
+
+            mode = self.plugin.response_mode
+            if mode == "queued":
+                for reading in readings:
+                    self.lane.put(reading)
+                return Message(code=Code.CHANGED, payload=b"Queued")
+            if mode == "journal":
+                if all(self.lane.store_for_replay(reading) for reading in readings):
+                    return Message(code=Code.CHANGED, payload=b"Stored")
+                return Message(code=Code.SERVICE_UNAVAILABLE, payload=b"Journal full")
+
+            for reading in readings:
+                response = await self.forward(reading)
+                if response.code != Code.CHANGED:
+                    break
+            return response
+
+        except UnicodeDecodeError:
+            sampled_log.error("Failed to decode CoAP payload as UTF-8.")
+            return Message(code=Code.BAD_REQUEST, payload=b"Invalid UTF-8 payload")
+        except Exception as e:
+            log.exception("Error handling CoAP request: %s", e) # Log full traceback
+            return Message(code=Code.INTERNAL_SERVER_ERROR, payload=b"Internal Server Error")
+
+
+def observe_uris_from_env(section=None):
+    """Resources to observe, from the bridge config's coap section or COAP_OBSERVE."""
+    uris = (section or {}).get("observe")
+    if uris is None:
+        uris = os.getenv("COAP_OBSERVE", "").split(",")
+    elif isinstance(uris, str):
+        uris = uris.split(",")
+    return [uri.strip() for uri in uris if uri.strip()]
+
+
+class CoapPlugin(Plugin):
+    name = "coap"
+
+    def __init__(self, runtime):
+        super().__init__(runtime)
+        self.port = int(os.getenv("COAP_PORT", "5683"))
+        self.bind_addr = os.getenv("COAP_BIND", "0.0.0.0") # '::' listens on IPv6 (often IPv4 too)
+        # UDP only: aiocoap's TCP/WebSocket listeners would also open ports without SO_REUSEPORT
+        self.transports = os.getenv("COAP_TRANSPORTS", "udp6").split(":")
+        self.response_mode = os.getenv("COAP_RESPONSE_MODE", "forward")
+        if self.response_mode not in RESPONSE_MODES:
+            raise ValueError(f"Unknown COAP_RESPONSE_MODE {self.response_mode!r}, expected one of {RESPONSE_MODES}")
+        self.observe_uris = observe_uris_from_env(runtime.config_section("coap"))
+        self.observe_retry = float(os.getenv("COAP_OBSERVE_RETRY", "5")) # Seconds, doubling to 60
+        self.lane = runtime.lane("coap", "COAP", queued=self.response_mode == "queued")
+        if self.lane.queue is not None and self.lane.queue.overflow == "block":
+            raise ValueError("COAP_QUEUE_OVERFLOW=block would stall the event loop; use drop_oldest or spill.")
+        if self.response_mode == "journal" and self.lane.journal is None:
+            raise ValueError("COAP_RESPONSE_MODE=journal requires JOURNAL_DIR")
+        dedup_ttl = float(os.getenv("COAP_DEDUP_TTL", "30")) # Seconds; 0 disables
+        self.dedup = DedupCache(dedup_ttl, int(os.getenv("COAP_DEDUP_MAX_ENTRIES", "100000"))) if dedup_ttl > 0 else None
+        self.context = None
+        self._observers = {} # uri -> observation task
+
+    def decode(self, payload, content_format, envelope, path=None):
+        """Decode a payload into the readings to forward (after aggregation and the deadband).
+
+        `path` is the resource it arrived on (or the observed URI), for aggregation rules.
+        Raises codec.DecodeError for malformed payloads and UnsupportedFormat for
+        content-formats the bridge cannot read.
+        """
+        if content_format in (None, JSON):
+            return self.lane.prepare(payload, envelope, path)
+        if content_format not in FORMAT_NAMES:
+            raise UnsupportedFormat(f"Unsupported content-format {content_format}")
+        if content_format in (CBOR, SENML_CBOR) and cbor2 is None:
+            raise UnsupportedFormat("CBOR payloads need cbor2 installed")
+        try:
+            if content_format == CBOR:
+                decoded = cbor2.loads(payload)
+                readings = decoded if isinstance(decoded, list) else [decoded]
+            else:
+                pack = codec.loads(payload) if content_format == SENML_JSON else cbor2.loads(payload)
+                readings = senml.to_readings(pack)
+        except DECODE_ERRORS as e: # codec.DecodeError and senml's errors are ValueErrors too
+            raise codec.DecodeError(str(e)) from e
+        results = []
+        for reading in readings:
+            if not isinstance(reading, dict):
+                raise codec.DecodeError("Reading is not a map")
+            for key, value in envelope.items():
+                reading.setdefault(key, value)
+            results.extend(self.lane.filter(reading, path))
+        return results
+
+    async def deliver(self, readings):
+        """Forward readings that no client is waiting on."""
+        for reading in readings:
+            if self.lane.queue is not None:
+                self.lane.put(reading)
+            else:
+                await self.lane.send(reading)
+
+    async def observe(self, uri):
+        """Keep an Observe registration with `uri` and forward its notifications."""
+        envelope = {'source': 'coap', 'device_id': f"coap_{uri}"}
+        backoff = self.observe_retry
+        while True:
+            try:
+                request = self.context.request(Message(code=Code.GET, uri=uri, observe=0))
+                try:
+                    response = await request.response
+                    if not response.code.is_successful():
+                        raise RuntimeError(f"registration answered {response.code}")
+                    log.info("Observing %s", uri)
+                    backoff = self.observe_retry
+                    await self.notify(uri, response, envelope)
+                    async for response in request.observation:
+                        await self.notify(uri, response, envelope)
+                finally:
+                    request.observation.cancel() # Deregister (also on shutdown)
+                log.warning("Observation of %s ended; registering again", uri)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("Observing %s failed: %s; retrying in %.0f seconds", uri, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    async def notify(self, uri, response, envelope):
+        COAP_NOTIFICATIONS.inc(resource=uri)
+        self.lane.received(len(response.payload), envelope['device_id'])
+        content_format = response.opt.content_format
+        try:
+            readings = self.decode(response.payload, int(content_format) if content_format is not None else None, envelope, uri)
+        except (codec.DecodeError, UnsupportedFormat) as e:
+            sampled_log.warning("Ignoring notification from %s: %s", uri, e)
+            return
+        await self.deliver(readings)
+
+    async def start(self):
+        root = resource.Site()
+        sensor = SensorResource(self)
+        root.add_resource(['sensor', 'ir'], sensor) # Example resource path
+        root.add_resource(['data'], sensor)         # More generic '/data' endpoint
+        try:
+            # Consider adding DTLS context creation here if needed
+            self.context = await Context.create_server_context(root, bind=(self.bind_addr, self.port),
+                                                              transports=self.transports)
+        except OSError as e:
+            log.error("Error starting CoAP server (maybe port %d is in use?): %s", self.port, e)
+            raise
+        log.info("Listening for CoAP requests on %s:%d (UDP, response mode %s)...", self.bind_addr, self.port, self.response_mode)
+        # Observe registrations go out from the server's own socket
+        self._observers = {uri: asyncio.create_task(self.observe(uri)) for uri in self.observe_uris}
+
+    async def reconfigure(self, config):
+        self.observe_uris = observe_uris_from_env(config.section("coap"))
+        if self.context is None:
+            return
+        removed = [uri for uri in self._observers if uri not in self.observe_uris]
+        tasks = [self._observers.pop(uri) for uri in removed]
+        for task in tasks:
+            task.cancel() # Deregisters
+        await asyncio.gather(*tasks, return_exceptions=True)
+        added = [uri for uri in self.observe_uris if uri not in self._observers]
+        for uri in added:
+            self._observers[uri] = asyncio.create_task(self.observe(uri))
+        if added or removed:
+            log.info("CoAP observations updated: added %s, removed %s", ", ".join(added) or "none", ", ".join(removed) or "none")
+
+    async def stop(self):
+        for task in self._observers.values():
+            task.cancel()
+        await asyncio.gather(*self._observers.values(), return_exceptions=True)
+        if self.context is not None:
+            await self.context.shutdown()
@@ -0,0 +1,124 @@
+"""
+Modbus front end: polls the devices of a register map (or the single
+MODBUS_IP device) over Modbus TCP, RTU over TCP or RTU serial lines and
+forwards each decoded reading.
+
+Under several worker processes each one polls every Nth device, so no device
+is polled twice; the devices of a serial line all go to one process, which
+owns the port.
+"""
+import asyncio
+import logging
+import os
+
+from ..modbus import Device, ModbusPoller, Point, load_register_map, parse_register_map
+from . import Plugin
+
+log = logging.getLogger(__name__)
+
+
+def devices_from_env(section=None):
+    """Devices from the bridge config's modbus section, MODBUS_REGISTER_MAP, or the single
+    device from MODBUS_IP/MODBUS_SLAVE_ID."""
+    if section and section.get("devices"):
+        return parse_register_map(section) # An inline register map, with its buses
+    register_map_path = os.getenv("MODBUS_REGISTER_MAP") # Devices and points to poll; see modbus/register_map.py
+    if register_map_path:
+        return load_register_map(register_map_path)
+    modbus_ip = os.getenv("MODBUS_IP", '192.168.1.100')
+    modbus_slave_id = int(os.getenv("MODBUS_SLAVE_ID", "1"))
+    # Two holding registers from address 1 holding temp/hum scaled by 10
+    return [Device(
+        f"modbus_{modbus_ip}_{modbus_slave_id}",
+        modbus_ip,
+        [Point("temperature", 1, scale=0.1), Point("humidity", 2, scale=0.1)],
+        port=int(os.getenv("MODBUS_PORT", "502")),
+        unit=modbus_slave_id,
+    )]
+
+
+def worker_share(devices, worker, processes):
+    """The devices worker `worker` of `processes` polls: every Nth device, or every Nth serial line."""
+    lines = []
+    share = []
+    for index, device in enumerate(devices):
+        if device.bus.transport == "rtu":
+            key = device.bus.signature()
+            if key not in lines:
+                lines.append(key)
+            index = lines.index(key)
+        if index % processes == worker:
+            share.append(device)
+    return share
+
+
+class ModbusPlugin(Plugin):
+    name = "modbus"
+
+    def __init__(self, runtime):
+        super().__init__(runtime)
+        self.poll_interval, self.devices = self.configured(runtime.config_section("modbus"))
+        self.lane = runtime.lane("modbus", "MODBUS", queued=True) # Polling must not wait on the gateway
+        if self.lane.queue.overflow == "block":
+            raise ValueError("MODBUS_QUEUE_OVERFLOW=block would stall the poller; use drop_oldest or spill.")
+        self.max_concurrency_per_host = int(os.getenv("MODBUS_MAX_CONCURRENCY_PER_HOST", "1")) # In-flight requests per gateway IP
+        self.timeout = float(os.getenv("MODBUS_TIMEOUT", "5"))
+        self.bus_stats_interval = float(os.getenv("MODBUS_BUS_STATS_INTERVAL", "60")) # Seconds, 0 disables
+        self.poller = None
+        self._task = None
+
+    def configured(self, section):
+        """The default poll interval and this worker's share of the devices."""
+        # Default 5 seconds, per-device intervals override it
+        poll_interval = float(section.get("poll_interval", os.getenv("POLL_INTERVAL", "5")))
+        devices = devices_from_env(section)
+        if self.runtime.worker is not None and self.runtime.processes > 1:
+            devices = worker_share(devices, self.runtime.worker, self.runtime.processes)
+        return poll_interval, devices
+
+    async def reconfigure(self, config):
+        try:
+            poll_interval, devices = self.configured(config.section("modbus"))
+        except (OSError, ValueError, TypeError) as e:
+            log.error("Keeping the current Modbus devices, the new register map is invalid: %s", e)
+            return
+        self.poll_interval, self.devices = poll_interval, devices
+        if self.poller is None:
+            return
+        added, removed = self.poller.update(devices, default_interval=poll_interval)
+        if added or removed:
+            log.info("Modbus devices updated: %d polling, added %s, removed %s",
+                     len(devices), ", ".join(added) or "none", ", ".join(removed) or "none")
+
+    def on_reading(self, device, values):
+        """Queue a decoded device reading; forwarding happens on worker threads."""
+        payload = dict(values)
+        payload['source'] = 'modbus' # Add source identifier
+        payload['device_id'] = device.name
+        self.lane.received(device=device.name)
+        for reading in self.lane.filter(payload):
+            self.lane.put(reading)
+
+    async def start(self):
+        log.info("Devices: %d on %d buses, %d points in %d read requests per poll",
+                 len(self.devices), len({d.bus.signature() for d in self.devices}),
+                 sum(len(d.points) for d in self.devices), sum(len(d.blocks) for d in self.devices))
+        log.info("Default Poll Interval: %.1f seconds", self.poll_interval)
+        # pymodbus clients bind to the running loop, so the poller is built here (even with no devices yet)
+        self.poller = ModbusPoller(
+            self.devices,
+            self.on_reading,
+            default_interval=self.poll_interval,
+            max_concurrency_per_host=self.max_concurrency_per_host,
+            timeout=self.timeout,
+            stats_interval=self.bus_stats_interval,
+        )
+        self._task = asyncio.create_task(self.poller.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
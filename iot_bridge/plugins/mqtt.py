@@ -0,0 +1,253 @@
+"""
+MQTT front end: subscribes to the configured topic filters and forwards each message.
+
+paho runs its network loop on its own thread; messages are decoded there and
+handed to the lane's worker threads, so the event loop is never involved.
+"""
+import asyncio
+import logging
+import os
+import ssl
+
+import paho.mqtt.client as mqtt
+
+from .. import codec, metrics
+from ..logsampling import SampledLogger
+from . import Plugin
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+# Per-filter throughput for this worker, used to size BRIDGE_PROCESSES
+MESSAGES_RECEIVED = metrics.counter("bridge_mqtt_messages_total", "MQTT messages received, by subscription filter")
+CONNECTS = metrics.counter("bridge_mqtt_connects_total", "MQTT connection attempts answered by the broker, by outcome (connected/reconnected/failed)")
+DISCONNECTS = metrics.counter("bridge_mqtt_disconnects_total", "MQTT disconnections, by kind (clean/unexpected)")
+
+
+def parse_server_url(url):
+    """Return (host, port, use_tls) for an mqtt:// or mqtts:// URL."""
+    if url.startswith("mqtts://"):
+        use_tls, default_port = True, 8883
+    elif url.startswith("mqtt://"):
+        use_tls, default_port = False, 1883
+    else:
+        raise ValueError(f"Invalid MQTT_SERVER format: {url}. Must start with mqtt:// or mqtts://")
+    host = url.split("://")[1].split(":")[0]
+    try:
+        port = int(url.split(":")[-1])
+    except (IndexError, ValueError):
+        port = default_port
+    return host, port, use_tls
+
+
+def parse_topic_filters(spec, default_qos):
+    """Parse 'filter[:qos],filter[:qos]' into a list of (filter, qos) tuples."""
+    filters = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        topic_filter, qos = entry, default_qos
+        if ":" in entry:
+            head, tail = entry.rsplit(":", 1)
+            if tail.isdigit():
+                topic_filter, qos = head, int(tail)
+        if qos not in (0, 1, 2):
+            raise ValueError(f"Invalid QoS {qos} for topic filter {topic_filter}")
+        filters.append((topic_filter, qos))
+    return filters
+
+
+def topic_filters_from_env(section=None):
+    """Topic filters from the bridge config's mqtt section, or MQTT_TOPICS / MQTT_TOPIC."""
+    topics = (section or {}).get("topics")
+    if topics is None:
+        topics = os.getenv("MQTT_TOPICS", os.getenv("MQTT_TOPIC", "sensor/dht11")) # Comma-separated, each optionally "filter:qos"
+    elif not isinstance(topics, str):
+        topics = ",".join(str(topic) for topic in topics)
+    filters = parse_topic_filters(topics, int(os.getenv("MQTT_QOS", "0")))
+    if not filters:
+        raise ValueError("No MQTT topic filters configured (MQTT_TOPICS / MQTT_TOPIC).")
+    return filters
+
+
+class MqttPlugin(Plugin):
+    name = "mqtt"
+
+    def __init__(self, runtime):
+        super().__init__(runtime)
+        self.server_url = os.getenv("MQTT_SERVER", "mqtts://mqtt-broker:8883") # Default to MQTTS
+        self.host, self.port, self.use_tls = parse_server_url(self.server_url)
+        self.topic_filters = topic_filters_from_env(runtime.config_section("mqtt"))
+        self.shared_group = os.getenv("MQTT_SHARED_GROUP") # Subscribe as $share/<group>/<filter> if set
+        if runtime.processes > 1 and not self.shared_group:
+            self.shared_group = "mqtt-http-bridge"
+            log.warning("Several worker processes without MQTT_SHARED_GROUP; using shared group '%s'", self.shared_group)
+        self.protocol = os.getenv("MQTT_PROTOCOL", "5" if self.shared_group else "3.1.1")
+        self.client_id = os.getenv("MQTT_CLIENT_ID", f"mqtt-http-bridge-{os.getpid()}") # Unique client ID
+        if runtime.worker is not None:
+            # Each supervised worker needs its own client ID and must share the subscription
+            self.client_id = f"{self.client_id}-{runtime.worker}"
+        self.throughput_log_interval = int(os.getenv("MQTT_THROUGHPUT_LOG_INTERVAL", "60")) # Seconds, 0 disables
+        self.worker_label = str(runtime.worker if runtime.worker is not None else 0)
+        self.lane = runtime.lane("mqtt", "MQTT", queued=True) # paho's thread must not wait on the gateway
+        self._filter_cache = {}
+        self._connected_before = False
+        self.client = None
+        log.info("Configuring for %s connection to %s:%d", "MQTTS" if self.use_tls else "MQTT", self.host, self.port)
+
+    def filter_for_topic(self, topic):
+        """Return the configured filter a message topic matched (cached per topic)."""
+        matched = self._filter_cache.get(topic)
+        if matched is None:
+            matched = next((f for f, _ in self.topic_filters if mqtt.topic_matches_sub(f, topic)), "unmatched")
+            if len(self._filter_cache) > 10000:
+                self._filter_cache.clear()
+            self._filter_cache[topic] = matched
+        return matched
+
+    def subscription_list(self, topic_filters=None):
+        """Topic filters to subscribe to, prefixed for shared subscriptions when configured."""
+        topic_filters = self.topic_filters if topic_filters is None else topic_filters
+        if self.shared_group:
+            return [(f"$share/{self.shared_group}/{f}", qos) for f, qos in topic_filters]
+        return list(topic_filters)
+
+    async def reconfigure(self, config):
+        try:
+            topic_filters = topic_filters_from_env(config.section("mqtt"))
+        except ValueError as e:
+            log.error("Keeping the current MQTT subscriptions: %s", e)
+            return
+        added = [entry for entry in topic_filters if entry not in self.topic_filters] # New filters and QoS changes
+        kept = {f for f, _ in topic_filters}
+        removed = [entry for entry in self.topic_filters if entry[0] not in kept]
+        self.topic_filters = topic_filters # Also used to subscribe again after a reconnect
+        self._filter_cache = {}
+        if self.client is None or not (added or removed):
+            return
+        # paho's client is thread-safe; the other subscriptions stay in place
+        if removed:
+            self.client.unsubscribe([f for f, _ in self.subscription_list(removed)])
+        if added:
+            self.client.subscribe(self.subscription_list(added))
+        log.info("MQTT subscriptions updated: added %s, removed %s",
+                 ", ".join(f"{f} (QoS {q})" for f, q in added) or "none", ", ".join(f for f, _ in removed) or "none")
+
+    # --- MQTT Callbacks ---
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        """Callback when client connects to broker."""
+        if reason_code == 0:
+            CONNECTS.inc(outcome="reconnected" if self._connected_before else "connected")
+            self._connected_before = True
+            log.info("Connected to MQTT broker %s:%d successfully.", self.host, self.port)
+            # Subscribe to all configured topic filters in one SUBSCRIBE packet
+            subscriptions = self.subscription_list()
+            client.subscribe(subscriptions)
+            log.info("Subscribed to topics: %s", ", ".join(f"{f} (QoS {q})" for f, q in subscriptions))
+        else:
+            CONNECTS.inc(outcome="failed")
+            log.error("MQTT Connection failed with reason code %s", reason_code)
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        """Callback for disconnection."""
+        DISCONNECTS.inc(kind="unexpected" if reason_code != 0 else "clean")
+        if reason_code != 0:
+            log.warning("Unexpectedly disconnected from MQTT broker with reason code %s. Will attempt to reconnect.", reason_code)
+        else:
+            log.info("Disconnected from MQTT broker.")
+
+    def on_message(self, client, userdata, msg):
+        """Callback when message is received on subscribed topic. Runs on paho's network thread,
+        so it only decodes the payload and queues it; forwarding happens on worker threads."""
+        try:
+            MESSAGES_RECEIVED.inc(worker=self.worker_label, filter=self.filter_for_topic(msg.topic))
+            sampled_log.info("Received MQTT message on topic '%s'", msg.topic)
+            log.debug("Payload: %s", msg.payload)
+
+            # Envelope fields, added only where the payload does not set them
+            envelope = {'source': 'mqtt', 'topic': msg.topic}
+            # Example: Extract device ID from topic like 'sensor/dht11/device123'
+            topic_parts = msg.topic.split('/')
+            if len(topic_parts) > 2:
+                envelope['device_id'] = topic_parts[-1]
+            self.lane.received(len(msg.payload), envelope.get('device_id', msg.topic), at=msg.timestamp or None)
+
+            try:
+                readings = self.lane.prepare(msg.payload, envelope)
+            except codec.DecodeError:
+                payload_str = msg.payload.decode('utf-8')
+                sampled_log.warning("Received non-JSON MQTT payload: %s. Forwarding as raw value.", payload_str)
+                # Wrap non-JSON as a 'value' field
+                readings = [{'value': payload_str, 'source': 'mqtt_raw', 'topic': msg.topic}]
+
+            for reading in readings:
+                self.lane.put(reading)
+
+        except UnicodeDecodeError:
+            sampled_log.error("Failed to decode MQTT payload as UTF-8. Topic: %s", msg.topic)
+        except Exception as e:
+            log.exception("Error processing MQTT message: %s", e) # Log traceback
+
+    def tls_context(self):
+        """TLS context for the broker connection from MQTT_CA_CERT / MQTT_CERT_FILE / MQTT_KEY_FILE."""
+        ca_cert = os.getenv("MQTT_CA_CERT") # Path to CA cert for TLS verification
+        cert_file = os.getenv("MQTT_CERT_FILE") # Path to client cert (for mTLS)
+        key_file = os.getenv("MQTT_KEY_FILE")   # Path to client key (for mTLS)
+        log.info("Configuring MQTT TLS...")
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if ca_cert:
+            # Verify the broker certificate against the CA
+            context.load_verify_locations(cafile=ca_cert)
+            log.info("Loaded CA certificate for broker verification: %s", ca_cert)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+        else:
+            # Allow connection without verifying server cert (less secure)
+            log.warning("MQTT_CA_CERT not specified, TLS connection to broker will be unverified.")
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        # Load client certificate/key if provided (for mutual TLS)
+        if cert_file and key_file:
+            log.info("Loading client certificate: %s and key: %s for mTLS", cert_file, key_file)
+            context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+        elif cert_file or key_file:
+            log.warning("MQTT_CERT_FILE or MQTT_KEY_FILE specified, but not both. Client certificate not loaded.")
+        return context
+
+    async def start(self):
+        # Use CallbackAPIVersion.VERSION2 for reason_code
+        protocol = mqtt.MQTTv5 if self.protocol == "5" else mqtt.MQTTv311
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=protocol)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+
+        user, password = os.getenv("MQTT_USER"), os.getenv("MQTT_PASSWORD")
+        if user and password:
+            client.username_pw_set(user, password)
+            log.info("MQTT username/password configured for user: %s", user)
+        if self.use_tls:
+            client.tls_set_context(self.tls_context())
+
+        log.info("Connecting to MQTT broker at %s:%d...", self.host, self.port)
+        try:
+            # The first connect is blocking; later reconnects are handled by paho's thread
+            await asyncio.get_running_loop().run_in_executor(None, client.connect, self.host, self.port, 60) # 60 second keepalive
+        except ssl.SSLError as e:
+            log.error("MQTT TLS/SSL Connection Error: %s. Check certificates and TLS configuration on broker/client.", e)
+            raise
+        except ConnectionRefusedError as e:
+            log.error("MQTT Connection Refused: %s. Check broker address, port, firewall, and authentication settings.", e)
+            raise
+        self.client = client
+        metrics.start_rate_reporter(MESSAGES_RECEIVED, self.throughput_log_interval, "MQTT throughput")
+        log.info("Starting MQTT network loop...")
+        client.loop_start()
+
+    async def stop(self):
+        if self.client is not None:
+            log.info("Disconnecting from MQTT broker...")
+            self.client.disconnect()
+            self.client.loop_stop()
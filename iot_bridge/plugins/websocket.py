@@ -0,0 +1,308 @@
+"""
+WebSocket front end: each text or binary message is one JSON reading.
+
+Every connection has a bounded queue between the task reading frames and the
+task forwarding them. When the gateway falls behind, the queue fills, reading
+stops, and TCP flow control pushes back on the device instead of the bridge
+buffering without limit. Forwarding is native async when aiohttp is installed,
+with one cap on requests in flight across all connections (HTTP_MAX_IN_FLIGHT).
+
+High-rate clients can negotiate a batch sub-protocol instead of sending one
+reading per message. Each frame then carries many readings and a sequence
+number::
+
+    {"seq": 42, "readings": [{"temperature": 21.5}, {"temperature": 21.6}]}
+
+encoded as JSON text (``iot-batch.json``), or as MessagePack
+(``iot-batch.msgpack``) or CBOR (``iot-batch.cbor``) binary frames when msgspec or
+cbor2 is installed. A frame is forwarded as one POST to the gateway's batch
+endpoint, and the bridge replies in the same encoding with a cumulative
+``{"ack": seq}`` once every frame up to ``seq`` has been forwarded (accepted,
+batched or journaled). A frame that could not be forwarded is answered with
+``{"nack": seq, "error": ...}`` so the client can resend it; acks then stay
+below that seq until the resent frame is forwarded, so an ack never covers a
+frame still to be resent. A frame nacked as ``invalid frame`` is rejected for
+good and does not hold acks back. Clients bound their window of
+unacknowledged frames by these acks.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import ssl
+import time
+
+import websockets
+
+from .. import codec, metrics
+from ..logsampling import SampledLogger
+from . import Plugin
+
+try:
+    import msgspec
+except ImportError: # Optional; enables iot-batch.msgpack
+    msgspec = None
+try:
+    import cbor2
+except ImportError: # Optional; enables iot-batch.cbor
+    cbor2 = None
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+# Batch sub-protocol -> (decode, encode) for its frames
+BATCH_PROTOCOLS = {"iot-batch.json": (codec.loads, lambda message: codec.dumps(message).decode("utf-8"))} # Text frames
+if msgspec is not None:
+    BATCH_PROTOCOLS["iot-batch.msgpack"] = (msgspec.msgpack.decode, msgspec.msgpack.encode)
+if cbor2 is not None:
+    BATCH_PROTOCOLS["iot-batch.cbor"] = (cbor2.loads, cbor2.dumps)
+
+WS_CONNECTIONS = metrics.gauge("bridge_ws_connections", "Open WebSocket connections")
+WS_CONNECTS = metrics.counter("bridge_ws_connections_total", "WebSocket connections accepted (device reconnects included)")
+WS_MESSAGES = metrics.counter("bridge_ws_messages_total", "WebSocket messages received, by sub-protocol")
+WS_READINGS = metrics.counter("bridge_ws_readings_total", "Readings received over WebSocket (one per message, or per batch frame entry)")
+WS_ACKS = metrics.counter("bridge_ws_acks_total", "Batch frame acknowledgements sent, by kind (ack/nack)")
+WS_BYTES = metrics.counter("bridge_ws_bytes_total", "WebSocket message bytes received (after decompression)")
+WS_BACKPRESSURE = metrics.counter("bridge_ws_backpressure_total", "Times a connection stopped reading because its queue was full")
+
+
+class ConnectionStats:
+    """Throughput counters for one WebSocket connection."""
+    __slots__ = ("peer", "opened", "messages", "bytes", "forwarded", "paused")
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.opened = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+        self.forwarded = 0 # Readings
+        self.paused = 0 # Reads held back by a full queue
+
+    def rate(self):
+        """Messages per second since the connection opened."""
+        return self.messages / max(time.monotonic() - self.opened, 1e-9)
+
+    def as_dict(self):
+        return {
+            "peer": f"{self.peer[0]}:{self.peer[1]}",
+            "seconds": round(time.monotonic() - self.opened, 1),
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "forwarded": self.forwarded,
+            "paused": self.paused,
+            "messages_per_second": round(self.rate(), 2),
+        }
+
+
+class WebSocketPlugin(Plugin):
+    name = "websocket"
+
+    def __init__(self, runtime):
+        super().__init__(runtime)
+        self.port = int(os.getenv("WS_PORT", "8765")) # Use different port from Go UI/WS (8081)
+        self.bind_addr = os.getenv("WS_BIND", "0.0.0.0") # Listen on all interfaces
+        self.cert_file = os.getenv("WS_CERT_FILE") # Optional: Path to cert for WSS
+        self.key_file = os.getenv("WS_KEY_FILE")   # Optional: Path to key for WSS
+        self.connection_queue = int(os.getenv("WS_CONNECTION_QUEUE", "64")) # Messages read ahead per connection
+        self.max_queue = int(os.getenv("WS_MAX_QUEUE", "16")) # Frames buffered by websockets before reading stops
+        self.max_size = int(os.getenv("WS_MAX_MESSAGE_BYTES", str(1024 * 1024)))
+        self.compression = os.getenv("WS_COMPRESSION", "deflate") # permessage-deflate, or "none"
+        self.stats_log_interval = int(os.getenv("WS_STATS_LOG_INTERVAL", "0")) # Seconds, 0 disables
+        self.ack_every = int(os.getenv("WS_ACK_EVERY", "8")) # Batch frames per ack while more are queued
+        self.lane = runtime.lane("websocket", "WS")
+        self.connections = {}
+        self.server = None
+        self._reporter = None
+
+    def connection_stats(self, limit=None):
+        """Per-connection throughput, busiest first."""
+        busiest = heapq.nlargest(limit or len(self.connections), self.connections.values(), key=ConnectionStats.rate)
+        return [stats.as_dict() for stats in busiest]
+
+    async def handler(self, websocket):
+        client_addr = websocket.remote_address
+        protocol = websocket.subprotocol or "reading"
+        log.info("WebSocket connected from %s (%s)", client_addr, protocol)
+        stats = ConnectionStats(client_addr)
+        self.connections[websocket] = stats
+        WS_CONNECTIONS.inc()
+        WS_CONNECTS.inc()
+        queue = asyncio.Queue(maxsize=self.connection_queue)
+        if websocket.subprotocol in BATCH_PROTOCOLS:
+            sender = asyncio.create_task(self.forward_frames(websocket, queue, stats))
+        else:
+            sender = asyncio.create_task(self.forward_messages(client_addr, queue, stats))
+        try:
+            async for message in websocket:
+                stats.messages += 1
+                stats.bytes += len(message)
+                WS_MESSAGES.inc(protocol=protocol)
+                WS_BYTES.inc(len(message))
+                if queue.full():
+                    # Stop reading until the gateway catches up; websockets' own buffer
+                    # (WS_MAX_QUEUE frames) then fills and TCP pushes back on the client
+                    stats.paused += 1
+                    WS_BACKPRESSURE.inc()
+                await queue.put(message)
+
+        except websockets.exceptions.ConnectionClosedOK:
+            log.info("WebSocket disconnected gracefully from %s", client_addr)
+        except websockets.exceptions.ConnectionClosedError as e:
+            log.warning("WebSocket disconnected with error from %s: %s", client_addr, e)
+        except Exception as e:
+            log.exception("Unexpected error in WebSocket handler for %s: %s", client_addr, e) # Log traceback
+        finally:
+            await queue.put(None) # Forward what was already read, then stop
+            await sender
+            del self.connections[websocket]
+            WS_CONNECTIONS.dec()
+            log.info("WebSocket connection handler finished for %s: %s", client_addr, stats.as_dict())
+
+    async def forward_messages(self, client_addr, queue, stats):
+        """Forward one connection's messages in order until a None sentinel."""
+        # Add source/device info if missing
+        envelope = {'source': 'websocket', 'device_id': f"ws_{client_addr[0]}_{client_addr[1]}"} # Example ID from address
+        while True:
+            message = await queue.get()
+            if message is None:
+                return
+            WS_READINGS.inc()
+            self.lane.received(len(message), envelope['device_id'])
+            try:
+                for reading in self.lane.prepare(message, envelope):
+                    await self.lane.send(reading)
+                stats.forwarded += 1
+            except codec.DecodeError:
+                sampled_log.warning("Received non-JSON WebSocket message from %s: %s...", client_addr, message[:100])
+            except Exception as e:
+                log.exception("Error processing WebSocket message from %s: %s", client_addr, e) # Log traceback
+
+    async def forward_frames(self, websocket, queue, stats):
+        """Forward one connection's batch frames in order and acknowledge them."""
+        client_addr = websocket.remote_address
+        decode, encode = BATCH_PROTOCOLS[websocket.subprotocol]
+        envelope = {'source': 'websocket', 'device_id': f"ws_{client_addr[0]}_{client_addr[1]}"}
+        forwarded = None # Highest seq forwarded
+        acked = None # Highest seq acknowledged
+        nacked = set() # Seqs nacked for a resend: acks stay below them until they are forwarded
+        since_ack = 0
+
+        async def send_ack():
+            nonlocal acked, since_ack
+            since_ack = 0
+            if forwarded is None:
+                return
+            limit = min(forwarded, min(nacked) - 1) if nacked else forwarded
+            if acked is None or limit > acked:
+                await self.reply(websocket, encode, {"ack": limit})
+                acked = limit
+
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                await send_ack()
+                return
+            seq = None
+            rejected = False
+            self.lane.received(len(frame), envelope['device_id'])
+            try:
+                # Validate the whole frame before filtering any of it: filtering stores,
+                # rate-limits and deadbands readings, which a rejected frame must not do
+                frame = decode(frame)
+                seq = frame["seq"]
+                if not isinstance(seq, int) or isinstance(seq, bool):
+                    raise ValueError("seq must be an integer")
+                received = frame["readings"]
+                if not isinstance(received, list) or not all(isinstance(reading, dict) for reading in received):
+                    raise ValueError("Readings must be a list of objects")
+            except (ValueError, KeyError, TypeError) as e:
+                sampled_log.warning("Invalid batch frame from %s: %s", client_addr, e)
+                error, rejected = "invalid frame", True # Resending it would not help
+            else:
+                try:
+                    readings = []
+                    for reading in received:
+                        for key, value in envelope.items():
+                            reading.setdefault(key, value)
+                        readings.extend(self.lane.filter(reading))
+                    WS_READINGS.inc(len(received))
+                    error = await self.lane.send_batch(readings) if readings else None
+                except Exception as e:
+                    log.exception("Error processing batch frame from %s: %s", client_addr, e)
+                    error = "internal error"
+
+            if error is not None:
+                await send_ack() # Acknowledge what came before, then report this frame
+                if not rejected and seq is not None:
+                    nacked.add(seq)
+                await self.reply(websocket, encode, {"nack": seq, "error": error})
+                continue
+            stats.forwarded += len(readings)
+            nacked.discard(seq)
+            forwarded = seq if forwarded is None else max(forwarded, seq)
+            since_ack += 1
+            # Cumulative acks: one per WS_ACK_EVERY frames while more are queued, else right away
+            if queue.empty() or since_ack >= self.ack_every:
+                await send_ack()
+
+    async def reply(self, websocket, encode, message):
+        WS_ACKS.inc(kind="ack" if "ack" in message else "nack")
+        try:
+            await websocket.send(encode(message))
+        except websockets.exceptions.ConnectionClosed:
+            pass # The client is gone; it will resend whatever was not acknowledged
+
+    def select_subprotocol(self, connection, subprotocols):
+        """The first batch sub-protocol the client offers; None keeps one reading per message."""
+        return next((protocol for protocol in subprotocols if protocol in BATCH_PROTOCOLS), None)
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_log_interval)
+            if self.connections:
+                log.info("WebSocket connections: %d, busiest: %s", len(self.connections), self.connection_stats(limit=5))
+
+    def tls_context(self):
+        """TLS (SSL) context for WSS if cert/key paths are provided and exist, else None."""
+        if not (self.cert_file and self.key_file):
+            log.info("TLS cert/key files not specified. Starting WebSocket server without TLS (WS).")
+            return None
+        log.info("Checking for TLS cert=%s, key=%s", self.cert_file, self.key_file)
+        if not (os.path.exists(self.cert_file) and os.path.exists(self.key_file)):
+            log.warning("TLS cert/key files specified but not found. Starting WS without TLS.")
+            return None
+        try:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert_file, self.key_file)
+            log.info("TLS context created successfully.")
+            return context
+        except Exception as e:
+            log.exception("Error loading TLS cert/key: %s. Starting WS without TLS.", e) # Log traceback
+            return None
+
+    async def start(self):
+        ssl_context = self.tls_context()
+        protocol = "WSS (TLS)" if ssl_context is not None else "WS"
+        log.info("Starting %s server on %s:%d (compression: %s)", protocol, self.bind_addr, self.port, self.compression)
+        try:
+            # reuse_port lets every worker process bind the same port; the kernel balances connections
+            self.server = await websockets.serve(
+                self.handler, self.bind_addr, self.port, ssl=ssl_context,
+                compression="deflate" if self.compression == "deflate" else None, # Negotiated per client
+                select_subprotocol=self.select_subprotocol,
+                max_queue=self.max_queue,
+                max_size=self.max_size,
+                reuse_port=self.runtime.processes > 1,
+            )
+        except OSError as e:
+            log.error("Error starting WebSocket server (maybe port %d is in use?): %s", self.port, e)
+            raise
+        if self.stats_log_interval > 0:
+            self._reporter = asyncio.create_task(self.report_stats())
+
+    async def stop(self):
+        if self._reporter is not None:
+            self._reporter.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,126 @@
+"""
+On-demand profile snapshots of a running bridge.
+
+`snapshot_from_env()` (SIGUSR2 in the runtime) profiles the process for
+``TRACE_PROFILE_SECONDS`` in the background and writes the result to
+``TRACE_DIR``, together with the slowest recent traces (see tracing.py):
+
+- ``TRACE_PROFILE=folded`` (the default): a sampling profiler thread records the
+  Python stack of every thread each ``TRACE_PROFILE_INTERVAL_MS`` and writes
+  them as collapsed stacks, one ``thread;outer;...;inner count`` line per
+  distinct stack, with frames named ``function (file:line)``. This is the
+  format of ``py-spy record --format raw``, read by flamegraph.pl and
+  speedscope. Threads blocked in a wait are sampled too, in the call that waits.
+- ``TRACE_PROFILE=cprofile``: a deterministic cProfile of the event loop
+  thread, which runs the front ends, written as pstats (``python -m pstats``).
+"""
+import collections
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+PROFILES = ("folded", "cprofile")
+
+_busy = threading.Lock() # Held while a snapshot is being taken
+
+
+def sample_stacks(seconds, interval):
+    """{collapsed stack: samples} of every other thread, sampled every `interval` seconds."""
+    counts = collections.Counter()
+    labels = {} # code object -> frame label
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread {ident}"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def write_folded(path, counts):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def snapshot(directory, profile="folded", seconds=30.0, interval=0.01, loop=None):
+    """Profile for `seconds` in the background and write the files to `directory`.
+
+    The cprofile mode profiles the thread `loop` runs on and must be called
+    from it. Returns False (and does nothing) while another snapshot runs.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown profile {profile!r}, expected one of {PROFILES}")
+    if not _busy.acquire(blocking=False):
+        log.warning("A profile snapshot is already being taken")
+        return False
+    try:
+        os.makedirs(directory, exist_ok=True)
+        stamp = f"{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        traces = tracing.dump_slowest(os.path.join(directory, f"traces-{stamp}.jsonl"))
+        if traces:
+            log.info("Wrote the %d slowest traces to %s", traces, directory)
+        if profile == "cprofile":
+            path = os.path.join(directory, f"profile-{stamp}.pstats")
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+            def done():
+                profiler.disable()
+                try:
+                    profiler.dump_stats(path)
+                    log.info("Wrote event loop profile to %s", path)
+                finally:
+                    _busy.release()
+            loop.call_later(seconds, done)
+        else:
+            path = os.path.join(directory, f"profile-{stamp}.folded")
+
+            def run():
+                try:
+                    write_folded(path, sample_stacks(seconds, interval))
+                    log.info("Wrote sampled profile to %s", path)
+                except OSError as e:
+                    log.error("Could not write profile to %s: %s", path, e)
+                finally:
+                    _busy.release()
+            threading.Thread(target=run, name="profiler", daemon=True).start()
+    except BaseException:
+        _busy.release()
+        raise
+    log.info("Profiling (%s) for %.0f seconds", profile, seconds)
+    return True
+
+
+def snapshot_from_env(loop=None):
+    """Take a snapshot as configured by TRACE_DIR, TRACE_PROFILE, TRACE_PROFILE_SECONDS and TRACE_PROFILE_INTERVAL_MS."""
+    try:
+        return snapshot(
+            os.getenv("TRACE_DIR", "/tmp/iot-bridge-traces"),
+            profile=os.getenv("TRACE_PROFILE", "folded").lower(),
+            seconds=float(os.getenv("TRACE_PROFILE_SECONDS", "30")),
+            interval=float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "10")) / 1000.0,
+            loop=loop,
+        )
+    except (OSError, ValueError) as e:
+        log.error("Could not take a profile snapshot: %s", e)
+        return False
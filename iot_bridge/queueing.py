@@ -0,0 +1,193 @@
+"""
+Bounded hand-off queue between a protocol's receive thread and forwarder workers.
+
+Receive callbacks (e.g. paho's on_message) only put() readings on a
+``ForwardQueue``; a ``WorkerPool`` of threads drains it and does the blocking
+HTTP work. When the queue is full, the configured overflow policy decides what
+happens to the new reading:
+
+- ``drop_oldest``: discard the oldest queued reading to make room
+- ``block``: wait for space (applies back-pressure to the caller)
+- ``spill``: append the reading to an on-disk spill file, replayed once the queue drains
+"""
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+from . import codec, metrics
+
+log = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_oldest", "block", "spill")
+
+QUEUE_DEPTH = metrics.gauge("bridge_queue_depth", "Readings waiting in the forward queue")
+SPILL_DEPTH = metrics.gauge("bridge_queue_spilled", "Readings waiting in the on-disk spill file")
+QUEUE_OVERFLOW = metrics.counter("bridge_queue_overflow_total", "Readings that hit a full queue, labelled by action taken")
+QUEUE_LAG = metrics.histogram("bridge_queue_lag_seconds", "Time from enqueue to forward completion",
+                              buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0))
+
+
+class SpillFile:
+    """Append-only file of (enqueued_at, payload) items in FIFO order.
+
+    Each line is the enqueue time, a space and the payload's JSON. Payloads are
+    read back as encoded bytes, which the forwarder sends without re-encoding.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._read_offset = 0
+        # Items left over from a previous run are replayed too
+        self.pending = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.pending = sum(1 for _ in f)
+        self._writer = open(path, "ab")
+
+    def append(self, item):
+        enqueued_at, payload = item
+        line = repr(enqueued_at).encode("ascii") + b" " + codec.encoded(payload) + b"\n"
+        with self._lock:
+            self._writer.write(line)
+            self._writer.flush()
+            self.pending += 1
+
+    def pop_many(self, limit):
+        """Read up to `limit` of the oldest items; truncates the file once fully drained."""
+        with self._lock:
+            if not self.pending:
+                return []
+            items = []
+            with open(self.path, "rb") as f:
+                f.seek(self._read_offset)
+                while len(items) < limit:
+                    line = f.readline()
+                    if not line:
+                        break
+                    self._read_offset += len(line)
+                    try:
+                        if line.startswith(b"["):
+                            items.append(tuple(codec.loads(line))) # [enqueued_at, payload] from older versions
+                        else:
+                            enqueued_at, _, payload = line.rstrip(b"\n").partition(b" ")
+                            items.append((float(enqueued_at), payload))
+                    except ValueError:
+                        log.warning("Skipping corrupt spill record in %s", self.path)
+                    self.pending -= 1
+            if self._read_offset >= self._writer.tell():
+                self._writer.truncate(0)
+                self._writer.seek(0)
+                self._read_offset = 0
+                self.pending = 0
+            return items
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+
+
+class ForwardQueue:
+    """Bounded FIFO of (enqueued_at, payload) items with an explicit overflow policy."""
+
+    def __init__(self, name, maxsize=10000, overflow="drop_oldest", spill_path=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        if overflow == "spill" and not spill_path:
+            raise ValueError("overflow='spill' requires spill_path")
+        self.name = name
+        self.overflow = overflow
+        self._queue = queue.Queue(maxsize)
+        self._spill = SpillFile(spill_path) if overflow == "spill" else None
+        # Items read back from the spill file; served before the in-memory queue
+        self._replay = collections.deque()
+        self._replay_lock = threading.Lock()
+
+    def put(self, payload):
+        item = (time.time(), payload)
+        if self.overflow == "block":
+            self._queue.put(item)
+        elif self._spill is not None and self._spill.pending:
+            # Keep FIFO order: once spilling, new items follow the spilled ones
+            self._spill.append(item)
+            QUEUE_OVERFLOW.inc(queue=self.name, action="spilled")
+            SPILL_DEPTH.set(self._spill.pending, queue=self.name)
+        else:
+            self._put_nowait(item)
+        QUEUE_DEPTH.set(self._queue.qsize(), queue=self.name)
+
+    def _put_nowait(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            if self._spill is not None:
+                self._spill.append(item)
+                QUEUE_OVERFLOW.inc(queue=self.name, action="spilled")
+                SPILL_DEPTH.set(self._spill.pending, queue=self.name)
+                return
+            try:
+                self._queue.get_nowait()
+                QUEUE_OVERFLOW.inc(queue=self.name, action="dropped_oldest")
+            except queue.Empty:
+                pass
+
+    def get(self, timeout=None):
+        """Return the next (enqueued_at, payload) item, refilling from the spill file when drained."""
+        if self._spill is not None:
+            with self._replay_lock:
+                if not self._replay and self._spill.pending and self._queue.empty():
+                    self._replay.extend(self._spill.pop_many(max(self._queue.maxsize // 2, 1)))
+                    SPILL_DEPTH.set(self._spill.pending, queue=self.name)
+                if self._replay:
+                    return self._replay.popleft()
+        item = self._queue.get(timeout=timeout)
+        QUEUE_DEPTH.set(self._queue.qsize(), queue=self.name)
+        return item
+
+    def qsize(self):
+        spilled = self._spill.pending + len(self._replay) if self._spill is not None else 0
+        return self._queue.qsize() + spilled
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+
+class WorkerPool:
+    """Threads that drain a ForwardQueue and call `handler(payload)` for each item."""
+
+    def __init__(self, forward_queue, handler, workers=4):
+        self.queue = forward_queue
+        self.handler = handler
+        self._stopping = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{forward_queue.name}-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                enqueued_at, payload = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.handler(payload)
+            except Exception as e:
+                log.exception("Forward worker error: %s", e)
+            finally:
+                QUEUE_LAG.observe(time.time() - enqueued_at, queue=self.queue.name)
+
+    def stop(self, timeout=None):
+        """Stop after the items already taken are handled; queued items are left in place."""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
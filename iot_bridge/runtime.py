@@ -0,0 +1,601 @@
+"""
+Single-process runtime hosting the protocol front ends as plugins.
+
+One asyncio event loop (uvloop when installed) runs every enabled front end:
+MQTT, WebSocket, CoAP and Modbus. They share one pooled HTTP client to the
+gateway, one metrics registry, the JSON codec, the local time-series store and
+the anomaly/aggregation/deadband/journal/batching stages. ``BRIDGE_PLUGINS`` picks the front ends::
+
+    BRIDGE_PLUGINS=mqtt,coap,modbus python -m iot_bridge
+
+Each plugin forwards through its own ``Lane``: the gateway attributes readings
+to a source by the ``X-Source-Identifier`` header, so batches, journals and
+queues are kept per source while the connections behind them are shared. With
+``SCHEDULE_MODE=fair`` the lanes instead share one fair queue that takes turns
+between devices and priority classes (see scheduling.py).
+
+With ``BRIDGE_TRACE`` (or SIGUSR1) sampled readings are timed stage by stage
+on their way to the gateway, and SIGUSR2 writes a profile snapshot (see
+tracing.py and profiling.py).
+
+With ``BRIDGE_CONFIG`` the settings, subscriptions and polled devices come from
+a file that is applied again whenever it changes (see config.py).
+
+With ``BRIDGE_PROCESSES`` above 1 a supervisor starts N copies of the runtime.
+The WebSocket and CoAP listeners bind with SO_REUSEPORT so the kernel spreads
+connections and datagrams across the processes, MQTT workers share a ``$share``
+subscription, and Modbus devices are partitioned between the processes.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import signal
+import sys
+
+import requests
+
+from . import codec, metrics, profiling, tracing
+from .aggregation import open_aggregator_from_env
+from .anomaly import open_screen_from_env
+from .batching import Batcher, batch_endpoint
+from .config import ConfigWatcher, needs_restart, open_config_from_env
+from .deadband import open_filter_from_env
+from .forwarder import AsyncForwarder, Forwarder, aiohttp, check_response, is_retryable
+from .journal import open_journal_from_env
+from .logsampling import SampledLogger
+from .queueing import ForwardQueue, WorkerPool
+from .scheduling import LaneQueue, open_policy_from_env, open_rate_limiter, open_scheduler_from_env, reading_identity
+from .streaming import Streamer
+from .supervisor import run_supervisor, worker_index
+from .tsdb import open_store_from_env, start_query_server
+from .wire import open_encoder_from_env
+
+try:
+    import uvloop
+except ImportError: # Optional; the default asyncio loop is used without it
+    uvloop = None
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log) # Per-message lines
+
+MESSAGES_RECEIVED = metrics.counter("bridge_messages_received_total", "Messages received from devices, by source")
+PAYLOAD_BYTES = metrics.histogram("bridge_payload_bytes", "Size of received message payloads, by source",
+                                  buckets=(64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576))
+DEVICE_MESSAGES = metrics.counter("bridge_device_messages_total", "Messages received by source and device (see METRICS_DEVICE_LIMIT)")
+# Devices get their own label up to this many per process, the rest count as "other"; 0 disables
+DEVICE_LABELS = metrics.LabelLimiter(int(os.getenv("METRICS_DEVICE_LIMIT", "0")))
+
+# Plugin name -> "module:Class", imported only when enabled
+PLUGINS = {
+    "mqtt": "iot_bridge.plugins.mqtt:MqttPlugin",
+    "websocket": "iot_bridge.plugins.websocket:WebSocketPlugin",
+    "coap": "iot_bridge.plugins.coap:CoapPlugin",
+    "modbus": "iot_bridge.plugins.modbus:ModbusPlugin",
+}
+
+
+def load_plugin(name):
+    """Import and return the plugin class registered under `name`."""
+    try:
+        module_name, class_name = PLUGINS[name].split(":")
+    except KeyError:
+        raise ValueError(f"Unknown bridge plugin {name!r}, expected one of {sorted(PLUGINS)}") from None
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class Lane:
+    """Forwarding path for one source: anomaly screen, aggregator, deadband filter,
+    hand-off queue, batcher (or streamer) and journal.
+
+    `put()` hands readings to worker threads, for front ends whose own loop must
+    not wait on the gateway; `send()` forwards from a coroutine instead, natively
+    when the lane has an AsyncForwarder. Anomalous readings skip the other stages
+    and are posted one by one from a priority worker.
+    """
+
+    def __init__(self, forwarder, source, env_prefix, queued=False, worker=None, async_forwarder=None,
+                 scheduler=None, rate_limiter=None, tsdb=None):
+        self.source = source
+        self.forwarder = forwarder
+        self.async_forwarder = async_forwarder
+        self.batch_endpoint = batch_endpoint(forwarder.endpoint)
+        self.journal = open_journal_from_env(forwarder, name=source if worker is None else f"{source}.{worker}")
+        # Readings handed to a background sender: JSON-array batches, or one long-lived NDJSON stream
+        forward_mode = os.getenv("FORWARD_MODE", "single")
+        self.batcher = None
+        if forward_mode == "batch":
+            self.batcher = Batcher(forwarder, journal=self.journal)
+        elif forward_mode == "stream":
+            self.batcher = Streamer(forwarder, journal=self.journal)
+        self.deadband = open_filter_from_env() # Report-by-exception; None forwards every reading
+        self.queue = None
+        self.workers = None
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter # Per-device token buckets; None is unlimited
+        self.tsdb = tsdb # Local copy of every decoded reading; None keeps nothing
+        if scheduler is not None:
+            self.queue = LaneQueue(scheduler, self) # Every reading goes through the shared fair queue
+        elif queued:
+            # The single-bridge spelling (MQTT_QUEUE_SIZE, ...) wins over the shared one
+            def setting(name, default):
+                return os.getenv(f"{env_prefix}_{name}", os.getenv(name, default))
+
+            spill_path = setting("SPILL_PATH", f"/tmp/{source}-http-spill.jsonl")
+            if worker is not None:
+                spill_path = f"{spill_path}.{worker}" # One spill file per worker process
+            self.queue = ForwardQueue(
+                source,
+                maxsize=int(setting("QUEUE_SIZE", "10000")),
+                overflow=setting("QUEUE_OVERFLOW", "drop_oldest"), # drop_oldest, block or spill
+                spill_path=spill_path,
+            )
+            workers = int(setting("FORWARD_WORKERS", "4"))
+            self.workers = WorkerPool(self.queue, self.forward, workers=workers)
+            log.info("Started %d %s forwarder workers (queue overflow policy: %s)", workers, source, self.queue.overflow)
+        self.aggregator = open_aggregator_from_env(source, self.forward_aggregate) # Windowed summaries; None forwards raw
+        self.anomaly = open_screen_from_env() # Edge pre-screen; None forwards every reading the normal way
+        self.priority = None
+        self._update_stages()
+
+    def _update_stages(self):
+        if self.anomaly is not None and self.priority is None:
+            # Fast lane: not batched, aggregated or queued behind normal readings
+            priority_queue = ForwardQueue(f"{self.source}-priority", maxsize=int(os.getenv("ANOMALY_QUEUE_SIZE", "1000")))
+            self.priority = WorkerPool(priority_queue, self.forward_now, workers=int(os.getenv("ANOMALY_FORWARD_WORKERS", "1")))
+        # Stages that need the decoded reading, rather than the raw payload with the envelope spliced in
+        self.decodes = any(stage is not None for stage in
+                           (self.deadband, self.aggregator, self.anomaly, self.rate_limiter, self.scheduler, self.tsdb))
+
+    def reconfigure(self, stages, rate_limiter=None):
+        """Rebuild `stages` ("deadband", "aggregation", "anomaly", "rate_limit") from the environment.
+
+        Raises ValueError (leaving every stage as it was) when a new setting is
+        invalid. A replaced aggregator forwards its open windows first. Blocking.
+        """
+        deadband = open_filter_from_env() if "deadband" in stages else self.deadband
+        anomaly = open_screen_from_env() if "anomaly" in stages else self.anomaly
+        aggregator = self.aggregator
+        if "aggregation" in stages:
+            aggregator = open_aggregator_from_env(self.source, self.forward_aggregate) # Last, as it starts a thread
+        replaced, self.aggregator = self.aggregator, aggregator
+        self.deadband, self.anomaly = deadband, anomaly
+        if "rate_limit" in stages:
+            self.rate_limiter = rate_limiter
+        self._update_stages()
+        if replaced is not None and replaced is not aggregator:
+            replaced.close()
+
+    def retarget(self, endpoint):
+        """Forward to `endpoint` from the next request on (TLS settings stay as they were)."""
+        self.forwarder.endpoint = endpoint
+        if self.async_forwarder is not None:
+            self.async_forwarder.endpoint = endpoint
+        self.batch_endpoint = batch_endpoint(endpoint)
+        if self.batcher is not None:
+            self.batcher.retarget(endpoint)
+        if self.journal is not None:
+            self.journal.replayer.endpoint = self.batch_endpoint
+
+    def received(self, size=None, device=None, at=None):
+        """Count a message received from a device, with `size` bytes of payload.
+
+        `at` is when the front end read it (time.monotonic()), for tracing.
+        """
+        if tracing.active:
+            tracing.begin(self.source, device, at)
+        MESSAGES_RECEIVED.inc(source=self.source)
+        if size is not None:
+            PAYLOAD_BYTES.observe(size, source=self.source)
+        if device is not None and DEVICE_LABELS.limit > 0:
+            DEVICE_MESSAGES.inc(source=self.source, device=DEVICE_LABELS(device))
+
+    def prepare(self, raw, envelope, path=None):
+        """Decode a raw payload into the readings to forward (none if all were suppressed).
+
+        Envelope fields are added where the payload does not set them. `path` is
+        the CoAP resource the payload arrived on, for aggregation rules. Raises
+        codec.DecodeError for payloads that are not a JSON object.
+        """
+        trace = tracing.current() if tracing.active else None
+        if trace is not None:
+            trace.mark("receive")
+        if not self.decodes:
+            # Parse once (straight from bytes) and splice the envelope into the original payload
+            readings = [codec.enrich(raw, envelope)]
+            if trace is not None:
+                tracing.handoff(trace, readings, "decode")
+            return readings
+        reading = codec.decode_reading(raw, envelope)
+        if trace is not None:
+            trace.mark("decode")
+        return self.filter(reading, path)
+
+    def filter(self, reading, path=None):
+        """Readings to forward for an already decoded reading."""
+        trace = tracing.current() if tracing.active else None
+        if self.tsdb is not None:
+            self.tsdb.append_reading(reading)
+        if self.anomaly is not None:
+            flagged = self.anomaly.check(reading)
+            if flagged:
+                self.escalate(reading, flagged)
+                return [] # Already on its way
+        if self.rate_limiter is not None and not self.rate_limiter.allow(self.source, *reading_identity(reading)):
+            return [] # Over its device's rate
+        if self.aggregator is not None:
+            reading = self.aggregator.apply(reading, path)
+            if reading is None:
+                return [] # Every metric went into a window
+        readings = self.deadband.apply(reading) if self.deadband is not None else [reading]
+        if trace is not None:
+            tracing.handoff(trace, readings, "enrich")
+        return readings
+
+    def escalate(self, reading, flagged):
+        """Flag an anomalous reading and hand it to the priority worker."""
+        reading = dict(reading)
+        reading["anomalies"] = ",".join(flagged) # e.g. "temperature:max,humidity:zscore"
+        sampled_log.warning("Anomalous %s reading from %s: %s", self.source,
+                            reading.get("device_id", reading.get("sensor_id", "unknown")), reading["anomalies"])
+        self.priority.queue.put(reading)
+
+    def forward_aggregate(self, summary):
+        """Forward a window summary (from the aggregator's thread)."""
+        if self.queue is not None:
+            self.put(summary)
+        else:
+            self.forward(summary)
+
+    def put(self, reading):
+        """Queue a reading for the worker threads."""
+        self.queue.put(reading)
+
+    def store_for_replay(self, reading):
+        """Keep a reading the gateway could not accept in the journal; True if it was stored."""
+        return self.journal is not None and self.journal.append_json(reading)
+
+    def forward(self, reading):
+        """Forward one reading to the gateway, or queue it for batching (blocking)."""
+        if self.batcher is not None:
+            self.batcher.submit(reading) # Flushed to the batch endpoint in the background
+            return
+        self.forward_now(reading)
+
+    def forward_now(self, reading):
+        """POST one reading to the gateway, bypassing the batcher (blocking)."""
+        trace = tracing.take(reading, "enqueue") if tracing.active else None
+        try:
+            log.debug("Forwarding %s payload to HTTP endpoint: %s", self.source, self.forwarder.endpoint)
+            response = self.forwarder.post(reading, traces=[(0, trace)] if trace is not None else None)
+            sampled_log.info("Forwarded %s reading via HTTP, response: %d %s", self.source, response.status_code, response.reason)
+            if not check_response(response) and is_retryable(response):
+                self.store_for_replay(reading)
+        except requests.exceptions.Timeout:
+            sampled_log.error("HTTP post timed out to %s", self.forwarder.endpoint)
+            self.store_for_replay(reading)
+        except requests.exceptions.RequestException as e:
+            sampled_log.error("Error sending data to HTTP endpoint %s: %s", self.forwarder.endpoint, e)
+            self.store_for_replay(reading)
+
+    async def post_async(self, reading, url=None, traces=None):
+        """POST one reading (or an encoded body) from a coroutine and return the response.
+
+        `traces` are the (index, Trace) pairs of traced readings in the body.
+        """
+        if self.async_forwarder is not None:
+            return await self.async_forwarder.post_body(codec.encoded(reading), url=url, traces=traces)
+        # Runs on the forwarder's pool, sized to its connection pool
+        return await self.forwarder.post_async(reading, url=url, traces=traces)
+
+    async def send(self, reading):
+        """Forward one reading from a coroutine, or queue it for batching or scheduling."""
+        if self.scheduler is not None:
+            self.queue.put(reading)
+            return
+        if self.batcher is not None:
+            self.batcher.submit(reading)
+            return
+        trace = tracing.take(reading, "enqueue") if tracing.active else None
+        try:
+            response = await self.post_async(reading, traces=[(0, trace)] if trace is not None else None)
+            sampled_log.info("Forwarded %s reading via HTTP, response: %d %s", self.source, response.status_code, response.reason)
+            if not check_response(response) and is_retryable(response):
+                self.store_for_replay(reading)
+        except requests.exceptions.Timeout:
+            sampled_log.error("HTTP post timed out to %s", self.forwarder.endpoint)
+            self.store_for_replay(reading)
+        except requests.exceptions.RequestException as e:
+            sampled_log.error("Error sending data to HTTP endpoint %s: %s", self.forwarder.endpoint, e)
+            self.store_for_replay(reading)
+
+    async def send_batch(self, readings):
+        """Forward readings from a coroutine as one POST to the batch endpoint.
+
+        Returns None once they were accepted, queued for batching or scheduling, or
+        journaled; otherwise why they were not (an HTTP status code, "timeout" or
+        "unavailable").
+        """
+        if self.scheduler is not None:
+            for reading in readings:
+                self.queue.put(reading)
+            return None
+        if self.batcher is not None:
+            for reading in readings:
+                self.batcher.submit(reading)
+            return None
+        traces = None
+        if tracing.active:
+            traces = [(index, trace) for index, trace in enumerate(tracing.take(reading, "enqueue") for reading in readings)
+                      if trace is not None]
+        body = b"[" + b",".join(codec.encoded(reading) for reading in readings) + b"]"
+        try:
+            response = await self.post_async(body, url=self.batch_endpoint, traces=traces)
+            if check_response(response):
+                return None
+            if not is_retryable(response):
+                return response.status_code
+            failure = response.status_code
+        except requests.exceptions.Timeout:
+            sampled_log.error("Batch post of %d readings timed out to %s", len(readings), self.batch_endpoint)
+            failure = "timeout"
+        except requests.exceptions.RequestException as e:
+            sampled_log.error("Batch post error to %s: %s", self.batch_endpoint, e)
+            failure = "unavailable"
+        if self.journal is not None and all(self.store_for_replay(reading) for reading in readings):
+            return None
+        return failure
+
+    def drain(self, timeout=10):
+        """Stop the stages that feed the queue: the priority worker and the aggregator."""
+        if self.priority is not None:
+            self.priority.stop(timeout=timeout)
+        if self.aggregator is not None:
+            self.aggregator.close(timeout=timeout) # Forward the open windows
+
+    def close(self, timeout=10):
+        if self.workers is not None:
+            self.workers.stop(timeout=timeout)
+            self.queue.close()
+        if self.batcher is not None:
+            self.batcher.close(timeout=timeout) # Flush pending readings
+        if self.journal is not None:
+            self.journal.replayer.stop(timeout=timeout)
+            self.journal.close()
+
+
+class Runtime:
+    """Runs the enabled plugins on one event loop until stopped."""
+
+    def __init__(self, plugin_names, processes=1, config=None):
+        if not plugin_names:
+            raise ValueError("No bridge plugins enabled (BRIDGE_PLUGINS)")
+        endpoint = os.getenv("HTTP_ENDPOINT", "https://go-iot-gateway:8080/data")
+        api_key = os.getenv("GATEWAY_API_KEY")
+        if not api_key:
+            log.error("GATEWAY_API_KEY environment variable not set!")
+            sys.exit(1)
+        encoder = open_encoder_from_env() # Compression and envelope of request bodies
+        # One pooled HTTP client (keep-alive connections, TLS session reuse) for every lane
+        self.forwarder = Forwarder(endpoint, api_key, source=plugin_names[0], encoder=encoder)
+        if not self.forwarder.verify_ssl:
+            log.warning("SSL verification disabled for Go Gateway endpoint: %s", endpoint)
+        # Coroutines post natively when aiohttp is installed, sharing one in-flight limit
+        self.async_forwarder = None
+        if aiohttp is not None and os.getenv("HTTP_ASYNC_CLIENT", "true").lower() == "true":
+            self.async_forwarder = AsyncForwarder(endpoint, api_key, source=plugin_names[0], encoder=encoder)
+        tracing.configure_from_env()
+        self.processes = processes
+        self.worker = worker_index()
+        self.config = config # BridgeConfig, or None without BRIDGE_CONFIG
+        policy = open_policy_from_env() # Priority classes and per-device rate limits
+        self.scheduler = open_scheduler_from_env(policy)
+        self.rate_limiter = open_rate_limiter(policy)
+        self.tsdb = open_store_from_env(name=None if self.worker is None else f"worker-{self.worker}")
+        self.lanes = []
+        self.metrics_server = None
+        self.query_server = None
+        self.plugins = [load_plugin(name)(self) for name in plugin_names]
+        self._stopped = None
+        self._reload_lock = asyncio.Lock()
+
+    def config_section(self, name):
+        """A plugin's section of the bridge config ({} without one)."""
+        return self.config.section(name) if self.config is not None else {}
+
+    def lane(self, source, env_prefix, queued=False):
+        """Create the forwarding lane for one plugin's source."""
+        async_forwarder = self.async_forwarder.for_source(source) if self.async_forwarder is not None else None
+        lane = Lane(self.forwarder.for_source(source), source, env_prefix, queued=queued, worker=self.worker,
+                    async_forwarder=async_forwarder, scheduler=self.scheduler, rate_limiter=self.rate_limiter,
+                    tsdb=self.tsdb)
+        self.lanes.append(lane)
+        return lane
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        # Diagnostics: SIGUSR1 toggles tracing, SIGUSR2 writes a profile snapshot
+        loop.add_signal_handler(signal.SIGUSR1, tracing.toggle)
+        loop.add_signal_handler(signal.SIGUSR2, lambda: profiling.snapshot_from_env(loop))
+        metrics.start_log_reporter(int(os.getenv("METRICS_LOG_INTERVAL", "0"))) # Seconds, 0 disables
+        self.serve_metrics()
+        self.serve_queries()
+        watcher = None
+        if self.config is not None:
+            watcher = ConfigWatcher(self.config.path, self.reload, poll_interval=float(os.getenv("BRIDGE_CONFIG_POLL_INTERVAL", "2")))
+            watcher.start()
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload(force=True)))
+
+        started = []
+        try:
+            for plugin in self.plugins:
+                await plugin.start()
+                started.append(plugin)
+            log.info("Bridge runtime started: %s (endpoint %s, SSL verification %s)",
+                     ", ".join(p.name for p in self.plugins), self.forwarder.endpoint, self.forwarder.verify_ssl)
+            await self._stopped
+        finally:
+            log.info("Stopping bridge runtime...")
+            if watcher is not None:
+                watcher.stop()
+            for plugin in reversed(started):
+                try:
+                    await plugin.stop()
+                except Exception as e:
+                    log.exception("Error stopping %s plugin: %s", plugin.name, e)
+            for lane in self.lanes:
+                lane.drain()
+            if self.scheduler is not None:
+                self.scheduler.close(timeout=10)
+            for lane in self.lanes:
+                lane.close()
+            if self.query_server is not None:
+                self.query_server.shutdown()
+                self.query_server.server_close()
+            if self.tsdb is not None:
+                self.tsdb.close() # Seal the in-memory heads
+            if self.async_forwarder is not None:
+                await self.async_forwarder.close()
+            self.forwarder.close()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close()
+
+    async def reload(self, force=False):
+        """Apply the bridge config again if it changed (or, with `force`, re-read everything it names)."""
+        async with self._reload_lock: # One at a time
+            await self._reload(force)
+
+    async def _reload(self, force):
+        try:
+            changed = self.config.load()
+        except ValueError as e:
+            log.error("Keeping the current bridge configuration: %s", e)
+            return
+        if changed is None and not force:
+            return
+        changed = changed or set()
+        log.info("Applying bridge configuration from %s (changed settings: %s)",
+                 self.config.path, ", ".join(sorted(changed)) or "none")
+        restart = needs_restart(changed)
+        if restart:
+            log.warning("Restart the bridge to apply: %s", ", ".join(restart))
+
+        if force or changed & {"HTTP_ENDPOINT", "HTTP_BATCH_ENDPOINT", "HTTP_STREAM_ENDPOINT"}:
+            endpoint = os.getenv("HTTP_ENDPOINT", "https://go-iot-gateway:8080/data")
+            if endpoint != self.forwarder.endpoint or changed & {"HTTP_BATCH_ENDPOINT", "HTTP_STREAM_ENDPOINT"}:
+                log.info("Forwarding to %s from now on", endpoint)
+                self.forwarder.endpoint = endpoint
+                if self.async_forwarder is not None:
+                    self.async_forwarder.endpoint = endpoint
+                for lane in self.lanes:
+                    lane.retarget(endpoint)
+
+        # Rules files named by a setting are re-read on SIGHUP (force) as well
+        stages = {stage for stage, prefixes in STAGE_SETTINGS.items()
+                  if force or any(name.startswith(prefixes) for name in changed)}
+        rate_limiter = self.rate_limiter
+        if "rate_limit" in stages:
+            try:
+                policy = open_policy_from_env()
+                if self.scheduler is not None:
+                    self.scheduler.set_policy(policy)
+                rate_limiter = self.rate_limiter = open_rate_limiter(policy)
+            except (OSError, ValueError, TypeError) as e:
+                log.error("Keeping the current schedule rules and rate limits: %s", e)
+                stages.discard("rate_limit")
+        loop = asyncio.get_running_loop()
+        for lane in self.lanes:
+            try:
+                # Off the loop: a replaced aggregator forwards its open windows
+                await loop.run_in_executor(None, lane.reconfigure, stages, rate_limiter)
+            except (OSError, ValueError, TypeError) as e:
+                log.error("Keeping the current %s pipeline stages: %s", lane.source, e)
+
+        for plugin in self.plugins:
+            try:
+                await plugin.reconfigure(self.config)
+            except Exception as e:
+                log.exception("Error reconfiguring %s plugin: %s", plugin.name, e)
+
+    def serve_metrics(self):
+        """Serve /metrics on METRICS_PORT (plus the worker index under the supervisor)."""
+        port = int(os.getenv("METRICS_PORT", "9108")) # 0 disables
+        if port > 0 and self.worker is not None:
+            port += self.worker
+        try:
+            self.metrics_server = metrics.start_http_server(port, os.getenv("METRICS_BIND", "0.0.0.0"))
+        except OSError as e:
+            log.error("Could not serve metrics on port %d: %s", port, e) # Forwarding matters more
+
+    def serve_queries(self):
+        """Serve the time-series query API on TSDB_QUERY_PORT (plus the worker index under the supervisor)."""
+        if self.tsdb is None:
+            return
+        port = int(os.getenv("TSDB_QUERY_PORT", "9110")) # 0 disables
+        if port > 0 and self.worker is not None:
+            port += self.worker
+        try:
+            self.query_server = start_query_server(self.tsdb, port, os.getenv("TSDB_QUERY_BIND", "127.0.0.1"),
+                                                   max_points=int(os.getenv("TSDB_QUERY_MAX_POINTS", "1000000")))
+        except OSError as e:
+            log.error("Could not serve time-series queries on port %d: %s", port, e)
+
+    def stop(self):
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_result(None)
+
+
+# Lane stages rebuilt when settings with these prefixes change
+STAGE_SETTINGS = {
+    "deadband": ("DEADBAND_",),
+    "aggregation": ("AGGREGATE_",),
+    "anomaly": ("ANOMALY_",),
+    "rate_limit": ("SCHEDULE_RULES", "SCHEDULE_DEFAULT_CLASS", "RATE_LIMIT_"),
+}
+
+# Worker process count for a single-plugin bridge script, used when BRIDGE_PROCESSES is unset
+WORKER_PROCESSES_ENV = {"mqtt": "MQTT_WORKER_PROCESSES", "coap": "COAP_WORKER_PROCESSES"}
+
+
+def _plugins_from_env():
+    return [name.strip() for name in os.getenv("BRIDGE_PLUGINS", "").split(",") if name.strip()]
+
+
+def main(plugins=None):
+    """Run the bridge runtime with `plugins`, or those listed in BRIDGE_PLUGINS."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    try:
+        config = open_config_from_env() # Its settings apply before anything reads the environment
+    except ValueError as e:
+        log.error("Invalid bridge configuration: %s", e)
+        sys.exit(1)
+    plugins = plugins or _plugins_from_env()
+    processes_env = WORKER_PROCESSES_ENV.get(plugins[0]) if len(plugins) == 1 else None
+    default_processes = os.getenv(processes_env, "1") if processes_env else "1"
+    processes = int(os.getenv("BRIDGE_PROCESSES", default_processes))
+
+    # Supervisor mode: run N copies of the runtime sharing the listeners
+    if processes > 1 and worker_index() is None:
+        log.info("Starting %d bridge worker processes (%s)", processes, ", ".join(plugins))
+        # Workers load the config themselves, on top of the original environment
+        run_supervisor(processes, env=config.base_env if config is not None else None)
+        return
+
+    if uvloop is not None and os.getenv("BRIDGE_UVLOOP", "true").lower() == "true":
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info("Using uvloop event loop")
+    try:
+        runtime = Runtime(plugins, processes=processes, config=config)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+    try:
+        asyncio.run(runtime.run())
+    except Exception as e:
+        log.exception("Bridge runtime failed: %s", e)
+        sys.exit(1)
+    log.info("Exiting.")
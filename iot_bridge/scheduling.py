@@ -0,0 +1,383 @@
+"""
+Fair scheduling of outbound readings across devices and protocols.
+
+With ``SCHEDULE_MODE=fair`` the lanes of every plugin share one ``FairQueue``
+and one pool of forwarder workers instead of a FIFO queue each. Readings are
+queued per flow (source and device) inside a priority class, and workers take
+them in deficit round-robin order: each class is visited in turn and may send
+up to its weight in readings, its flows taking one reading each. A chatty MQTT
+topic or WebSocket client then only delays its own flow, not the Modbus polls
+or CoAP alarms sharing the gateway connection pool. When the queue is full the
+oldest reading of the longest flow is dropped.
+
+A ``RateLimiter`` enforces per-device token buckets before readings are queued.
+``SCHEDULE_RULES`` (a JSON list) assigns classes and rates; the first rule
+whose selectors match applies::
+
+    [{"source": "coap", "device": "alarm-*", "class": "critical"},
+     {"source": "websocket", "class": "bulk", "rate": 20, "burst": 40}]
+
+Selectors are ``source``, ``device`` (glob of the device id) and ``topic``
+(MQTT topic filter). Delays per class are exported as
+``bridge_schedule_delay_seconds``.
+"""
+import collections
+import fnmatch
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from . import metrics
+from .aggregation import topic_matches
+from .queueing import WorkerPool
+
+log = logging.getLogger(__name__)
+
+SCHEDULE_DELAY = metrics.histogram("bridge_schedule_delay_seconds", "Time readings waited in the fair queue, by class",
+                                   buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+SCHEDULE_DEPTH = metrics.gauge("bridge_schedule_depth", "Readings waiting in the fair queue, by class")
+SCHEDULE_DROPPED = metrics.counter("bridge_schedule_dropped_total", "Readings dropped from the longest flow of a full fair queue, by class")
+RATE_LIMITED = metrics.counter("bridge_rate_limited_total", "Readings over their device's rate limit, by source")
+
+DEFAULT_CLASSES = "critical:8,normal:4,bulk:1"
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ScheduleRule:
+    """Class and rate limit for readings matching the selectors."""
+
+    def __init__(self, source=None, device=None, topic=None, priority_class=None, rate=None, burst=None):
+        self.source = source
+        self.device = device
+        self.topic = topic
+        self.priority_class = priority_class
+        self.rate = rate # Readings per second per device; None is unlimited
+        self.burst = burst if burst is not None else (2 * rate if rate else None)
+
+    def matches(self, source, device, topic):
+        return ((self.source is None or self.source == source)
+                and (self.device is None or fnmatch.fnmatchcase(device, self.device))
+                and (self.topic is None or topic_matches(self.topic, topic)))
+
+
+class Policy:
+    """Class and rate limit of each (source, device, topic), from the first matching rule."""
+
+    def __init__(self, rules=(), default_class="normal", default_rate=None, default_burst=None):
+        self.default = ScheduleRule(priority_class=default_class, rate=default_rate, burst=default_burst)
+        self.rules = list(rules)
+        for rule in self.rules: # Settings a rule leaves out come from the default
+            if rule.priority_class is None:
+                rule.priority_class = self.default.priority_class
+            if rule.rate is None:
+                rule.rate, rule.burst = self.default.rate, self.default.burst
+        self._cache = {}
+
+    def lookup(self, source, device, topic):
+        key = (source, device, topic)
+        rule = self._cache.get(key)
+        if rule is None:
+            rule = next((r for r in self.rules if r.matches(source, device, topic)), self.default)
+            if len(self._cache) >= 10000:
+                self._cache.clear()
+            self._cache[key] = rule
+        return rule
+
+    def priority_class(self, source, device, topic):
+        return self.lookup(source, device, topic).priority_class
+
+
+class RateLimiter:
+    """Per-device token buckets; devices idle long enough to refill are forgotten first."""
+
+    def __init__(self, policy, max_devices=100000):
+        self.policy = policy
+        self.max_devices = max_devices
+        self._buckets = collections.OrderedDict() # (source, device) -> TokenBucket, least recently used first
+        self._lock = threading.Lock()
+
+    def allow(self, source, device, topic=""):
+        rule = self.policy.lookup(source, device, topic)
+        if rule.rate is None:
+            return True
+        key = (source, device)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_devices:
+                    self._buckets.popitem(last=False)
+                bucket = self._buckets[key] = TokenBucket(rule.rate, rule.burst, now)
+            else:
+                self._buckets.move_to_end(key)
+            allowed = bucket.take(now)
+        if not allowed:
+            RATE_LIMITED.inc(source=source)
+        return allowed
+
+
+class _Class:
+    __slots__ = ("name", "weight", "flows", "active", "credit", "size")
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.flows = {} # flow key -> deque of (enqueued_at, item)
+        self.active = collections.deque() # Flow keys with readings, in round-robin order
+        self.credit = 0
+        self.size = 0
+
+
+class FairQueue:
+    """Bounded queue served by deficit round-robin over classes and, within a class, over flows.
+
+    `get()` returns (enqueued_at, item) like ForwardQueue, so a WorkerPool can drain it.
+    """
+
+    overflow = "drop_oldest" # Of the longest flow; never blocks, as event-loop plugins share the queue
+
+    def __init__(self, name="scheduler", classes=None, maxsize=10000):
+        classes = classes or parse_classes(DEFAULT_CLASSES)
+        self.name = name
+        self.maxsize = maxsize
+        self._classes = {class_name: _Class(class_name, weight) for class_name, weight in classes.items()}
+        self._active = collections.deque() # Classes with readings
+        self._lengths = {} # Flow length -> {(class, flow)}, so the longest flow is found without a scan
+        self._longest = 0
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def put(self, item, flow, priority_class):
+        """Queue `item` on `flow` (e.g. (source, device)) in `priority_class`."""
+        cls = self._classes.get(priority_class)
+        if cls is None:
+            raise ValueError(f"Unknown priority class {priority_class!r}, expected one of {sorted(self._classes)}")
+        with self._cond:
+            if self._size >= self.maxsize:
+                self._drop_longest()
+            readings = cls.flows.get(flow)
+            if readings is None:
+                readings = cls.flows[flow] = collections.deque()
+                cls.active.append(flow)
+                if cls.size == 0:
+                    self._active.append(cls)
+            readings.append((time.time(), item))
+            self._resize(cls, flow, len(readings) - 1, len(readings))
+            cls.size += 1
+            self._size += 1
+            SCHEDULE_DEPTH.set(cls.size, priority_class=cls.name)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """The next (enqueued_at, item) in scheduling order; raises queue.Empty after `timeout`."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size, timeout):
+                raise queue.Empty
+            cls = self._active[0]
+            if cls.credit <= 0:
+                cls.credit = cls.weight
+            flow = cls.active[0]
+            readings = cls.flows[flow]
+            enqueued_at, item = readings.popleft()
+            self._resize(cls, flow, len(readings) + 1, len(readings))
+            if readings:
+                cls.active.rotate(-1) # One reading per flow per turn
+            else:
+                cls.active.popleft()
+                del cls.flows[flow]
+            cls.size -= 1
+            cls.credit -= 1
+            self._size -= 1
+            if cls.size == 0:
+                self._active.popleft()
+                cls.credit = 0
+            elif cls.credit <= 0:
+                self._active.rotate(-1) # Class used its weight; next class
+            SCHEDULE_DEPTH.set(cls.size, priority_class=cls.name)
+        SCHEDULE_DELAY.observe(time.time() - enqueued_at, priority_class=cls.name)
+        return enqueued_at, item
+
+    def _resize(self, cls, flow, old, new):
+        """Move a flow from the `old` to the `new` length bucket (lock held).
+
+        Lengths change by one at a time, so when the longest bucket empties the
+        flow that left it is one shorter and the new longest.
+        """
+        key = (cls, flow)
+        if old:
+            bucket = self._lengths[old]
+            bucket.discard(key)
+            if not bucket:
+                del self._lengths[old]
+        if new:
+            self._lengths.setdefault(new, set()).add(key)
+        if new > self._longest:
+            self._longest = new
+        elif old == self._longest and old not in self._lengths:
+            self._longest = new
+
+    def _drop_longest(self):
+        """Drop the oldest reading of the longest flow (lock held)."""
+        if self._longest == 1:
+            # Every flow holds one reading: take the one next in line, which empties
+            # its flow without searching the round-robin order for it
+            cls = self._active[0]
+            flow = cls.active[0]
+        else:
+            cls, flow = next(iter(self._lengths[self._longest]))
+        readings = cls.flows[flow]
+        readings.popleft()
+        self._resize(cls, flow, len(readings) + 1, len(readings))
+        if not readings:
+            cls.active.popleft()
+            del cls.flows[flow]
+        cls.size -= 1
+        self._size -= 1
+        if cls.size == 0:
+            self._active.remove(cls)
+            cls.credit = 0
+        SCHEDULE_DROPPED.inc(priority_class=cls.name)
+
+    def qsize(self):
+        return self._size
+
+    def close(self):
+        pass
+
+
+class LaneQueue:
+    """One lane's view of the shared FairQueue, standing in for its ForwardQueue."""
+
+    def __init__(self, scheduler, lane):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.name = scheduler.queue.name
+        self.overflow = scheduler.queue.overflow
+
+    def put(self, reading):
+        self.scheduler.put(self.lane, reading)
+
+    def qsize(self):
+        return self.scheduler.queue.qsize()
+
+    def close(self):
+        pass
+
+
+class Scheduler:
+    """Shared fair queue and forwarder workers for every lane of the runtime."""
+
+    def __init__(self, policy, fair_queue, workers=8):
+        self.policy = policy
+        self.queue = fair_queue
+        self.workers = WorkerPool(fair_queue, self._forward, workers=workers)
+
+    def set_policy(self, policy):
+        """Classify readings by `policy` from now on; the classes themselves are fixed."""
+        if policy is None:
+            raise ValueError("The fair scheduler needs a policy; SCHEDULE_MODE only changes on a restart")
+        check_classes(policy, self.queue._classes)
+        self.policy = policy
+
+    def put(self, lane, reading):
+        device, topic = reading_identity(reading)
+        flow = (lane.source, device)
+        self.queue.put((lane, reading), flow, self.policy.priority_class(lane.source, device, topic))
+
+    def _forward(self, item):
+        lane, reading = item
+        lane.forward(reading)
+
+    def close(self, timeout=None):
+        self.workers.stop(timeout=timeout)
+
+
+def reading_identity(reading):
+    """(device, topic) of a decoded reading, as strings."""
+    if not isinstance(reading, dict):
+        return "", ""
+    device = next((reading[f] for f in ("device_id", "sensor_id") if f in reading), "")
+    return str(device), str(reading.get("topic", ""))
+
+
+def parse_classes(spec):
+    """"critical:8,normal:4,bulk:1" -> {"critical": 8, ...} (class name -> weight)."""
+    classes = {}
+    for entry in spec.split(","):
+        name, _, weight = entry.strip().partition(":")
+        if name:
+            classes[name] = int(weight or 1)
+            if classes[name] < 1:
+                raise ValueError(f"Priority class {name!r} needs a weight of at least 1")
+    return classes
+
+
+def _rule_from_settings(settings):
+    settings = dict(settings)
+    if "class" in settings:
+        settings["priority_class"] = settings.pop("class")
+    return ScheduleRule(**settings)
+
+
+def open_policy_from_env():
+    """The class/rate policy from SCHEDULE_RULES and RATE_LIMIT_*; None when nothing is configured."""
+    rules_path = os.getenv("SCHEDULE_RULES")
+    rate = os.getenv("RATE_LIMIT_PER_DEVICE") # Readings per second; unset is unlimited
+    burst = os.getenv("RATE_LIMIT_BURST")
+    if not rules_path and not rate and os.getenv("SCHEDULE_MODE", "fifo") != "fair":
+        return None
+    rules = []
+    if rules_path:
+        with open(rules_path) as f:
+            rules = [_rule_from_settings(settings) for settings in json.load(f)]
+    return Policy(rules, default_class=os.getenv("SCHEDULE_DEFAULT_CLASS", "normal"),
+                  default_rate=float(rate) if rate else None, default_burst=float(burst) if burst else None)
+
+
+def check_classes(policy, classes):
+    """Raise ValueError when `policy` assigns a class that is not among `classes`."""
+    if policy.default.priority_class not in classes:
+        raise ValueError(f"SCHEDULE_DEFAULT_CLASS {policy.default.priority_class!r} is not in SCHEDULE_CLASSES")
+    for rule in policy.rules:
+        if rule.priority_class not in classes:
+            raise ValueError(f"Schedule rule class {rule.priority_class!r} is not in SCHEDULE_CLASSES")
+
+
+def open_scheduler_from_env(policy):
+    """The shared fair scheduler when SCHEDULE_MODE=fair, else None."""
+    if policy is None or os.getenv("SCHEDULE_MODE", "fifo") != "fair":
+        return None
+    classes = parse_classes(os.getenv("SCHEDULE_CLASSES", DEFAULT_CLASSES))
+    check_classes(policy, classes)
+    fair_queue = FairQueue(classes=classes, maxsize=int(os.getenv("SCHEDULE_QUEUE_SIZE", "10000")))
+    workers = int(os.getenv("SCHEDULE_WORKERS", "8"))
+    log.info("Fair scheduling over classes %s with %d forwarder workers", classes, workers)
+    return Scheduler(policy, fair_queue, workers=workers)
+
+
+def open_rate_limiter(policy):
+    """A rate limiter when any rule (or the default) sets a rate, else None."""
+    if policy is None or (policy.default.rate is None and all(rule.rate is None for rule in policy.rules)):
+        return None
+    return RateLimiter(policy, max_devices=int(os.getenv("RATE_LIMIT_MAX_DEVICES", "100000")))
@@ -0,0 +1,84 @@
+"""
+SenML (RFC 8428) pack resolution.
+
+A pack is a list of records whose base fields (``bn``, ``bt``, ``bv``, ``bs``)
+carry over to the records after them. ``to_readings`` resolves a pack and groups
+its records into one flat reading per (base name, time), the shape the gateway
+ingests::
+
+    [{"bn": "urn:dev:mac:0024befffe804ff1:", "bt": 1718000000, "n": "temp", "u": "Cel", "v": 23.1},
+     {"n": "hum", "u": "%RH", "v": 51}]
+    -> [{"timestamp": 1718000000, "device_id": "urn:dev:mac:0024befffe804ff1", "temp": 23.1, "hum": 51}]
+
+CBOR packs (content-format 112) use integer labels, which are mapped to the
+JSON field names. Units are not carried into the readings. A malformed pack,
+including a field of the wrong type (a name that is not a string, a time or
+value that is not a number), raises ValueError.
+"""
+import time
+
+CBOR_LABELS = {
+    -1: "bver", -2: "bn", -3: "bt", -4: "bu", -5: "bv", -6: "bs",
+    0: "n", 1: "u", 2: "v", 3: "vs", 4: "vb", 5: "s", 6: "t", 7: "ut", 8: "vd",
+}
+RELATIVE_TIME_LIMIT = 2 ** 28 # Resolved times below this are relative to now
+NUMBER_FIELDS = ("bt", "bv", "bs", "t", "v", "s")
+STRING_FIELDS = ("bn", "n")
+
+
+def resolve(pack, now=None):
+    """Yield (base_name, name, time, value) for every record of a pack that carries a value."""
+    if not isinstance(pack, list):
+        raise ValueError("SenML pack must be an array")
+    now = time.time() if now is None else now
+    base_name, base_time, base_value, base_sum = "", 0, 0, 0
+    for record in pack:
+        if not isinstance(record, dict):
+            raise ValueError("SenML record must be an object")
+        record = {CBOR_LABELS.get(label, label): value for label, value in record.items()}
+        _check_types(record)
+        base_name = record.get("bn", base_name)
+        base_time = record.get("bt", base_time)
+        base_value = record.get("bv", base_value)
+        base_sum = record.get("bs", base_sum)
+
+        at = base_time + record.get("t", 0)
+        if at < RELATIVE_TIME_LIMIT:
+            at += now
+        if "v" in record:
+            value = base_value + record["v"]
+        elif "vs" in record:
+            value = record["vs"]
+        elif "vb" in record:
+            value = record["vb"]
+        elif "vd" in record:
+            value = record["vd"]
+        elif "s" in record:
+            value = base_sum + record["s"]
+        else:
+            continue # Only sets base fields
+        yield base_name, record.get("n", ""), at, value
+
+
+def _check_types(record):
+    """Raise ValueError for fields whose type the resolution cannot combine."""
+    for field in NUMBER_FIELDS:
+        value = record.get(field, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"SenML field {field} must be a number")
+    for field in STRING_FIELDS:
+        if field in record and not isinstance(record[field], str):
+            raise ValueError(f"SenML field {field} must be a string")
+
+
+def to_readings(pack, now=None):
+    """Resolve a pack into flat readings, one per (base name, time)."""
+    readings = {}
+    for base_name, name, at, value in resolve(pack, now):
+        reading = readings.get((base_name, at))
+        if reading is None:
+            reading = readings[(base_name, at)] = {"timestamp": at}
+            if base_name:
+                reading["device_id"] = base_name.rstrip(":/")
+        reading[name or base_name or "value"] = value
+    return list(readings.values())
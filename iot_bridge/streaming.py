@@ -0,0 +1,405 @@
+"""
+Streaming forwarder: one long-lived request per source instead of a request per reading.
+
+A ``Streamer`` keeps a chunked POST open to the gateway's stream endpoint and
+writes every reading to it as one line of newline-delimited JSON, so the
+headers and the API key check are paid once per stream rather than per
+reading. Readings that arrive within `flush_ms` of each other go out in one
+HTTP chunk.
+
+While it reads, the gateway writes progress lines back on the same request,
+``{"acked": N, "rejected": M}``, at least once a second: N counts the lines it
+has consumed. Readings are kept until they are acked; when a stream breaks they
+are written again on the next one, so a reading may reach the gateway twice
+but is not lost while the bridge runs. A progress line with an ``error`` ends
+the stream; only when it names the ``line`` at fault (a line over the
+gateway's size limit) is that reading dropped. A stream that stays silent for
+longer than the HTTP timeout is considered broken. Streams are ended and
+reopened every `max_age` seconds.
+
+With HTTP_COMPRESSION set, a stream is compressed as a whole: one compressor
+(with the preset dictionary, if any) runs across all its chunks and is flushed
+at the end of each, so later readings are encoded against earlier ones.
+
+Traced readings (see tracing.py) end when the gateway acks them; streams carry
+no per-reading trace header.
+"""
+import collections
+import http.client
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+from . import codec, metrics, tracing
+from .forwarder import CONNECTIONS_OPENED, AsyncResponse, _build_ssl_context, check_response
+from .logsampling import SampledLogger
+from .wire import BODY_BYTES
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+DEFAULT_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "20"))
+DEFAULT_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(64 * 1024)))
+DEFAULT_MAX_PENDING = int(os.getenv("STREAM_MAX_PENDING", "100000"))
+DEFAULT_MAX_AGE = float(os.getenv("STREAM_MAX_AGE", "600"))
+
+RECONNECT_MIN = 1.0 # Seconds before reopening a broken stream, doubled on each failure
+RECONNECT_MAX = 30.0
+
+STREAMS_ENDED = metrics.counter("bridge_streams_total", "Streams to the gateway ended, by source and reason")
+STREAM_READINGS = metrics.counter("bridge_stream_readings_total", "Readings written to streams, by source")
+STREAM_ACKED = metrics.counter("bridge_stream_readings_acked_total", "Readings the gateway acknowledged on a stream, by source")
+STREAM_REJECTED = metrics.counter("bridge_stream_readings_rejected_total", "Stream lines the gateway could not parse, by source")
+STREAM_UNACKED = metrics.gauge("bridge_stream_unacked", "Readings waiting to be written or acknowledged, by source")
+STREAM_ACK_SECONDS = metrics.histogram("bridge_stream_ack_seconds", "Time from writing a chunk to the gateway acknowledging all of it")
+STREAM_DROPPED = metrics.counter("bridge_stream_readings_dropped_total", "Readings dropped by the streamer, by source")
+STREAM_JOURNALED = metrics.counter("bridge_stream_readings_journaled_total", "Readings the streamer kept in the journal, by source")
+
+
+def stream_endpoint(endpoint):
+    """Default stream URL next to the single-reading endpoint, e.g. /data -> /data/stream."""
+    return os.getenv("HTTP_STREAM_ENDPOINT") or endpoint.rstrip("/") + "/stream"
+
+
+class _Stream:
+    """One chunked POST: written by the streamer's thread, its response read by a thread of its own."""
+
+    def __init__(self, conn, compressor=None):
+        self.conn = conn
+        self.compressor = compressor
+        self.sock = conn.sock # Written directly; the response may take over the connection
+        self.opened_at = time.monotonic()
+        self.written = 0 # Lines written
+        self.acked = 0 # Lines the gateway consumed
+        self.rejected = 0
+        self.accepted = False # The gateway answered with progress rather than an error
+        self.answered = threading.Event()
+        self.finished = threading.Event() # The response ended, cleanly or not
+        self.closing = False
+
+    def close(self):
+        """Break the connection; the reader sees EOF and closes it."""
+        self.closing = True
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Streamer:
+    """Forwards readings as NDJSON lines over one long-lived chunked POST, from a background thread."""
+
+    def __init__(self, forwarder, flush_ms=DEFAULT_FLUSH_MS, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 max_pending=DEFAULT_MAX_PENDING, max_age=DEFAULT_MAX_AGE, endpoint=None, journal=None):
+        self.forwarder = forwarder
+        self.source = forwarder.source
+        self.journal = journal # Readings that cannot be held or delivered are kept here, if set
+        self.flush = flush_ms / 1000.0
+        self.chunk_bytes = chunk_bytes
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.endpoint = endpoint or stream_endpoint(forwarder.endpoint)
+        self._headers = {
+            "Content-Type": "application/x-ndjson",
+            "Transfer-Encoding": "chunked",
+            "Expect": "100-continue", # Lets the gateway refuse the stream before reading it
+            "X-API-Key": forwarder.session.headers["X-API-Key"],
+            "X-Source-Identifier": self.source,
+        }
+        if forwarder.encoder.compression != "none":
+            self._headers["Content-Encoding"] = forwarder.encoder.compression
+        self._ssl_context = _build_ssl_context(forwarder.verify_ssl)
+
+        self._pending = collections.deque() # Encoded readings not yet written
+        self._size = 0 # Bytes of pending lines, newlines included
+        self._opened_at = None # When the oldest pending reading arrived
+        self._unacked = collections.deque() # Written to the current stream, oldest first
+        self._chunks = collections.deque() # (lines written up to the chunk's end, written at), for ack latency
+        self._stream = None
+        self._rotate = False
+        self._retry_at = 0.0
+        self._delay = RECONNECT_MIN
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"streamer-{self.source}", daemon=True)
+        self._thread.start()
+
+    def submit(self, payload):
+        """Add one reading (a dict or encoded bytes) to the stream. Never blocks on the network."""
+        trace = tracing.take(payload, "enqueue") if tracing.active else None
+        encoded = codec.encoded(payload)
+        if trace is not None:
+            trace.mark("serialize")
+            tracing.attach(encoded, trace) # Follows the line until it is acked
+        self.submit_encoded(encoded)
+
+    def submit_encoded(self, encoded):
+        """Add one reading that is already encoded as a JSON object (bytes)."""
+        if b"\n" in encoded:
+            encoded = codec.dumps(codec.loads(encoded)) # One reading per line
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Streamer is closed")
+            if len(self._pending) + len(self._unacked) >= self.max_pending:
+                if self.journal is not None or not self._pending:
+                    self._spill([encoded])
+                    return
+                dropped = self._pending.popleft() # Without a journal the newest readings win
+                self._size -= len(dropped) + 1
+                STREAM_DROPPED.inc(source=self.source)
+            opening = not self._pending
+            if opening:
+                self._opened_at = time.monotonic()
+            self._pending.append(encoded)
+            self._size += len(encoded) + 1
+            if opening or self._size >= self.chunk_bytes:
+                self._cond.notify()
+
+    def retarget(self, endpoint):
+        """Stream to the stream URL next to `endpoint`, ending the current stream."""
+        with self._cond:
+            self.endpoint = stream_endpoint(endpoint)
+            self._rotate = True
+            self._cond.notify()
+
+    def _next(self):
+        """Wait until there is something to do (lock held).
+
+        Returns "write", "end" (the current stream), "broken" (the current stream
+        failed), "drain" (closed while the gateway is unreachable) or None once
+        closed with nothing left.
+        """
+        while True:
+            now = time.monotonic()
+            stream = self._stream
+            deadlines = []
+            if stream is not None:
+                if stream.finished.is_set():
+                    return "broken" # Ended by the gateway or the network
+                if self._rotate or now - stream.opened_at >= self.max_age or (self._closed and not self._pending):
+                    return "end"
+                deadlines.append(stream.opened_at + self.max_age)
+            if self._pending:
+                if stream is None and now < self._retry_at:
+                    if self._closed:
+                        return "drain"
+                    deadlines.append(self._retry_at)
+                elif self._closed or self._size >= self.chunk_bytes or now - self._opened_at >= self.flush:
+                    return "write"
+                else:
+                    deadlines.append(self._opened_at + self.flush)
+            elif self._closed and stream is None:
+                return None
+            self._cond.wait(min(deadlines) - now if deadlines else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                action = self._next()
+            if action is None:
+                return
+            if action == "write":
+                self._write()
+            elif action == "end":
+                self._end(self._stream)
+            elif action == "broken":
+                self._abandon(self._stream, "error")
+                self._backoff()
+            else:
+                self._drain()
+
+    def _open(self):
+        url = urlsplit(self.endpoint)
+        if url.scheme == "https":
+            conn = http.client.HTTPSConnection(url.hostname, url.port or 443, timeout=self.forwarder.timeout,
+                                               context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.forwarder.timeout)
+        conn.putrequest("POST", url.path + ("?" + url.query if url.query else ""), skip_accept_encoding=True)
+        for name, value in self._headers.items():
+            conn.putheader(name, value)
+        conn.endheaders() # Connects
+        CONNECTIONS_OPENED.inc(scheme="stream")
+        stream = _Stream(conn, self.forwarder.encoder.compressor())
+        threading.Thread(target=self._read, args=(stream,), name=f"streamer-{self.source}-acks", daemon=True).start()
+        # Nothing is written until the gateway accepts the stream (it sends progress right away)
+        stream.answered.wait(self.forwarder.timeout)
+        if not stream.accepted:
+            stream.close()
+            STREAMS_ENDED.inc(source=self.source, reason="refused")
+            raise ConnectionError("stream not accepted")
+        with self._cond:
+            self._stream = stream
+            self._rotate = False
+        log.info("Opened %s stream to %s", self.source, self.endpoint)
+        return stream
+
+    def _write(self):
+        stream = self._stream
+        if stream is None:
+            try:
+                stream = self._open()
+            except (OSError, http.client.HTTPException) as e:
+                sampled_log.error("Could not open a stream to %s: %s", self.endpoint, e)
+                self._backoff()
+                return
+        with self._cond:
+            lines, size = [], 0
+            while self._pending and (not lines or size + len(self._pending[0]) + 1 <= self.chunk_bytes):
+                encoded = self._pending.popleft()
+                lines.append(encoded)
+                size += len(encoded) + 1
+            self._size -= size
+            # Readings left behind start a new flush window now
+            self._opened_at = time.monotonic() if self._pending else None
+            self._unacked.extend(lines)
+            stream.written += len(lines)
+            self._chunks.append((stream.written, time.monotonic()))
+        traces = []
+        if tracing.active:
+            for line in lines:
+                trace = tracing.peek(line, "enqueue")
+                if trace is not None:
+                    traces.append((0, trace))
+        body = b"\n".join(lines) + b"\n"
+        BODY_BYTES.inc(len(body), stage="json")
+        if stream.compressor is not None:
+            body = stream.compressor.compress(body) + stream.compressor.flush(zlib.Z_SYNC_FLUSH)
+        BODY_BYTES.inc(len(body), stage="wire")
+        tracing.mark_all(traces, "serialize")
+        try:
+            stream.sock.sendall(b"%x\r\n%b\r\n" % (len(body), body))
+            tracing.mark_all(traces, "send")
+        except OSError as e:
+            sampled_log.error("Stream to %s broken: %s", self.endpoint, e)
+            self._abandon(stream, "error")
+            self._backoff()
+            return
+        STREAM_READINGS.inc(len(lines), source=self.source)
+
+    def _read(self, stream):
+        """Apply the gateway's progress lines for `stream` until its response ends."""
+        try:
+            response = stream.conn.getresponse()
+            if response.status != 200:
+                check_response(AsyncResponse(response.status, response.reason,
+                                             response.read(4096).decode("utf-8", "replace")))
+                return
+            for line in response:
+                progress = codec.loads(line)
+                if not isinstance(progress, dict):
+                    raise ValueError(f"Unexpected progress line {line[:100]!r}")
+                stream.accepted = True
+                stream.answered.set()
+                self._ack(stream, progress)
+                if "status" in progress or "error" in progress:
+                    return # Final line
+            if not stream.closing:
+                sampled_log.error("Stream to %s ended without a final status", self.endpoint)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            if not stream.closing:
+                sampled_log.error("Stream to %s broken: %s", self.endpoint, e)
+        finally:
+            stream.conn.close()
+            stream.answered.set()
+            with self._cond:
+                stream.finished.set()
+                self._cond.notify()
+
+    def _ack(self, stream, progress):
+        now = time.monotonic()
+        with self._cond:
+            if stream is not self._stream:
+                return # Abandoned; its readings were queued again
+            acked = min(int(progress.get("acked", 0)), stream.written)
+            if acked > stream.acked:
+                self._delay = RECONNECT_MIN # The gateway is consuming the stream
+                for _ in range(acked - stream.acked):
+                    line = self._unacked.popleft()
+                    trace = tracing.take(line) if tracing.active else None
+                    if trace is not None:
+                        tracing.finish([(0, trace)], "ack", "acked")
+                STREAM_ACKED.inc(acked - stream.acked, source=self.source)
+                stream.acked = acked
+                while self._chunks and self._chunks[0][0] <= acked:
+                    STREAM_ACK_SECONDS.observe(now - self._chunks.popleft()[1])
+            rejected = int(progress.get("rejected", 0))
+            if rejected > stream.rejected:
+                STREAM_REJECTED.inc(rejected - stream.rejected, source=self.source)
+                stream.rejected = rejected
+            if progress.get("error"):
+                sampled_log.error("Gateway ended the %s stream: %s", self.source, progress["error"])
+                if progress.get("line") == stream.acked + 1 and self._unacked:
+                    # The gateway cannot take this reading (e.g. over its line limit); it would end the next stream too
+                    self._unacked.popleft()
+                    STREAM_DROPPED.inc(source=self.source)
+                    self._delay = RECONNECT_MIN
+                # Otherwise the stream as a whole failed (e.g. a compression dictionary mismatch):
+                # every reading is written again on the next one, after a growing backoff
+            STREAM_UNACKED.set(len(self._pending) + len(self._unacked), source=self.source)
+
+    def _end(self, stream):
+        """End `stream` cleanly and wait for the gateway's final ack."""
+        try:
+            if stream.compressor is not None:
+                tail = stream.compressor.flush() # Ends the compressed body
+                stream.sock.sendall(b"%x\r\n%b\r\n" % (len(tail), tail))
+            stream.sock.sendall(b"0\r\n\r\n")
+            if not stream.finished.wait(self.forwarder.timeout):
+                sampled_log.error("No final ack on the %s stream to %s", self.source, self.endpoint)
+        except OSError as e:
+            sampled_log.error("Stream to %s broken: %s", self.endpoint, e)
+        with self._cond:
+            reason = "closed" if self._closed else "retarget" if self._rotate else "rotated"
+        self._abandon(stream, reason)
+        if reason == "closed":
+            self._drain() # Left unacked
+
+    def _abandon(self, stream, reason):
+        """Close `stream`; its unacked readings are written again first on the next one."""
+        with self._cond:
+            if self._stream is stream:
+                self._stream = None
+            if self._unacked:
+                self._pending.extendleft(reversed(self._unacked))
+                self._size += sum(len(encoded) + 1 for encoded in self._unacked)
+                self._unacked.clear()
+                if self._opened_at is None:
+                    self._opened_at = time.monotonic()
+            self._chunks.clear()
+            STREAM_UNACKED.set(len(self._pending), source=self.source)
+        stream.close()
+        STREAMS_ENDED.inc(source=self.source, reason=reason)
+        log.info("Ended %s stream to %s after %d readings (%s)", self.source, self.endpoint, stream.acked, reason)
+
+    def _backoff(self):
+        with self._cond:
+            self._retry_at = time.monotonic() + self._delay
+            self._delay = min(self._delay * 2, RECONNECT_MAX)
+
+    def _drain(self):
+        """Journal (or drop) every pending reading."""
+        with self._cond:
+            items = list(self._pending)
+            self._pending.clear()
+            self._size = 0
+            self._spill(items)
+
+    def _spill(self, items):
+        if self.journal is not None:
+            kept = sum(1 for encoded in items if self.journal.append(encoded))
+            STREAM_JOURNALED.inc(kept, source=self.source)
+            STREAM_DROPPED.inc(len(items) - kept, source=self.source)
+        else:
+            STREAM_DROPPED.inc(len(items), source=self.source)
+
+    def close(self, timeout=None):
+        """Write whatever is pending, end the stream and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
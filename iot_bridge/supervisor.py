@@ -0,0 +1,93 @@
+"""
+Process supervisor for running several copies of a bridge.
+
+The supervisor re-executes the current script (or ``-m`` module) N times with ``BRIDGE_WORKER_INDEX``
+set to 0..N-1, restarts workers that exit, and forwards SIGINT/SIGTERM (and
+SIGHUP, which reloads the bridge config, and the SIGUSR1/SIGUSR2 diagnostics
+signals) to them.
+Each worker uses its index to derive distinct identities (e.g. MQTT client IDs)
+or to share a listening socket with SO_REUSEPORT.
+"""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+WORKER_INDEX_ENV = "BRIDGE_WORKER_INDEX"
+
+
+def worker_index():
+    """Index of this worker process, or None when not running under the supervisor."""
+    value = os.getenv(WORKER_INDEX_ENV)
+    return int(value) if value is not None else None
+
+
+def run_supervisor(workers, restart_delay=2.0, max_restart_delay=60.0, env=None):
+    """Start `workers` copies of this script and keep them running until signalled.
+
+    `env` is the workers' environment (default: this process's).
+    """
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    if spec is not None:
+        command = [sys.executable, "-m", spec.name] + sys.argv[1:] # Started with python -m
+    else:
+        command = [sys.executable] + sys.argv
+    base_env = os.environ if env is None else env
+    procs = {}
+    started = {}
+    delays = {}
+    stopping = False
+
+    def spawn(index):
+        env = dict(base_env, **{WORKER_INDEX_ENV: str(index)})
+        procs[index] = subprocess.Popen(command, env=env)
+        started[index] = time.monotonic()
+        log.info("Started worker %d (pid %d)", index, procs[index].pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signum)
+
+    def relay(signum, frame):
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for name in ("SIGHUP", "SIGUSR1", "SIGUSR2"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), relay)
+
+    for index in range(workers):
+        spawn(index)
+        delays[index] = restart_delay
+
+    while not stopping:
+        time.sleep(1)
+        for index, proc in list(procs.items()):
+            code = proc.poll()
+            if code is None or stopping:
+                continue
+            if time.monotonic() - started[index] > max_restart_delay:
+                delays[index] = restart_delay # Ran long enough; reset the backoff
+            log.warning("Worker %d (pid %d) exited with code %s; restarting in %.0fs", index, proc.pid, code, delays[index])
+            time.sleep(delays[index])
+            delays[index] = min(delays[index] * 2, max_restart_delay)
+            if not stopping:
+                spawn(index)
+
+    for index, proc in procs.items():
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            log.warning("Worker %d did not exit in time, killing it", index)
+            proc.kill()
+    log.info("All workers stopped.")
@@ -0,0 +1,227 @@
+"""
+Per-reading hot-path tracing for the bridges.
+
+When tracing is on (``BRIDGE_TRACE=true``, or toggled at runtime with SIGUSR1),
+one message in ``TRACE_SAMPLE_EVERY`` is followed through the pipeline and the
+time it spends in each stage is recorded:
+
+- receive: from the front end reading the message (MQTT: paho's read from the
+  socket) to the lane decoding it
+- decode: JSON parse (with the envelope spliced in on the fast path)
+- enrich: envelope fields and the edge stages (time-series store, anomaly
+  screen, rate limits, aggregation, deadband)
+- enqueue: waiting in hand-off queues, batches and stream buffers
+- serialize: encoding the reading and building (and compressing) the body
+- send: the HTTP request to the gateway, including its response for single
+  and batched POSTs; for streams, writing the chunk
+- ack: for streams, waiting for the gateway's progress ack
+
+Stage times go to the ``bridge_trace_stage_seconds`` histogram and end-to-end
+times to ``bridge_trace_seconds``. Traced readings slower than ``TRACE_SLOW_MS``
+are logged with their stages, and the slowest recent ones are kept for
+`dump_slowest()`. Each trace has an ID that is sent to the gateway in the
+``X-Trace-Id`` header (``<id>@<index in the body>``, comma-separated), so the
+gateway's log line for the request can be matched to the bridge's.
+
+A trace travels with its reading: from the front end to the lane in a context
+variable, and from there on attached to the reading object (or its encoded
+bytes) in a bounded table. With tracing off, each stage pays one flag check.
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+from .logsampling import SampledLogger
+
+log = logging.getLogger(__name__)
+sampled_log = SampledLogger(log)
+
+TRACE_HEADER = "X-Trace-Id"
+MAX_ATTACHED = 10000 # Traced readings in flight; the oldest are forgotten beyond this
+
+_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+            1.0, 2.5, 5.0, 10.0)
+STAGE_SECONDS = metrics.histogram("bridge_trace_stage_seconds", "Time traced readings spent in each pipeline stage, by source and stage",
+                                  buckets=_BUCKETS)
+TRACE_SECONDS = metrics.histogram("bridge_trace_seconds", "End-to-end time of traced readings, from receipt to the gateway's answer, by source",
+                                  buckets=_BUCKETS)
+
+active = False # Checked on every hot path; set by configure_from_env() and toggle()
+sample_every = 100
+slow_seconds = 0.25
+keep = 100 # Slowest traces kept for dump_slowest()
+
+_countdown = 1
+_current = contextvars.ContextVar("iot_bridge_trace", default=None)
+_attached = {} # id(reading) -> (reading, Trace); holding the reading keeps its id unique
+_slowest = [] # Min-heap of (seconds, seq, trace dict)
+_seq = itertools.count()
+_lock = threading.Lock()
+
+
+class Trace:
+    """Stage timings of one reading on its way to the gateway."""
+    __slots__ = ("id", "source", "device", "started", "last", "stages")
+
+    def __init__(self, source, device=None, started=None):
+        self.id = os.urandom(8).hex()
+        self.source = source
+        self.device = device
+        self.started = self.last = started or time.monotonic()
+        self.stages = {}
+
+    def mark(self, stage):
+        """The reading finished `stage` now; a stage reached again adds up."""
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def as_dict(self, outcome=None):
+        return {
+            "trace_id": self.id,
+            "source": self.source,
+            "device": self.device,
+            "outcome": outcome,
+            "total_ms": round((self.last - self.started) * 1000, 3),
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+        }
+
+
+def configure_from_env():
+    """Apply BRIDGE_TRACE, TRACE_SAMPLE_EVERY, TRACE_SLOW_MS and TRACE_KEEP."""
+    global sample_every, slow_seconds, keep
+    sample_every = max(1, int(os.getenv("TRACE_SAMPLE_EVERY", "100")))
+    slow_seconds = float(os.getenv("TRACE_SLOW_MS", "250")) / 1000.0
+    keep = int(os.getenv("TRACE_KEEP", "100"))
+    enable(os.getenv("BRIDGE_TRACE", "false").lower() == "true")
+
+
+def enable(on=True):
+    global active
+    if on == active:
+        return
+    active = on
+    if not on:
+        _attached.clear()
+    log.info("Tracing %s (one message in %d, slow above %.0f ms)", "on" if on else "off", sample_every, slow_seconds * 1000)
+
+
+def toggle():
+    enable(not active)
+
+
+def begin(source, device=None, at=None):
+    """Start tracing the message a front end just received, if it is sampled.
+
+    `at` is when the front end read it (time.monotonic()), if earlier. The
+    trace is picked up by `current()` in the same thread or task.
+    """
+    global _countdown
+    _countdown -= 1 # Unsynchronised; sampling only needs to be roughly one in N
+    trace = None
+    if _countdown <= 0:
+        _countdown = sample_every
+        now = time.monotonic()
+        trace = Trace(source, device, at if at is not None and at <= now else now)
+    _current.set(trace)
+    return trace
+
+
+def current():
+    """The trace of the message being handled in this thread or task, if sampled."""
+    return _current.get()
+
+
+def handoff(trace, readings, stage):
+    """End `stage` of the current trace and attach it to the first of `readings` to forward."""
+    trace.mark(stage)
+    if readings:
+        attach(readings[0], trace)
+    _current.set(None)
+
+
+def attach(reading, trace):
+    """Let `trace` follow `reading` (a dict or encoded bytes) to a later stage."""
+    if len(_attached) >= MAX_ATTACHED:
+        try:
+            del _attached[next(iter(_attached))] # Readings dropped or suppressed on the way
+        except (StopIteration, KeyError, RuntimeError):
+            pass
+    _attached[id(reading)] = (reading, trace)
+
+
+def take(reading, stage=None):
+    """Detach and return the trace following `reading`, ending `stage`; None if untraced."""
+    entry = _attached.pop(id(reading), None)
+    if entry is None or entry[0] is not reading:
+        return None
+    if stage is not None:
+        entry[1].mark(stage)
+    return entry[1]
+
+
+def peek(reading, stage=None):
+    """Like take(), but the trace keeps following the reading."""
+    entry = _attached.get(id(reading))
+    if entry is None or entry[0] is not reading:
+        return None
+    if stage is not None:
+        entry[1].mark(stage)
+    return entry[1]
+
+
+def mark_all(traces, stage):
+    for _, trace in traces:
+        trace.mark(stage)
+
+
+def request_headers(traces, headers):
+    """`headers` plus the trace header for a body holding traced readings at the given indexes.
+
+    Ends their serialize stage. `traces` holds (index in the body, Trace) pairs.
+    """
+    mark_all(traces, "serialize")
+    return dict(headers, **{TRACE_HEADER: ",".join(f"{trace.id}@{index}" for index, trace in traces)})
+
+
+def finish(traces, stage, outcome):
+    """End `stage` of each trace and record it: the reading reached the gateway (or failed to)."""
+    for _, trace in traces:
+        trace.mark(stage)
+        _record(trace, outcome)
+
+
+def _record(trace, outcome):
+    total = trace.last - trace.started
+    for stage, seconds in trace.stages.items():
+        STAGE_SECONDS.observe(seconds, source=trace.source, stage=stage)
+    TRACE_SECONDS.observe(total, source=trace.source)
+    if keep > 0:
+        with _lock:
+            entry = (total, next(_seq), trace.as_dict(outcome))
+            if len(_slowest) < keep:
+                heapq.heappush(_slowest, entry)
+            elif total > _slowest[0][0]:
+                heapq.heapreplace(_slowest, entry)
+    if total >= slow_seconds:
+        sampled_log.warning("Slow %s reading, trace %s (device %s, %s): %.1f ms end to end; %s",
+                            trace.source, trace.id, trace.device, outcome, total * 1000,
+                            ", ".join(f"{stage} {seconds * 1000:.2f} ms" for stage, seconds in trace.stages.items()))
+
+
+def dump_slowest(path):
+    """Write the slowest recent traces, slowest first, as JSON lines; returns how many."""
+    with _lock:
+        entries = sorted(_slowest, reverse=True)
+    if not entries:
+        return 0
+    with open(path, "w", encoding="utf-8") as f:
+        for _, _, trace in entries:
+            f.write(json.dumps(trace) + "\n")
+    return len(entries)
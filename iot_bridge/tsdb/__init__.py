@@ -0,0 +1,42 @@
+"""
+Local time-series store: compressed columnar chunks, retention and a query API.
+"""
+import logging
+import os
+
+from .query import AGGREGATIONS, downsample, start_query_server
+from .store import TimeSeriesStore
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    "AGGREGATIONS",
+    "TimeSeriesStore",
+    "downsample",
+    "open_store_from_env",
+    "start_query_server",
+]
+
+
+def open_store_from_env(name=None):
+    """Open the store configured by TSDB_DIR; None when unset.
+
+    `name` selects a subdirectory, so each worker process keeps its own store.
+    """
+    directory = os.getenv("TSDB_DIR")
+    if not directory:
+        return None
+    if name:
+        directory = os.path.join(directory, name)
+    store = TimeSeriesStore(
+        directory,
+        retention=float(os.getenv("TSDB_RETENTION", str(7 * 86400))), # Seconds
+        max_bytes=int(os.getenv("TSDB_MAX_BYTES", "0")),
+        chunk_points=int(os.getenv("TSDB_CHUNK_POINTS", "1024")),
+        segment_bytes=int(os.getenv("TSDB_SEGMENT_BYTES", str(8 * 1024 * 1024))),
+        flush_interval=float(os.getenv("TSDB_FLUSH_INTERVAL", "300")),
+        max_series=int(os.getenv("TSDB_MAX_SERIES", "100000")),
+        compress=os.getenv("TSDB_COMPRESS", "true").lower() == "true",
+    )
+    log.info("Local time-series store enabled at %s", directory)
+    return store
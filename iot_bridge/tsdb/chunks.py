@@ -0,0 +1,283 @@
+"""
+Column encodings for the chunks of the edge time-series store.
+
+A chunk holds one series' points between two seals: int64 millisecond
+timestamps and float64 values, each column encoded on its own.
+
+- Timestamps: the first timestamp, the first delta, then delta-of-deltas, as
+  zigzag varints. A regularly sampled series takes one byte per point.
+- Values, ``decimal``: when every value is a decimal with at most 9 fraction
+  digits (0.1-scaled registers, DHT11 readings), the scaled integers are
+  delta-encoded as zigzag varints, so a slowly changing sensor takes about a
+  byte per point.
+- Values, ``xor``: otherwise each value is XORed with the previous one and only
+  the non-zero bytes of the XOR are kept, with one header byte per value giving
+  the leading and trailing zero bytes (a byte-aligned take on Gorilla).
+
+Encoding and decoding are vectorized with NumPy when installed; the pure
+Python fallbacks read and write the same bytes.
+"""
+import math
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError: # Optional; per-point loops are used without it
+    np = None
+
+RAW = 0 # Little-endian int64 timestamps and float64 values as they are
+XOR = 1
+DECIMAL = 16 # + number of fraction digits, 0-9
+
+_MAX_EXACT = 2 ** 53 # Scaled decimals beyond this are not exact in a float64
+
+
+def encode(timestamps, values):
+    """Encode parallel columns (sequences of int ms and floats) into (codec, ts_bytes, value_bytes)."""
+    if np is not None:
+        if isinstance(timestamps, array): # A series head: no copy
+            ts, vs = np.frombuffer(timestamps, dtype=np.int64), np.frombuffer(values, dtype=np.float64)
+        else:
+            ts, vs = np.asarray(timestamps, dtype=np.int64), np.asarray(values, dtype=np.float64)
+        ts_bytes = _np_varints(_np_zigzag(_ts_residuals(ts)))
+        digits = _np_decimal_digits(vs)
+        if digits is not None:
+            ints = np.round(vs * 10.0 ** digits).astype(np.int64)
+            return DECIMAL + digits, ts_bytes, _np_varints(_np_zigzag(np.diff(ints, prepend=np.int64(0))))
+        return XOR, ts_bytes, _np_xor(vs)
+    ts_bytes = _py_varints(_py_zigzag(v) for v in _py_ts_residuals(timestamps))
+    digits = _py_decimal_digits(values)
+    if digits is not None:
+        scale = 10.0 ** digits
+        ints = [int(round(v * scale)) for v in values]
+        deltas = (b - a for a, b in zip([0] + ints[:-1], ints))
+        return DECIMAL + digits, ts_bytes, _py_varints(_py_zigzag(d) for d in deltas)
+    return XOR, ts_bytes, _py_xor(values)
+
+
+def decode(codec, count, ts_bytes, value_bytes):
+    """Decode a chunk's columns; returns (timestamps, values) as NumPy arrays, or arrays from the array module."""
+    if codec == RAW:
+        if np is not None:
+            return np.frombuffer(ts_bytes, dtype="<i8").copy(), np.frombuffer(value_bytes, dtype="<f8").copy()
+        return array("q", ts_bytes), array("d", value_bytes)
+    if np is not None:
+        ts = _np_ts_restore(_np_unzigzag(_np_unvarints(ts_bytes, count)))
+        if codec == XOR:
+            return ts, _np_unxor(value_bytes, count)
+        ints = np.cumsum(_np_unzigzag(_np_unvarints(value_bytes, count)))
+        return ts, ints / 10.0 ** (codec - DECIMAL)
+    ts = array("q", _py_ts_restore([_py_unzigzag(v) for v in _py_unvarints(ts_bytes, count)]))
+    if codec == XOR:
+        return ts, _py_unxor(value_bytes, count)
+    scale = 10.0 ** (codec - DECIMAL)
+    total, values = 0, array("d")
+    for delta in _py_unvarints(value_bytes, count):
+        total += _py_unzigzag(delta)
+        values.append(total / scale)
+    return ts, values
+
+
+def encode_raw(timestamps, values):
+    """The uncompressed encoding, e.g. to compare sizes."""
+    return RAW, array("q", timestamps).tobytes(), array("d", values).tobytes()
+
+
+# --- NumPy ---
+
+def _ts_residuals(ts):
+    deltas = np.diff(ts)
+    return np.concatenate((ts[:1], deltas[:1], np.diff(deltas)))
+
+
+def _np_ts_restore(residuals):
+    if len(residuals) < 2:
+        return residuals
+    deltas = np.cumsum(residuals[1:])
+    return np.concatenate((residuals[:1], residuals[0] + np.cumsum(deltas)))
+
+
+def _np_zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _np_unzigzag(values):
+    return ((values >> np.uint64(1)).view(np.int64)) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def _np_varints(values):
+    """LEB128 bytes of uint64 values."""
+    if not len(values):
+        return b""
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max())):
+        selected = lengths > k
+        byte = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = lengths[selected] > k + 1
+        out[starts[selected] + k] = (byte | (more.astype(np.uint64) << np.uint64(7))).astype(np.uint8)
+    return out.tobytes()
+
+
+def _np_unvarints(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) == count:
+        return raw.astype(np.uint64) # Every value fits in one byte
+    ends = (raw & 0x80) == 0
+    index = np.concatenate(([0], np.cumsum(ends)[:-1])) # Value each byte belongs to
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(len(raw)) - starts[index]
+    groups = np.zeros((count, int(position.max()) + 1), dtype=np.uint64)
+    groups[index, position] = raw & 0x7F
+    values = groups[:, 0].copy()
+    for k in range(1, groups.shape[1]):
+        values |= groups[:, k] << np.uint64(7 * k)
+    return values
+
+
+def _np_decimal_digits(values):
+    """Fewest fraction digits (0-9) that represent every value exactly, or None."""
+    if not len(values) or not np.isfinite(values).all() or (np.signbit(values) & (values == 0)).any():
+        return None
+    largest = np.abs(values).max()
+    for digits in range(10):
+        scale = 10.0 ** digits
+        if largest * scale >= _MAX_EXACT:
+            return None
+        scaled = np.round(values * scale)
+        if np.array_equal(scaled / scale, values):
+            return digits
+    return None
+
+
+def _np_xor(values):
+    bits = values.view(np.uint64)
+    xors = bits ^ np.concatenate(([np.uint64(0)], bits[:-1]))
+    columns = xors.astype(">u8").view(np.uint8).reshape(-1, 8) # Most significant byte first
+    nonzero = columns != 0
+    empty = ~nonzero.any(axis=1)
+    leading = np.where(empty, 8, nonzero.argmax(axis=1))
+    trailing = np.where(empty, 0, nonzero[:, ::-1].argmax(axis=1))
+    position = np.arange(8)
+    keep = (position >= leading[:, None]) & (position < (8 - trailing)[:, None])
+    headers = (leading * 9 + trailing).astype(np.uint8)
+    return headers.tobytes() + columns[keep].tobytes()
+
+
+def _np_unxor(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    headers = raw[:count].astype(np.int64)
+    leading, trailing = headers // 9, headers % 9
+    position = np.arange(8)
+    keep = (position >= leading[:, None]) & (position < (8 - trailing)[:, None])
+    columns = np.zeros((count, 8), dtype=np.uint8)
+    columns[keep] = raw[count:]
+    xors = columns.view(">u8").reshape(count).astype(np.uint64)
+    return np.bitwise_xor.accumulate(xors).view(np.float64)
+
+
+# --- Pure Python ---
+
+def _py_ts_residuals(timestamps):
+    residuals = []
+    previous = previous_delta = None
+    for t in timestamps:
+        if previous is None:
+            residuals.append(t)
+        elif previous_delta is None:
+            previous_delta = t - previous
+            residuals.append(previous_delta)
+        else:
+            delta = t - previous
+            residuals.append(delta - previous_delta)
+            previous_delta = delta
+        previous = t
+    return residuals
+
+
+def _py_ts_restore(residuals):
+    timestamps = []
+    delta = 0
+    for i, residual in enumerate(residuals):
+        if i == 0:
+            timestamps.append(residual)
+            continue
+        delta = residual if i == 1 else delta + residual
+        timestamps.append(timestamps[-1] + delta)
+    return timestamps
+
+
+def _py_zigzag(value):
+    return ((value << 1) ^ (value >> 63)) & 0xFFFFFFFFFFFFFFFF
+
+
+def _py_unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _py_varints(values):
+    out = bytearray()
+    for value in values:
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def _py_unvarints(data, count):
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value, shift = 0, 0
+    return values[:count]
+
+
+def _py_decimal_digits(values):
+    if not values or any(not math.isfinite(v) or (v == 0 and math.copysign(1.0, v) < 0) for v in values):
+        return None
+    largest = max(abs(v) for v in values)
+    for digits in range(10):
+        scale = 10.0 ** digits
+        if largest * scale >= _MAX_EXACT:
+            return None
+        if all(round(v * scale) / scale == v for v in values):
+            return digits
+    return None
+
+
+def _py_xor(values):
+    headers, payload = bytearray(), bytearray()
+    previous = 0
+    for (bits,) in struct.iter_unpack("<Q", array("d", values).tobytes()):
+        xor = (bits ^ previous).to_bytes(8, "big")
+        previous = bits
+        significant = xor.lstrip(b"\0")
+        if not significant:
+            headers.append(8 * 9)
+            continue
+        stripped = significant.rstrip(b"\0")
+        headers.append((8 - len(significant)) * 9 + len(significant) - len(stripped))
+        payload += stripped
+    return bytes(headers + payload)
+
+
+def _py_unxor(data, count):
+    values = []
+    previous, offset = 0, count
+    for header in data[:count]:
+        leading, trailing = divmod(header, 9)
+        width = 8 - leading - trailing
+        xor = int.from_bytes(data[offset:offset + width], "big") << (8 * trailing) if width > 0 else 0
+        offset += max(width, 0)
+        previous ^= xor
+        values.append(previous)
+    return array("d", struct.pack(f"<{count}Q", *values))
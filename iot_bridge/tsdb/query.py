@@ -0,0 +1,162 @@
+"""
+Local HTTP query API over the time-series store.
+
+    GET /api/v1/series?device=boiler-*&metric=temperature
+    GET /api/v1/query?device=boiler-1&metric=temperature&start=-1h&end=now&step=60&agg=mean
+
+`device` and `metric` are fnmatch patterns (every series when left out);
+`start` and `end` are epoch seconds, ``now`` or a time relative to now such as
+``-15m`` (default: the last hour). With `step` (seconds) the points of each
+series are downsampled into buckets aligned to multiples of the step, using
+`agg`. Timestamps in responses are epoch seconds.
+"""
+import http.server
+import logging
+import threading
+import time
+from itertools import groupby
+from urllib.parse import parse_qs, urlsplit
+
+from .. import codec
+from . import chunks
+
+log = logging.getLogger(__name__)
+
+AGGREGATIONS = ("mean", "min", "max", "sum", "count", "first", "last")
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value, now):
+    """Epoch seconds for "now", "-15m"-style relative times and plain epoch seconds."""
+    if value == "now":
+        return now
+    if value.startswith("-") and value[-1:] in _UNITS:
+        return now - float(value[1:-1]) * _UNITS[value[-1]]
+    return float(value)
+
+
+def downsample(timestamps, values, step_ms, agg="mean"):
+    """Aggregate time-ordered points into buckets of `step_ms`; returns (bucket starts, values)."""
+    if agg not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {agg!r}, expected one of {AGGREGATIONS}")
+    np = chunks.np
+    if np is None:
+        buckets, results = [], []
+        for bucket, points in groupby(zip(timestamps, values), key=lambda point: point[0] // step_ms):
+            bucket_values = [v for _, v in points]
+            buckets.append(bucket * step_ms)
+            results.append(_aggregate(bucket_values, agg))
+        return buckets, results
+    if not len(timestamps):
+        return timestamps, values
+    buckets = timestamps // step_ms
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    counts = np.diff(np.append(starts, len(values)))
+    if agg == "count":
+        result = counts.astype(np.float64)
+    elif agg == "first":
+        result = values[starts]
+    elif agg == "last":
+        result = values[starts + counts - 1]
+    else:
+        ufunc = {"min": np.minimum, "max": np.maximum}.get(agg, np.add)
+        result = ufunc.reduceat(values, starts)
+        if agg == "mean":
+            result = result / counts
+    return buckets[starts] * step_ms, result
+
+
+def _aggregate(values, agg):
+    if agg == "mean":
+        return sum(values) / len(values)
+    if agg == "count":
+        return float(len(values))
+    if agg == "first":
+        return values[0]
+    if agg == "last":
+        return values[-1]
+    return {"min": min, "max": max, "sum": sum}[agg](values)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def run_query(store, params, max_points, now=None):
+    """Result of a /api/v1/query request given its parameters (a dict of strings)."""
+    now = time.time() if now is None else now
+    try:
+        end = parse_time(params.get("end", "now"), now)
+        start = parse_time(params.get("start", "-1h"), now)
+        step = float(params["step"]) if params.get("step") else None
+    except ValueError as e:
+        raise QueryError(f"Invalid time parameter: {e}") from None
+    if step is not None and step <= 0:
+        raise QueryError("step must be positive")
+    agg = params.get("agg", "mean")
+    if agg not in AGGREGATIONS:
+        raise QueryError(f"Unknown aggregation {agg!r}, expected one of {AGGREGATIONS}")
+    start_ms, end_ms = int(start * 1000), int(end * 1000)
+    results, total = [], 0
+    for device, metric, _, _, _ in store.series(params.get("device"), params.get("metric")):
+        timestamps, values = store.read(device, metric, start_ms, end_ms)
+        if step is not None:
+            timestamps, values = downsample(timestamps, values, int(step * 1000), agg)
+        total += len(values)
+        if total > max_points:
+            raise QueryError(f"More than {max_points} points; narrow the range or set a larger step")
+        if not len(values):
+            continue
+        timestamps = timestamps.tolist() if hasattr(timestamps, "tolist") else timestamps
+        values = values.tolist() if hasattr(values, "tolist") else values
+        results.append({"device": device, "metric": metric, "points": [[t / 1000, v] for t, v in zip(timestamps, values)]})
+    response = {"start": start, "end": end, "series": results}
+    if step is not None:
+        response.update(step=step, agg=agg)
+    return response
+
+
+class _QueryHandler(http.server.BaseHTTPRequestHandler):
+    store = None
+    max_points = 1000000
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/api/v1/query":
+                body = run_query(self.store, params, self.max_points)
+            elif url.path == "/api/v1/series":
+                body = {"series": [{"device": device, "metric": metric, "points": points, "first": first / 1000, "last": last / 1000}
+                                   for device, metric, points, first, last in self.store.series(params.get("device"), params.get("metric"))]}
+            else:
+                self.send_error(404)
+                return
+        except QueryError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(200, body)
+
+    def _reply(self, status, body):
+        data = codec.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_query_server(store, port, bind="127.0.0.1", max_points=1000000):
+    """Serve the query API on `bind`:`port` from a daemon thread; None if `port` is 0."""
+    if port <= 0:
+        return None
+    handler = type("QueryHandler", (_QueryHandler,), {"store": store, "max_points": max_points})
+    server = http.server.ThreadingHTTPServer((bind, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="tsdb-http", daemon=True)
+    thread.start()
+    log.info("Serving time-series queries on http://%s:%d/api/v1/query", bind, port)
+    return server
@@ -0,0 +1,338 @@
+"""
+Embedded time-series store for the readings a bridge has seen.
+
+Every numeric field of a reading is a point of the series (device, metric).
+New points go to the series' in-memory head; a head is sealed into a chunk
+(see chunks.py) once it holds `chunk_points` points, and every
+`flush_interval` seconds. Chunks are appended as length-prefixed, CRC-checked
+records to fixed-size, memory-mapped segment files, as in the journal, and
+an index of chunk time ranges per series is rebuilt from the segments when
+the store is reopened. Whole segments are deleted once all their points are
+older than the retention period, or oldest first when the store outgrows
+`max_bytes`.
+
+Points still in a head are lost if the process dies; the store is a local
+cache next to the gateway, not a replacement for it.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from fnmatch import fnmatchcase
+
+from .. import metrics
+from . import chunks
+
+log = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<II") # record length, crc32
+_CHUNK = struct.Struct("<qqIIBH") # earliest and latest timestamp (ms), points, timestamp column bytes, codec, key bytes
+_SEGMENT_SUFFIX = ".tsdb"
+_KEY_SEPARATOR = "\x00"
+
+_ID_FIELDS = ("device_id", "sensor_id", "topic")
+_SKIP_FIELDS = frozenset(("timestamp",) + _ID_FIELDS)
+
+TSDB_POINTS = metrics.counter("bridge_tsdb_points_total", "Points written to the local time-series store")
+TSDB_DROPPED = metrics.counter("bridge_tsdb_dropped_total", "Points not stored, by reason (series_limit)")
+TSDB_SERIES = metrics.gauge("bridge_tsdb_series", "Series in the local time-series store")
+TSDB_BYTES = metrics.gauge("bridge_tsdb_bytes", "Bytes of chunks in the local time-series store's segments")
+TSDB_EVICTED = metrics.counter("bridge_tsdb_evicted_segments_total", "Segments deleted, by reason (retention/size)")
+
+
+class _Segment:
+    def __init__(self, path, size, create=False):
+        self.path = path
+        self.file = open(path, "w+b" if create else "r+b")
+        if create:
+            self.file.truncate(size)
+        else:
+            size = os.fstat(self.file.fileno()).st_size
+        self.size = size
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.write_offset = 0
+        self.max_ts = None
+
+    def records(self):
+        """(offset, length) of each valid record, stopping at the end of valid data."""
+        offset = 0
+        while offset + _HEADER.size <= self.size:
+            length, crc = _HEADER.unpack_from(self.map, offset)
+            end = offset + _HEADER.size + length
+            if length < _CHUNK.size or end > self.size or zlib.crc32(self.map[offset + _HEADER.size:end]) != crc:
+                break
+            yield offset, length
+            offset = end
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class _Series:
+    __slots__ = ("device", "metric", "chunks", "timestamps", "values", "points")
+
+    def __init__(self, device, metric):
+        self.device = device
+        self.metric = metric
+        self.chunks = [] # (segment id, offset, first ms, last ms, points)
+        self.timestamps = array("q") # Head, not yet sealed
+        self.values = array("d")
+        self.points = 0 # In sealed chunks
+
+
+class TimeSeriesStore:
+    """Per-series columnar chunks in memory-mapped segments, with retention."""
+
+    def __init__(self, directory, retention=7 * 86400, max_bytes=0, chunk_points=1024, segment_bytes=8 * 1024 * 1024,
+                 flush_interval=300.0, max_series=100000, compress=True):
+        self.directory = directory
+        self.retention = retention # Seconds; 0 keeps everything (up to max_bytes)
+        self.max_bytes = max_bytes # 0 is unlimited
+        self.chunk_points = chunk_points
+        self.segment_bytes = segment_bytes
+        self.max_series = max_series
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._series = {}
+        self._segments = {}
+        self._write_id = None
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._stopped = threading.Event()
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(target=self._run, args=(flush_interval,), name="tsdb-flush", daemon=True)
+            self._thread.start()
+
+    # --- Recovery ---
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:020d}{_SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        ids = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+        points = 0
+        for segment_id in ids:
+            segment = self._segments[segment_id] = _Segment(self._segment_path(segment_id), self.segment_bytes)
+            for offset, length in segment.records():
+                first, last, count, _, _, key_length = _CHUNK.unpack_from(segment.map, offset + _HEADER.size)
+                start = offset + _HEADER.size + _CHUNK.size
+                device, _, metric = bytes(segment.map[start:start + key_length]).decode("utf-8").partition(_KEY_SEPARATOR)
+                series = self._series.get((device, metric))
+                if series is None:
+                    series = self._series[(device, metric)] = _Series(device, metric)
+                series.chunks.append((segment_id, offset, first, last, count))
+                series.points += count
+                points += count
+                segment.max_ts = last if segment.max_ts is None else max(segment.max_ts, last)
+                segment.write_offset = offset + _HEADER.size + length
+        if ids:
+            self._write_id = ids[-1]
+            log.info("Time-series store %s reopened with %d series, %d points", self.directory, len(self._series), points)
+        self._update_gauges()
+
+    # --- Writing ---
+
+    def append(self, device, metric, value, timestamp_ms):
+        """Add one point; False if the series limit kept it out."""
+        with self._lock:
+            return self._append(device, metric, value, timestamp_ms)
+
+    def append_reading(self, reading, now=None):
+        """Add every numeric field of a reading as a point of its device's series.
+
+        The reading's `timestamp` (seconds, or milliseconds since the epoch) is
+        used when present, else the time it arrived.
+        """
+        device = next((str(reading[f]) for f in _ID_FIELDS if f in reading), None) or str(reading.get("source", ""))
+        timestamp = reading.get("timestamp")
+        if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool) and 0 <= timestamp < 1e14:
+            timestamp_ms = int(timestamp * 1000) if timestamp < 1e11 else int(timestamp)
+        else:
+            timestamp_ms = int((now if now is not None else time.time()) * 1000)
+        with self._lock:
+            for name, value in reading.items():
+                if name in _SKIP_FIELDS or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                self._append(device, name, value, timestamp_ms)
+
+    def _append(self, device, metric, value, timestamp_ms):
+        series = self._series.get((device, metric))
+        if series is None:
+            if len(self._series) >= self.max_series:
+                TSDB_DROPPED.inc(reason="series_limit")
+                return False
+            series = self._series[(device, metric)] = _Series(device, metric)
+            TSDB_SERIES.set(len(self._series))
+        series.timestamps.append(timestamp_ms)
+        series.values.append(value)
+        TSDB_POINTS.inc()
+        if len(series.values) >= self.chunk_points:
+            self._seal(series)
+        return True
+
+    def _seal(self, series):
+        """Write a series' head as a chunk (lock held)."""
+        if not series.values:
+            return
+        timestamps, values = series.timestamps, series.values
+        encode = chunks.encode if self.compress else chunks.encode_raw
+        codec, ts_bytes, value_bytes = encode(timestamps, values)
+        key = f"{series.device}{_KEY_SEPARATOR}{series.metric}".encode("utf-8")
+        first, last = min(timestamps), max(timestamps)
+        body = b"".join((_CHUNK.pack(first, last, len(values), len(ts_bytes), codec, len(key)),
+                         key, ts_bytes, value_bytes))
+        needed = _HEADER.size + len(body)
+        segment = self._segments.get(self._write_id)
+        if segment is None or segment.write_offset + needed > segment.size:
+            segment = self._roll(needed)
+        offset = segment.write_offset
+        _HEADER.pack_into(segment.map, offset, len(body), zlib.crc32(body))
+        segment.map[offset + _HEADER.size:offset + needed] = body
+        segment.write_offset += needed
+        segment.max_ts = last if segment.max_ts is None else max(segment.max_ts, last)
+        series.chunks.append((self._write_id, offset, first, last, len(values)))
+        series.points += len(values)
+        series.timestamps, series.values = array("q"), array("d")
+
+    def _roll(self, needed):
+        if self._write_id is not None:
+            self._segments[self._write_id].map.flush()
+        self._write_id = (self._write_id or 0) + 1
+        segment = self._segments[self._write_id] = _Segment(self._segment_path(self._write_id),
+                                                            max(self.segment_bytes, needed), create=True)
+        self._enforce_size()
+        return segment
+
+    def flush(self):
+        """Seal every head and write the current segment out."""
+        with self._lock:
+            for series in list(self._series.values()): # Sealing can roll a segment and evict series
+                self._seal(series)
+            if self._write_id is not None:
+                self._segments[self._write_id].map.flush()
+            self._update_gauges()
+
+    # --- Retention ---
+
+    def expire(self, now=None):
+        """Delete segments whose points are all older than the retention period."""
+        if self.retention <= 0:
+            return
+        cutoff = ((now if now is not None else time.time()) - self.retention) * 1000
+        with self._lock:
+            for segment_id, segment in list(self._segments.items()):
+                if segment_id != self._write_id and (segment.max_ts is None or segment.max_ts < cutoff):
+                    self._drop_segment(segment_id, "retention")
+            self._update_gauges()
+
+    def _enforce_size(self):
+        if self.max_bytes <= 0:
+            return
+        while len(self._segments) > 1 and sum(s.size for s in self._segments.values()) > self.max_bytes:
+            self._drop_segment(min(self._segments), "size")
+
+    def _drop_segment(self, segment_id, reason):
+        segment = self._segments.pop(segment_id)
+        for key, series in list(self._series.items()):
+            kept = [chunk for chunk in series.chunks if chunk[0] != segment_id]
+            if len(kept) != len(series.chunks):
+                series.points -= sum(chunk[4] for chunk in series.chunks if chunk[0] == segment_id)
+                series.chunks = kept
+                if not kept and not series.values:
+                    del self._series[key]
+        segment.close()
+        os.remove(segment.path)
+        TSDB_EVICTED.inc(reason=reason)
+        log.info("Deleted time-series segment %d (%s)", segment_id, reason)
+
+    # --- Reading ---
+
+    def series(self, device=None, metric=None):
+        """(device, metric, points, first ms, last ms) of the series matching the (fnmatch) patterns."""
+        with self._lock:
+            matching = [s for s in self._series.values()
+                        if (device is None or fnmatchcase(s.device, device)) and (metric is None or fnmatchcase(s.metric, metric))]
+            results = []
+            for s in matching:
+                firsts = [chunk[2] for chunk in s.chunks] + ([min(s.timestamps)] if s.timestamps else [])
+                lasts = [chunk[3] for chunk in s.chunks] + ([max(s.timestamps)] if s.timestamps else [])
+                results.append((s.device, s.metric, s.points + len(s.values), min(firsts), max(lasts)))
+        return sorted(results)
+
+    def read(self, device, metric, start_ms, end_ms):
+        """Points of one series with start_ms <= timestamp < end_ms, in time order.
+
+        Returns (timestamps, values): NumPy arrays when installed, else lists.
+        """
+        with self._lock:
+            series = self._series.get((device, metric))
+            if series is None:
+                return ([], []) if chunks.np is None else (chunks.np.empty(0, "i8"), chunks.np.empty(0, "f8"))
+            raw = []
+            for segment_id, offset, first, last, count in series.chunks:
+                if last >= start_ms and first < end_ms:
+                    segment = self._segments[segment_id]
+                    length, _ = _HEADER.unpack_from(segment.map, offset)
+                    raw.append(segment.map[offset + _HEADER.size:offset + _HEADER.size + length]) # A copy
+            head = (array("q", series.timestamps), array("d", series.values))
+        columns = [_decode(body) for body in raw]
+        if head[1]:
+            columns.append(head)
+        return _select(columns, start_ms, end_ms)
+
+    # --- Housekeeping ---
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.flush()
+                self.expire()
+            except Exception as e:
+                log.exception("Time-series store housekeeping failed: %s", e)
+
+    def _update_gauges(self):
+        TSDB_SERIES.set(len(self._series))
+        TSDB_BYTES.set(sum(segment.write_offset for segment in self._segments.values()))
+
+    def bytes_used(self):
+        """Bytes of chunk records written to the segments."""
+        with self._lock:
+            return sum(segment.write_offset for segment in self._segments.values())
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+
+def _decode(body):
+    first, last, count, ts_length, codec, key_length = _CHUNK.unpack_from(body)
+    start = _CHUNK.size + key_length
+    return chunks.decode(codec, count, body[start:start + ts_length], body[start + ts_length:])
+
+
+def _select(columns, start_ms, end_ms):
+    np = chunks.np
+    if np is None:
+        points = sorted((t, v) for timestamps, values in columns for t, v in zip(timestamps, values) if start_ms <= t < end_ms)
+        return [t for t, _ in points], [v for _, v in points]
+    if not columns:
+        return np.empty(0, "i8"), np.empty(0, "f8")
+    timestamps = np.concatenate([np.asarray(t, dtype=np.int64) for t, _ in columns])
+    values = np.concatenate([np.asarray(v, dtype=np.float64) for _, v in columns])
+    if len(timestamps) > 1 and (np.diff(timestamps) < 0).any():
+        order = np.argsort(timestamps, kind="stable") # Late points or chunks out of order
+        timestamps, values = timestamps[order], values[order]
+    lo, hi = np.searchsorted(timestamps, [start_ms, end_ms])
+    return timestamps[lo:hi], values[lo:hi]
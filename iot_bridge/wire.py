@@ -0,0 +1,171 @@
+"""
+Wire format of the request bodies sent to the gateway: compression and a compact binary envelope.
+
+Bodies are built as JSON (one reading, or an array of them) and turned into
+what goes on the wire just before they are sent:
+
+- ``HTTP_ENVELOPE=msgpack`` re-encodes them as a MessagePack envelope in which
+  field names and string values (device IDs, sources, topics) are sent once
+  per request and referred to by index, instead of once per reading (see
+  `envelope()`). Needs msgspec.
+- ``HTTP_COMPRESSION=gzip`` or ``deflate`` compresses them, with the matching
+  ``Content-Encoding``. Deflate can start from a preset dictionary shared with
+  the gateway (``HTTP_COMPRESSION_DICT``), e.g. one made by
+  `train_dictionary()` from typical payloads, so that even single readings
+  compress well.
+
+Streams (streaming.py) are compressed as a whole instead: one compressor per
+stream, flushed at the end of every chunk.
+"""
+import collections
+import logging
+import os
+import zlib
+
+from . import codec, metrics
+
+try:
+    import msgspec
+except ImportError: # Optional; required by HTTP_ENVELOPE=msgpack
+    msgspec = None
+
+log = logging.getLogger(__name__)
+
+COMPRESSIONS = ("none", "gzip", "deflate")
+ENVELOPES = ("json", "msgpack")
+ENVELOPE_CONTENT_TYPE = "application/vnd.iot-envelope+msgpack"
+INTERNED_STRING = 1 # MessagePack extension type of a reference into the envelope's string table
+
+_WBITS = {"gzip": 31, "deflate": 15} # zlib window bits selecting the gzip or zlib (HTTP "deflate") format
+
+BODY_BYTES = metrics.counter("bridge_http_body_bytes_total", "Request body bytes to the gateway, as JSON (stage=json) and on the wire (stage=wire)")
+
+
+def envelope(readings):
+    """MessagePack envelope of readings (dicts)::
+
+        {"k": [field names], "s": [string values], "r": [{field index: value}, ...]}
+
+    String values are replaced by an extension (type 1) holding their index in
+    "s" as a big-endian unsigned integer of 1, 2 or 4 bytes.
+    """
+    keys, strings, rows = {}, {}, []
+    for reading in readings:
+        row = {}
+        for key, value in reading.items():
+            index = keys.get(key)
+            if index is None:
+                index = keys[key] = len(keys)
+            if isinstance(value, str):
+                ref = strings.get(value)
+                if ref is None:
+                    ref = strings[value] = msgspec.msgpack.Ext(INTERNED_STRING, _index_bytes(len(strings)))
+                value = ref
+            row[index] = value
+        rows.append(row)
+    return msgspec.msgpack.encode({"k": list(keys), "s": list(strings), "r": rows})
+
+
+def _index_bytes(index):
+    if index < 0x100:
+        return index.to_bytes(1, "big")
+    if index < 0x10000:
+        return index.to_bytes(2, "big")
+    return index.to_bytes(4, "big")
+
+
+def train_dictionary(samples, size=16 * 1024):
+    """A preset deflate dictionary of at most `size` bytes from sample readings (encoded JSON).
+
+    Deflate matches against the last 32 KiB, and shorter distances cost fewer
+    bits, so the dictionary is made of the field names and the field/string
+    value pairs the samples share, the most frequent last, followed by a few
+    whole samples for the punctuation and number formats in between.
+    """
+    fragments = collections.Counter()
+    for sample in samples:
+        for key, value in codec.loads(sample).items():
+            fragments[codec.dumps({key: value})[1:-1] if isinstance(value, str) else codec.dumps(key) + b":"] += 1
+    tail = b"".join(samples[-4:])[-size // 4:]
+    parts, used = [], len(tail)
+    for fragment, count in fragments.most_common():
+        if count < 2:
+            break
+        if used + len(fragment) <= size:
+            parts.append(fragment)
+            used += len(fragment)
+    return b"".join(reversed(parts)) + tail
+
+
+class BodyEncoder:
+    """Turns JSON request bodies into wire bodies, with the headers that describe them."""
+
+    def __init__(self, compression="none", envelope="json", level=6, min_bytes=None, dictionary=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        if envelope not in ENVELOPES:
+            raise ValueError(f"Unknown envelope {envelope!r}, expected one of {ENVELOPES}")
+        if envelope == "msgpack" and msgspec is None:
+            raise ValueError("The msgpack envelope requires msgspec")
+        if dictionary and compression != "deflate":
+            raise ValueError("A compression dictionary needs deflate compression") # gzip has no preset dictionaries
+        self.compression = compression
+        self.envelope = envelope
+        self.level = level
+        if min_bytes is None: # With a dictionary, even single readings compress well
+            min_bytes = 0 if dictionary else 256
+        self.min_bytes = min_bytes # Smaller bodies are sent uncompressed
+        self.dictionary = dictionary or None
+        self.content_type = ENVELOPE_CONTENT_TYPE if envelope == "msgpack" else "application/json"
+
+    def encode(self, body):
+        """(wire body, headers) for a JSON body: one reading or an array of them."""
+        headers = {}
+        json_size = len(body)
+        if self.envelope == "msgpack":
+            readings = codec.loads(body)
+            body = envelope(readings if isinstance(readings, list) else [readings])
+            headers["Content-Type"] = ENVELOPE_CONTENT_TYPE
+        if self.compression != "none" and len(body) >= self.min_bytes:
+            compressor = self.compressor()
+            body = compressor.compress(body) + compressor.flush()
+            headers["Content-Encoding"] = self.compression
+        BODY_BYTES.inc(json_size, stage="json")
+        BODY_BYTES.inc(len(body), stage="wire")
+        return body, headers
+
+    def compressor(self):
+        """A new zlib compressor in the configured format, or None without compression."""
+        if self.compression == "none":
+            return None
+        if self.dictionary:
+            return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[self.compression], zdict=self.dictionary)
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[self.compression])
+
+
+def open_encoder_from_env():
+    """The BodyEncoder configured by HTTP_COMPRESSION, HTTP_ENVELOPE and friends.
+
+    Raises ValueError for invalid settings.
+    """
+    dictionary = min_bytes = None
+    if os.getenv("HTTP_COMPRESSION_MIN_BYTES"):
+        min_bytes = int(os.getenv("HTTP_COMPRESSION_MIN_BYTES"))
+    path = os.getenv("HTTP_COMPRESSION_DICT")
+    if path:
+        try:
+            with open(path, "rb") as f:
+                dictionary = f.read()
+        except OSError as e:
+            raise ValueError(f"Cannot read compression dictionary: {e}") from None
+    encoder = BodyEncoder(
+        compression=os.getenv("HTTP_COMPRESSION", "none").lower(),
+        envelope=os.getenv("HTTP_ENVELOPE", "json").lower(),
+        level=int(os.getenv("HTTP_COMPRESSION_LEVEL", "6")),
+        min_bytes=min_bytes,
+        dictionary=dictionary,
+    )
+    if encoder.compression != "none" or encoder.envelope != "json":
+        log.info("Request bodies: %s envelope, %s compression%s", encoder.envelope, encoder.compression,
+                 f" with a {len(dictionary)}-byte dictionary" if dictionary else "")
+    return encoder